@@ -1,5 +1,14 @@
+from .admission import *
+from .block_cache import *
+from .compression_cache import *
+from .digest_index import *
 from .download_manager import *
+from .file_handles import *
+from .mapped_files import *
 from .monitor_filesys import *
+from .resource_catalog import *
 from .rich_client import *
 from .rich_progress import *
 from .rich_table import *
+from .scheduler import *
+from .sqlite_catalog import *
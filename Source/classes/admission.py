@@ -0,0 +1,71 @@
+from collections import deque
+from threading import Lock
+from typing import TypeVar, Generic, Hashable
+
+from shared.envs import SERVER_WORKERS, ADMISSION_QUEUE_SIZE
+
+K = TypeVar("K", bound=Hashable)
+
+
+# Decides which connections are served: at most `workers` at once, the next
+# `queue_size` ones wait in arrival order and the rest are turned away. It only
+# keeps the books, the servers tell the clients and start the sessions
+class AdmissionController(Generic[K]):
+    def __init__(
+        self, *, workers: int = SERVER_WORKERS, queue_size: int = ADMISSION_QUEUE_SIZE
+    ):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+
+        self.lock = Lock()
+        self.active: set[K] = set()
+        self.waiting: deque[K] = deque()
+        self.counters = {"admitted": 0, "queued": 0, "rejected": 0}
+
+    def __contains__(self, key: K) -> bool:
+        with self.lock:
+            return key in self.active or key in self.waiting
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "active": len(self.active),
+                "waiting": len(self.waiting),
+            }
+
+    # 0 when admitted right away, the position in the queue, or None if full
+    def offer(self, key: K) -> int | None:
+        with self.lock:
+            if len(self.active) < self.workers and not self.waiting:
+                self.active.add(key)
+                self.counters["admitted"] += 1
+                return 0
+
+            if len(self.waiting) >= self.queue_size:
+                self.counters["rejected"] += 1
+                return None
+
+            self.waiting.append(key)
+            self.counters["queued"] += 1
+            return len(self.waiting)
+
+    # Returns the waiting keys admitted in its place
+    def release(self, key: K) -> list[K]:
+        with self.lock:
+            if key in self.active:
+                self.active.discard(key)
+            elif key in self.waiting:
+                self.waiting.remove(key)
+
+            admitted = []
+            while self.waiting and len(self.active) < self.workers:
+                admitted.append(self.waiting.popleft())
+                self.active.add(admitted[-1])
+                self.counters["admitted"] += 1
+
+            return admitted
+
+    def positions(self) -> list[tuple[K, int]]:
+        with self.lock:
+            return [(key, i) for i, key in enumerate(self.waiting, 1)]
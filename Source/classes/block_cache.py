@@ -0,0 +1,237 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from shared.envs import (
+    BLOCK_CACHE_SIZE,
+    BLOCK_CACHE_BLOCK,
+    BLOCK_CACHE_POLICY,
+    PREFETCH_WORKERS,
+    PREFETCH_MAX_SIZE,
+)
+from utils.files import get_file_identity
+
+
+# Blocks of the served files shared by every connection, bounded in bytes.
+# Keys are (file identity, block index), the identity changes with the size or
+# mtime so a rewritten file is never served from old blocks. Concurrent misses
+# on one block wait for a single read. With the "2q" policy new blocks go to
+# a FIFO first and only blocks asked for again after leaving it are kept in
+# the LRU, so one big cold download does not flush the hot files
+class BlockCache:
+    def __init__(
+        self,
+        *,
+        capacity: int = BLOCK_CACHE_SIZE,
+        block_size: int = BLOCK_CACHE_BLOCK,
+        policy: str = BLOCK_CACHE_POLICY,
+        workers: int = PREFETCH_WORKERS,
+        max_prefetch: int = PREFETCH_MAX_SIZE,
+    ):
+        self.capacity = capacity
+        self.block_size = block_size
+        self.probation = capacity // 4 if policy == "2q" else 0
+
+        self.lock = Lock()
+        self.size = 0
+        self.recent: OrderedDict[tuple, bytes] = OrderedDict()
+        self.recent_size = 0
+        self.frequent: OrderedDict[tuple, bytes] = OrderedDict()
+
+        # Keys evicted from the FIFO lately, a miss on one goes to the LRU
+        self.ghosts: OrderedDict[tuple, None] = OrderedDict()
+        self.max_ghosts = max(1, capacity // block_size // 2)
+
+        self.flights: dict[tuple, Future] = {}
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "evictions": 0,
+            "prefetched": 0,
+            "prefetch_dropped": 0,
+        }
+
+        # Read-ahead, bounded in bytes being read over all downloads
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_prefetch = max_prefetch
+        self.prefetching = 0
+
+    identity = staticmethod(get_file_identity)
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "size": self.size,
+                "blocks": len(self.recent) + len(self.frequent),
+                "in_flight": len(self.flights),
+                "prefetching": self.prefetching,
+            }
+
+    def lookup(self, key: tuple) -> bytes | None:
+        if key in self.frequent:
+            self.frequent.move_to_end(key)
+            return self.frequent[key]
+
+        return self.recent.get(key)
+
+    def insert(self, key: tuple, block: bytes):
+        if len(block) > self.capacity:
+            return
+
+        if self.probation and key not in self.ghosts:
+            self.recent[key] = block
+            self.recent_size += len(block)
+        else:
+            self.ghosts.pop(key, None)
+            self.frequent[key] = block
+
+        self.size += len(block)
+        self.evict()
+
+    def evict(self):
+        while self.size > self.capacity:
+            if self.recent and (self.recent_size > self.probation or not self.frequent):
+                key, block = self.recent.popitem(last=False)
+                self.recent_size -= len(block)
+
+                self.ghosts[key] = None
+                while len(self.ghosts) > self.max_ghosts:
+                    self.ghosts.popitem(last=False)
+            else:
+                key, block = self.frequent.popitem(last=False)
+
+            self.size -= len(block)
+            self.counters["evictions"] += 1
+
+    def load(self, fd: int, index: int) -> bytes:
+        return os.pread(fd, self.block_size, index * self.block_size)
+
+    def get_block(self, fd: int, ident: tuple, index: int, miss="misses") -> bytes:
+        key = ident, index
+
+        with self.lock:
+            if (block := self.lookup(key)) is not None:
+                self.counters["hits"] += 1
+                return block
+
+            if flight := self.flights.get(key):
+                self.counters["coalesced"] += 1
+                owner = False
+            else:
+                self.counters[miss] += 1
+                flight = self.flights[key] = Future()
+                owner = True
+
+        if not owner:
+            return flight.result()
+
+        try:
+            block = self.load(fd, index)
+        except OSError as e:
+            with self.lock:
+                self.flights.pop(key, None)
+
+            flight.set_exception(e)
+            raise
+
+        with self.lock:
+            self.flights.pop(key, None)
+            self.insert(key, block)
+
+        flight.set_result(block)
+        return block
+
+    def get_range(self, offset: int, size: int) -> range:
+        return range(
+            offset // self.block_size, (offset + size - 1) // self.block_size + 1
+        )
+
+    def slice(self, blocks: list[bytes], offset: int, size: int) -> bytes:
+        start = offset % self.block_size
+        data = blocks[0] if len(blocks) == 1 else b"".join(blocks)
+
+        return data[start : start + size]
+
+    # Reads through the cache, shorter than asked at the end of the file
+    def read(self, file, ident: tuple, offset: int, size: int) -> bytes:
+        if size <= 0:
+            return b""
+
+        blocks = [
+            self.get_block(file.fileno(), ident, i)
+            for i in self.get_range(offset, size)
+        ]
+        return self.slice(blocks, offset, size)
+
+    # Loads the blocks of the range in the background, so they are in memory
+    # by the time the download gets there. Skipped once too much is pending
+    def prefetch(self, file, ident: tuple, offset: int, size: int):
+        if size <= 0:
+            return
+
+        with self.lock:
+            blocks = [
+                i
+                for i in self.get_range(offset, size)
+                if (ident, i) not in self.flights and self.lookup((ident, i)) is None
+            ]
+            pending = len(blocks) * self.block_size
+
+            if not blocks:
+                return
+            if self.prefetching + pending > self.max_prefetch:
+                self.counters["prefetch_dropped"] += 1
+                return
+
+            self.prefetching += pending
+
+        # A handle of its own, the download may close its file meanwhile
+        fd = os.dup(file.fileno())
+
+        try:
+            future = self.pool.submit(self.read_ahead, fd, ident, blocks, pending)
+        except RuntimeError:
+            self.read_ahead_done(fd, pending)
+            return
+
+        # A read cancelled by close() never runs, its handle is closed here
+        future.add_done_callback(
+            lambda future: future.cancelled() and self.read_ahead_done(fd, pending)
+        )
+
+    def read_ahead(self, fd: int, ident: tuple, blocks: list[int], pending: int):
+        try:
+            for i in blocks:
+                self.get_block(fd, ident, i, miss="prefetched")
+        except OSError:
+            pass
+        finally:
+            self.read_ahead_done(fd, pending)
+
+    def read_ahead_done(self, fd: int, pending: int):
+        os.close(fd)
+
+        with self.lock:
+            self.prefetching -= pending
+
+    # Only hits, for callers that must not block on the disk
+    def peek(self, ident: tuple, offset: int, size: int) -> bytes | None:
+        if size <= 0:
+            return b""
+
+        with self.lock:
+            blocks = []
+            for i in self.get_range(offset, size):
+                if (block := self.lookup((ident, i))) is None:
+                    return None
+                blocks.append(block)
+
+            self.counters["hits"] += len(blocks)
+
+        return self.slice(blocks, offset, size)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
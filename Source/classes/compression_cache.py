@@ -0,0 +1,132 @@
+import os, re
+from urllib.parse import quote
+from time import thread_time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.envs import (
+    SERVER_CACHE_PATH,
+    COMPRESS_CODECS,
+    COMPRESS_MAX_RATIO,
+    COMPRESS_MIN_SIZE,
+    COMPRESS_WORKERS,
+)
+from utils.compression import is_precompressed, get_sample_ratio, compress_file
+
+
+# Compressed variants of the resources, kept on disk and named after the size
+# and mtime of the source so a changed file never serves a stale variant.
+# Variants are built in the background, the file is sent as is until then
+class CompressionCache:
+    def __init__(
+        self, *, path: str = SERVER_CACHE_PATH, workers: int = COMPRESS_WORKERS
+    ):
+        self.path = path
+        self.lock = Lock()
+        self.pending: set[str] = set()
+        # No workers: variants are built by the caller, before it gets them
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+
+        # CPU spent on a variant, reported when it is first served
+        self.costs: dict[str, float] = {}
+        self.ratios: dict[str, tuple[int, int, float]] = {}
+
+    def get_ratio(self, filename: str, path: str, stat: os.stat_result) -> float:
+        cached = self.ratios.get(filename)
+        if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        ratio = get_sample_ratio(path)
+        self.ratios[filename] = (stat.st_size, stat.st_mtime_ns, ratio)
+
+        return ratio
+
+    def choose(self, filename: str, path: str, codecs: list[str]) -> str | None:
+        codec = next((c for c in COMPRESS_CODECS if c in codecs), None)
+        if not codec or is_precompressed(filename):
+            return None
+
+        stat = os.stat(path)
+        if stat.st_size < COMPRESS_MIN_SIZE:
+            return None
+
+        return (
+            codec
+            if self.get_ratio(filename, path, stat) <= COMPRESS_MAX_RATIO
+            else None
+        )
+
+    # Files in subfolders keep a flat name in the cache
+    def get_variant_name(self, filename: str) -> str:
+        return quote(filename, safe="")
+
+    def get_variant_path(self, filename: str, stat: os.stat_result, codec: str):
+        name = f"{self.get_variant_name(filename)}.{stat.st_size}-{stat.st_mtime_ns}"
+        return os.path.join(self.path, f"{name}.{codec}")
+
+    def remove_stale(self, filename: str, stat: os.stat_result):
+        variant = re.escape(self.get_variant_name(filename))
+        pattern = re.compile(rf"{variant}\.(\d+-\d+)\.\w+")
+        key = f"{stat.st_size}-{stat.st_mtime_ns}"
+
+        for name in os.listdir(self.path):
+            if (match := pattern.fullmatch(name)) and match.group(1) != key:
+                os.remove(os.path.join(self.path, name))
+
+    # None while the variant is being built
+    def get_variant(
+        self, filename: str, path: str, codec: str
+    ) -> tuple[str, float] | None:
+        stat = os.stat(path)
+        variant = self.get_variant_path(filename, stat, codec)
+
+        if not os.path.exists(variant):
+            if self.pool:
+                self.schedule(filename, path, stat, codec, variant)
+                return None
+
+            self.build(filename, path, stat, codec, variant)
+
+        with self.lock:
+            return variant, self.costs.pop(variant, 0.0)
+
+    # Clients asking for the same variant share a single build
+    def schedule(self, filename, path, stat, codec, variant):
+        with self.lock:
+            if variant in self.pending:
+                return
+            self.pending.add(variant)
+
+        try:
+            self.pool.submit(self.build, filename, path, stat, codec, variant)
+        except RuntimeError:
+            with self.lock:
+                self.pending.discard(variant)
+
+    def build(self, filename, path, stat, codec, variant):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+
+            # Worker processes may build the same variant at once
+            start, tmp = thread_time(), f"{variant}.{os.getpid()}.tmp"
+            compress_file(path, tmp, codec)
+
+            # Changed while compressing, the next request builds it again
+            if os.stat(path).st_mtime_ns != stat.st_mtime_ns:
+                os.remove(tmp)
+                return
+
+            os.replace(tmp, variant)
+            self.remove_stale(filename, stat)
+
+            with self.lock:
+                self.costs[variant] = thread_time() - start
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.pending.discard(variant)
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
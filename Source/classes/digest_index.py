@@ -0,0 +1,184 @@
+import os, json
+from time import sleep
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from shared.envs import SERVER_DIR_PATH, DIGEST_CHUNK_SIZE, DIGEST_WORKERS
+from utils.files import get_file_digests
+
+
+# Digests of the resources, hashed in the background and cached on disk.
+# An entry is reused as long as the file keeps its size and mtime. The file is
+# written in the background like the catalog's, once per burst of digests
+class DigestIndex:
+    def __init__(
+        self,
+        *,
+        path: str = os.path.join(SERVER_DIR_PATH, "digests.json"),
+        workers: int = DIGEST_WORKERS,
+        interval: float = 0.5,
+    ):
+        self.path = path
+        self.interval = interval
+        self.lock = Lock()
+        self.pending: set[str] = set()
+        # No workers: digests are only put, by the process that computes them
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+
+        # Bumped whenever published digests change
+        self.version = 0
+        self.listeners: list = []
+        self.entries: dict[str, dict] = self.load()
+
+        # Catalog version each entry was last found fresh at, see get
+        self.checked: dict[str, int] = {}
+
+        self.closed = False
+        self.dirty = Event()
+        self.writer = Thread(target=self.persist, daemon=True) if workers else None
+        if self.writer:
+            self.writer.start()
+
+    def load(self) -> dict[str, dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries, separators=(",", ":"))
+
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+
+        os.replace(tmp, self.path)
+
+    def persist(self):
+        while not self.closed:
+            self.dirty.wait()
+
+            # Let the digests of a burst of files settle into one write
+            sleep(self.interval)
+            self.dirty.clear()
+
+            try:
+                self.save()
+            except OSError:
+                pass
+
+    def is_fresh(self, entry: dict | None, stat: os.stat_result) -> bool:
+        return bool(entry) and (
+            entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime_ns
+            and entry["chunk_size"] == DIGEST_CHUNK_SIZE
+        )
+
+    def get_public(self, entry: dict) -> dict:
+        return {k: v for k, v in entry.items() if k not in ["size", "mtime"]}
+
+    # With the catalog version, a file is only checked on disk again once the
+    # catalog changed since it was last found fresh
+    def get(self, filename: str, path: str, version: int = None) -> dict | None:
+        entry = self.entries.get(filename)
+        if entry and version is not None and self.checked.get(filename) == version:
+            return self.get_public(entry)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if self.is_fresh(entry, stat):
+            self.checked[filename] = version
+            return self.get_public(entry)
+
+        self.schedule(filename, path)
+        return None
+
+    # Takes the catalog entries as an iterable, they may be read in batches
+    def refresh(self, resources):
+        names = set()
+
+        for filename, fileinfo in resources:
+            names.add(filename)
+
+            if self.get(filename, fileinfo[1]):
+                for listener in self.listeners:
+                    listener(filename, self.entries[filename])
+
+        with self.lock:
+            for filename in [f for f in self.entries if f not in names]:
+                del self.entries[filename]
+                self.checked.pop(filename, None)
+                self.version += 1
+                self.dirty.set()
+
+    # With the version of the index the entry comes from, so that every
+    # process following it ends up at the same version
+    def put(self, filename: str, entry: dict, version: int = None):
+        with self.lock:
+            self.entries[filename] = entry
+            self.checked.pop(filename, None)
+            self.version += 1 if version is None else 0
+
+        self.follow(version) if version is not None else None
+
+        for listener in self.listeners:
+            listener(filename, entry)
+
+    def follow(self, version: int):
+        with self.lock:
+            self.version = max(self.version, version)
+
+    def schedule(self, filename: str, path: str):
+        if self.pool is None:
+            return
+
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+
+        try:
+            self.pool.submit(self.compute, filename, path)
+        except RuntimeError:
+            self.pending.discard(filename)
+
+    def compute(self, filename: str, path: str):
+        try:
+            stat = os.stat(path)
+            digests = get_file_digests(path)
+
+            # Changed while hashing, the next lookup schedules it again
+            if os.stat(path).st_mtime_ns != stat.st_mtime_ns:
+                return
+
+            with self.lock:
+                self.entries[filename] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    **digests,
+                }
+                self.checked.pop(filename, None)
+                self.version += 1
+            self.dirty.set()
+
+            for listener in self.listeners:
+                listener(filename, self.entries[filename])
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.pending.discard(filename)
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+        self.closed = True
+        self.dirty.set()
+        if self.writer:
+            self.writer.join(timeout=self.interval * 4)
@@ -1,9 +1,27 @@
+import os, asyncio
 from sys import stdout
+from math import ceil
+from time import thread_time
+from socket import socket
+from selectors import EVENT_WRITE
+from threading import Lock
 from typing import TypeVar, Generic
 
 from .rich_client import RichClient, RichProgress
+from .block_cache import BlockCache
+from .file_handles import FileHandles
+from .mapped_files import MappedFiles
+from .scheduler import WeightedScheduler
+from shared.envs import PREFETCH_CHUNKS, TRANSMIT_TIMEOUT
+from shared.protocol import ProtocolError, encode_header, encode_frame, wait_ready
 from utils.logger import LogType, console_log
-from utils.files import get_resource_path, get_download_path, get_downloaded_list
+from utils.compression import new_decompressor
+from utils.files import (
+    get_resource_path,
+    get_download_path,
+    get_downloaded_list,
+    new_chunk_hasher,
+)
 
 
 class FileDownloader:
@@ -13,23 +31,32 @@ class FileDownloader:
         filename: str,
         chunk_sz: int,
         tot: int,
+        stream_id: int = 0,
+        weight: int = 1,
+        offset: int = 0,
         render_content: str = "",
     ):
         self.filename = filename
         self.chunk_sz = chunk_sz
+        self.stream_id = stream_id
+        self.weight = weight
 
-        self.cur = 0
+        self.cur = offset
         self.tot = tot
         self.render_content = render_content or filename
 
     def is_done(self) -> bool:
         return self.cur >= self.tot
 
+    # An empty file is done as soon as it is requested
+    def get_percent(self) -> float:
+        return self.cur / float(self.tot) if self.tot else 1.0
+
     def raw_progress(self):
-        return (self.cur, self.tot, self.cur / float(self.tot))
+        return (self.cur, self.tot, self.get_percent())
 
     def render_progress_bar(self, len: int = 20) -> None:
-        percent = self.cur / float(self.tot)
+        percent = self.get_percent()
         cur_len = int(percent * len)
 
         if self.render_content:
@@ -47,44 +74,382 @@ class ClientFileDownloader(FileDownloader):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        self.path = get_download_path(kwargs["filename"])
+        self.target = self.path = get_download_path(kwargs["filename"])
+        self.lock = Lock()
 
-        # Create an empty file or overwrite the existing one
-        with open(self.path, "wb"):
-            pass
+        # Write position and end of the byte range received on each stream
+        self.ranges: dict[int, list[int]] = {}
 
-    def download(self, chunk_data: bytes):
-        if self.is_done() or not chunk_data or chunk_data == b"eof":
-            return
+        # Server chunk digests, checked while the data streams in
+        self.chunk_size = 0
+        self.chunks: list[str] = []
+        self.hashers: dict[int, object] = {}
+        self.corrupted: set[int] = set()
+
+        # Old copy of the file that delta transfers copy unchanged blocks from
+        self.basis: str | None = None
+        self.block_size = 0
 
+        # Compressed transfers: codec, bytes on the wire and CPU spent inflating
+        self.codec: str | None = None
+        self.decompressor = None
+        self.received = 0
+        self.inflate_time = 0.0
+
+        # Create an empty file or keep the part that is being resumed
+        self.seek(self.cur)
+
+    def seek(self, offset: int):
         with open(self.path, "ab") as f:
+            f.truncate(offset)
+
+        self.cur = offset
+        self.ranges = {self.stream_id: [offset, self.tot]}
+        self.hashers.clear()
+
+    def use_codec(self, codec: str):
+        self.codec = codec
+        self.decompressor = new_decompressor(codec)
+
+    def receive(self, chunk_data: bytes, stream_id: int = 0):
+        if not self.decompressor:
+            return self.download(chunk_data, stream_id)
+
+        start = thread_time()
+        data = self.decompressor.decompress(chunk_data)
+        self.inflate_time += thread_time() - start
+        self.received += len(chunk_data)
+
+        self.download(data, stream_id)
+
+        if self.is_done():
+            console_log(
+                LogType.INFO,
+                f"{self.filename} received as {self.codec}, "
+                f"{self.received / max(1, self.tot):.2%} of {self.tot} bytes, "
+                f"{self.inflate_time:.2f}s CPU to decompress",
+            )
+
+    def use_basis(self, basis: str, block_size: int):
+        self.basis = basis
+        self.block_size = block_size
+
+    def copy_blocks(self, stream_id: int, copy: dict, piece_size: int = 1024**2):
+        start, size = int(copy["block"]) * self.block_size, int(copy["size"])
+
+        for pos in range(0, size, piece_size):
+            with open(self.basis, "rb") as f:
+                f.seek(start + pos)
+                data = f.read(min(piece_size, size - pos))
+
+            self.download(data, stream_id)
+
+    def expect_digests(self, digests: dict):
+        self.chunk_size = int(digests.get("chunk_size", 0))
+        self.chunks = digests.get("chunks", []) if self.chunk_size else []
+
+    def verify(self, stream_id: int, pos: int, data: bytes):
+        while data and self.chunks:
+            index = pos // self.chunk_size
+            start = index * self.chunk_size
+            end = min(start + self.chunk_size, self.tot)
+
+            if not (digest := self.hashers.pop(stream_id, None)):
+                digest = new_chunk_hasher()
+
+                # A resumed stream starts mid-chunk, the head is already on disk
+                if pos > start:
+                    with open(self.path, "rb") as f:
+                        f.seek(start)
+                        digest.update(f.read(pos - start))
+
+            part = data[: end - pos]
+            digest.update(part)
+            pos, data = pos + len(part), data[len(part) :]
+
+            if pos < end:
+                self.hashers[stream_id] = digest
+            elif index < len(self.chunks) and digest.hexdigest() != self.chunks[index]:
+                self.corrupted.add(index)
+                console_log(
+                    LogType.ERR, f"Chunk {index} of {self.filename} failed verification"
+                )
+
+    def split(
+        self, stream_ids: list[int], align: int = 1
+    ) -> list[tuple[int, int, int]]:
+        # Segments land in a sized temporary file, so a crash never leaves
+        # something that looks like a resumable partial download
+        self.path = f"{self.target}.part"
+        with open(self.path, "wb") as f:
+            f.truncate(self.tot)
+
+        # Segment bounds fall on chunk bounds so every chunk can be verified
+        step = ceil(ceil((self.tot - self.cur) / len(stream_ids)) / align) * align
+        self.ranges = {
+            stream_id: [start, min(start + step, self.tot)]
+            for stream_id, start in zip(stream_ids, range(self.cur, self.tot, step))
+        }
+
+        return [(stream_id, *bounds) for stream_id, bounds in self.ranges.items()]
+
+    def download(self, chunk_data: bytes, stream_id: int = 0):
+        if self.is_done() or not chunk_data:
+            return
+
+        stream_id = stream_id or self.stream_id
+        bounds = self.ranges[stream_id]
+        data = chunk_data[: bounds[1] - bounds[0]]
+
+        with open(self.path, "r+b") as f:
             try:
-                f.write(chunk_data)
-                self.cur += len(chunk_data)
+                f.seek(bounds[0])
+                f.write(data)
             except Exception as e:
                 console_log(LogType.ERR, f"An error occurs when downloading file: {e}")
+                return
+
+        self.verify(stream_id, bounds[0], data)
+
+        with self.lock:
+            bounds[0] += len(data)
+            self.cur += len(data)
+
+            if self.is_done() and self.path != self.target:
+                os.replace(self.path, self.target)
+                self.path = self.target
+
+            if self.is_done() and self.basis:
+                os.remove(self.basis)
+                self.basis = None
 
 
 class ServerFileDownloader(FileDownloader):
-    def __init__(self, **kwargs):
+    def __init__(
+        self,
+        *,
+        path: str = None,
+        cache: BlockCache = None,
+        maps: MappedFiles = None,
+        handles: FileHandles = None,
+        read_ahead: int = PREFETCH_CHUNKS,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
 
-        self.path = get_resource_path(kwargs["filename"])
+        self.path = path or get_resource_path(kwargs["filename"])
+
+        # Chunks are sent from this handle at self.cur, with sendfile, through
+        # the shared block cache or as slices of the shared map of the file.
+        # The handle itself may be shared with the other downloads of the file
+        self.cache = cache
+        self.maps = maps
+        self.handles = handles
+        self.mapped: tuple[tuple, memoryview] | None = None
+        self.open(self.path)
+
+        # Chunks read in advance while the current one is sent, up to self.ahead
+        self.read_ahead = read_ahead
+        self.ahead = 0
+
+        # Delta transfer: spans the client copies from its old file, by offset
+        self.copies: dict[int, dict[str, int]] = {}
+
+        # Codec of the cached compressed variant sent instead of the file
+        self.codec: str | None = None
+
+    def open(self, path: str):
+        self.file = self.handles.acquire(path) if self.handles else open(path, "rb")
+        self.ident = self.cache.identity(self.file) if self.cache else None
+        self.mapped = self.maps.acquire(self.file, path) if self.maps else None
+
+    # Opened before the file is let go, the variant may be gone already
+    def use_variant(self, path: str, codec: str):
+        file, mapped = self.file, self.mapped
+        self.open(path)
+        self.release(file, mapped)
+
+        self.path = path
+        self.codec = codec
 
-        # Create a generator to read the file by chunks
-        self.file_gen = self.read_by_chunks_generator()
+        self.cur, self.tot = 0, os.fstat(self.file.fileno()).st_size
+        self.ahead = 0
 
-    def read_by_chunks_generator(self):
-        with open(self.path, "rb") as f:
-            while True:
-                data = f.read(self.chunk_sz)
-                self.cur += len(data)
+    def next_chunk_size(self) -> int:
+        end = next(iter(self.copies), self.tot)
+        return max(0, min(self.chunk_sz, end - self.cur, self.tot - self.cur))
 
-                if not data:
+    def next_copy_frame(self) -> bytes | None:
+        if not (copy := self.copies.pop(self.cur, None)):
+            return None
+
+        self.cur += copy["size"]
+        self.close() if self.is_done() else None
+
+        return encode_frame("copy", copy, self.stream_id)
+
+    def release(self, file, mapped: tuple[tuple, memoryview] | None):
+        if mapped:
+            self.maps.release(*mapped)
+
+        if file is not None:
+            self.handles.release(file) if self.handles else file.close()
+
+    def close(self):
+        self.release(self.file, self.mapped)
+        self.file = self.mapped = None
+
+    # The block cache reads ahead in its threads, otherwise the kernel is
+    # asked to start reading the range into the page cache
+    def prefetch(self, size: int):
+        start = max(self.ahead, self.cur + size)
+        end = self.cur + size + self.chunk_sz * self.read_ahead
+
+        # Not past the file, nor into what the client copies from its own
+        end = min(end, self.tot, next(iter(self.copies), self.tot))
+
+        if start >= end:
+            return
+
+        if self.cache:
+            self.cache.prefetch(self.file, self.ident, start, end - start)
+        elif hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(
+                self.file.fileno(), start, end - start, os.POSIX_FADV_WILLNEED
+            )
+
+        self.ahead = end
+
+    # Reading the map past the end of a truncated file raises SIGBUS, such a
+    # chunk is read from the file instead and found short by check_sent
+    def read_view(self, size: int) -> memoryview | bytes:
+        if os.fstat(self.file.fileno()).st_size < self.cur + size:
+            return self.read_chunk(size)
+
+        return self.mapped[1][self.cur : self.cur + size]
+
+    # The fallbacks of socket.sendfile and loop.sendfile read at the position
+    # of the handle, which is shared with the other downloads of the file
+    def read_chunk(self, size: int) -> bytes:
+        return os.pread(self.file.fileno(), size, self.cur)
+
+    def sendfile(self, conn: socket, size: int) -> int:
+        sent = 0
+
+        try:
+            while sent < size:
+                try:
+                    count = os.sendfile(
+                        conn.fileno(), self.file.fileno(), self.cur + sent, size - sent
+                    )
+                except BlockingIOError:
+                    # Sockets with a timeout are non-blocking underneath
+                    if not wait_ready(conn, EVENT_WRITE, conn.gettimeout()):
+                        raise TimeoutError(f"{self.filename} stalled while sending")
+                    continue
+
+                if not count:
                     break
-                yield data
+                sent += count
+        except TimeoutError:
+            raise
+        except OSError:
+            if sent:
+                raise
+            conn.sendall(data := self.read_chunk(size))
+            return len(data)
+
+        return sent
+
+    def check_sent(self, sent: int, size: int):
+        self.cur += sent
+
+        if sent < size:
+            self.close()
+            raise ProtocolError(f"{self.filename} was truncated while sending")
+
+        self.close() if self.is_done() else None
+
+    def send_chunk(self, conn: socket) -> int:
+        if self.is_done() or self.file is None:
+            return 0
+
+        if frame := self.next_copy_frame():
+            conn.sendall(frame)
+            return len(frame)
+
+        size = self.next_chunk_size()
+        self.prefetch(size)
+        conn.sendall(encode_header("data", size, self.stream_id))
+
+        if self.mapped or self.cache:
+            if self.mapped:
+                data = self.read_view(size)
+            else:
+                data = self.cache.read(self.file, self.ident, self.cur, size)
+
+            conn.sendall(data)
+            self.check_sent(len(data), size)
+        else:
+            self.check_sent(self.sendfile(conn, size), size)
+
+        return size
+
+    # handoff is called once the chunk is in the transport, before waiting
+    # for the client to read it
+    async def async_send_chunk(self, conn: asyncio.StreamWriter, handoff) -> int:
+        if self.is_done() or self.file is None:
+            return 0
+
+        if frame := self.next_copy_frame():
+            conn.write(frame)
+            handoff(len(frame))
+            await conn.drain()
+            return len(frame)
+
+        size = self.next_chunk_size()
+        self.prefetch(size)
+
+        if self.mapped or self.cache:
+            # Cache misses are read in a worker thread, off the event loop
+            if self.mapped:
+                data = self.read_view(size)
+            elif (data := self.cache.peek(self.ident, self.cur, size)) is None:
+                data = await asyncio.to_thread(
+                    self.cache.read, self.file, self.ident, self.cur, size
+                )
+
+            conn.write(encode_header("data", size, self.stream_id))
+            conn.write(data)
+            self.check_sent(len(data), size)
 
-            yield b"eof"
+            handoff(size)
+            await conn.drain()
+
+            return size
+
+        conn.write(encode_header("data", size, self.stream_id))
+        await asyncio.wait_for(conn.drain(), TRANSMIT_TIMEOUT)
+
+        try:
+            # Nothing is buffered, a client that stops reading is dropped
+            sent = await asyncio.wait_for(
+                asyncio.get_running_loop().sendfile(
+                    conn.transport, self.file, self.cur, size, fallback=False
+                ),
+                TRANSMIT_TIMEOUT,
+            )
+        except asyncio.SendfileNotAvailableError:
+            data = await asyncio.to_thread(self.read_chunk, size)
+            conn.write(data)
+            sent = len(data)
+
+        self.check_sent(sent, size)
+
+        handoff(size)
+        await conn.drain()
+
+        return size
 
 
 T = TypeVar("T", ClientFileDownloader, ServerFileDownloader)
@@ -110,6 +475,13 @@ class DownloadManager(Generic[T]):
         filename: str,
         chunk_sz: int,
         tot: int,
+        stream_id: int = 0,
+        weight: int = 1,
+        offset: int = 0,
+        path: str = None,
+        cache: BlockCache = None,
+        maps: MappedFiles = None,
+        handles: FileHandles = None,
         is_overwritten: bool = False,
     ):
         if not is_overwritten and filename in self.exists:
@@ -121,12 +493,22 @@ class DownloadManager(Generic[T]):
                 filename=filename,
                 chunk_sz=chunk_sz,
                 tot=tot,
+                stream_id=stream_id,
+                weight=weight,
+                offset=offset,
             )
         elif isinstance(self, ServerDownloadManager):
             self.download_list[filename] = ServerFileDownloader(
                 filename=filename,
                 chunk_sz=chunk_sz,
                 tot=tot,
+                stream_id=stream_id,
+                weight=weight,
+                offset=offset,
+                path=path,
+                cache=cache,
+                maps=maps,
+                handles=handles,
             )
 
         self.queue[filename] = self.download_list[filename]
@@ -161,8 +543,33 @@ class ClientDownloadManager(DownloadManager[ClientFileDownloader]):
             else None
         )
 
+        self.streams: dict[int, str] = {}
+        self.last_stream_id = 0
+        self.lock = Lock()
+
         self.exists.update(get_downloaded_list())
 
+    def add_download(self, *, filename: str, stream_id: int = 0, **kwargs):
+        super().add_download(filename=filename, stream_id=stream_id, **kwargs)
+
+        if filename in self.download_list and stream_id:
+            self.streams = {k: v for k, v in self.streams.items() if v != filename}
+            self.streams[stream_id] = filename
+
+    def add_stream(self, stream_id: int, filename: str):
+        self.streams[stream_id] = filename
+
+    def new_stream_id(self) -> int:
+        with self.lock:
+            self.last_stream_id += 1
+            return self.last_stream_id
+
+    def get_stream(self, stream_id: int) -> ClientFileDownloader | None:
+        if stream_id not in self.streams:
+            return None
+
+        return self.download_list.get(self.streams[stream_id])
+
     def show_duplicates(self):
         if not self.duplicates or len(self.duplicates) == 0:
             return
@@ -220,27 +627,93 @@ class ClientDownloadManager(DownloadManager[ClientFileDownloader]):
             if not self.is_all_done():
                 stdout.write("\033[F" * (len(self.queue) + 1))
 
-    def download(self, raw_data: tuple[str, bytes]):
+    def download(self, raw_data: tuple[str, bytes], stream_id: int = 0):
         if not raw_data or not len(raw_data):
             return
 
         filename, data = raw_data
         if filename in self.queue and not self.queue[filename].is_done():
-            self.queue[filename].download(data)
+            self.queue[filename].receive(data, stream_id)
 
-        self.render_download_status()
-        self.finish()
+        # Segments of one file arrive on several receiving threads
+        with self.lock:
+            self.render_download_status()
+            self.finish()
+
+    def download_stream(self, stream_id: int, data: bytes):
+        if stream_id in self.streams:
+            self.download((self.streams[stream_id], data), stream_id)
+
+    def copy_stream(self, stream_id: int, copy: dict):
+        if (file := self.get_stream(stream_id)) and file.basis:
+            file.copy_blocks(stream_id, copy)
+
+        with self.lock:
+            self.render_download_status()
+            self.finish()
 
 
 class ServerDownloadManager(DownloadManager[ServerFileDownloader]):
-    def __init__(self, **kwargs):
+    def __init__(
+        self,
+        *,
+        cache: BlockCache = None,
+        maps: MappedFiles = None,
+        handles: FileHandles = None,
+        **kwargs,
+    ):
+        self.scheduler: WeightedScheduler[str] = WeightedScheduler()
+        self.cache = cache
+        self.maps = maps
+        self.handles = handles
+
         super().__init__(**kwargs)
 
-    def download(self, filename: str):
-        data = None
+    def add_download(self, *, filename: str, weight: int = 1, **kwargs):
+        if filename in self.download_list:
+            self.download_list[filename].close()
+
+        super().add_download(
+            filename=filename,
+            weight=weight,
+            cache=self.cache,
+            maps=self.maps,
+            handles=self.handles,
+            **kwargs,
+        )
+
+        if filename in self.queue:
+            self.scheduler.add(filename, weight)
+
+    def close(self):
+        for file_downloader in self.download_list.values():
+            file_downloader.close()
+
+    def next_download(self) -> ServerFileDownloader | None:
+        while (filename := self.scheduler.next()) is not None:
+            if filename in self.queue and not self.queue[filename].is_done():
+                return self.queue[filename]
+
+            self.scheduler.remove(filename)
+
+        return None
+
+    def download(self, filename: str, conn: socket):
+        sent = 0
+        if filename in self.queue and not self.queue[filename].is_done():
+            sent = self.queue[filename].send_chunk(conn)
+            self.scheduler.charge(filename, sent)
+
+        self.finish()
+
+        return sent
+
+    async def async_download(self, filename: str, conn: asyncio.StreamWriter, handoff):
+        sent = 0
         if filename in self.queue and not self.queue[filename].is_done():
-            data = next(self.queue[filename].file_gen)
+            sent = await self.queue[filename].async_send_chunk(conn, handoff)
+            self.scheduler.charge(filename, sent)
 
         self.finish()
 
-        return data
+        return sent
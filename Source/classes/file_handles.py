@@ -0,0 +1,103 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from shared.envs import FILE_HANDLE_BUDGET
+from utils.files import get_file_identity, get_stat_identity
+
+
+class FileHandle:
+    def __init__(self, file, path: str):
+        self.file = file
+        self.path = path
+        self.ident = get_file_identity(file)
+        self.refs = 0
+        self.stale = False
+
+
+# One open handle per resource, shared by every download of it. Readers only
+# use explicit offsets (pread, sendfile, mmap), never the file position.
+# Unused handles stay open for the next download and the least recently used
+# ones are closed past the budget. The budget is soft: handles in use are never
+# closed, a burst of distinct files may go over it for a while
+class FileHandles:
+    def __init__(self, *, budget: int = FILE_HANDLE_BUDGET):
+        self.budget = budget
+
+        self.lock = Lock()
+        self.handles: OrderedDict[str, FileHandle] = OrderedDict()
+        # Every open handle by its file, replaced ones included until released
+        self.files: dict[int, FileHandle] = {}
+        self.counters = {"opens": 0, "reuses": 0, "closes": 0}
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "open": len(self.files),
+                "in_use": sum(1 for h in self.files.values() if h.refs),
+            }
+
+    def close_handle(self, handle: FileHandle):
+        handle.file.close()
+
+        del self.files[id(handle.file)]
+        self.counters["closes"] += 1
+
+    def retire(self, path: str):
+        if (handle := self.handles.pop(path, None)) is None:
+            return
+
+        handle.stale = True
+        if not handle.refs:
+            self.close_handle(handle)
+
+    def trim(self):
+        for path, handle in list(self.handles.items()):
+            if len(self.files) <= self.budget:
+                break
+            if not handle.refs:
+                self.retire(path)
+
+    def acquire(self, path: str):
+        ident = get_stat_identity(os.stat(path))
+
+        with self.lock:
+            # Replaced or rewritten since, new downloads get a new handle
+            if (handle := self.handles.get(path)) and handle.ident != ident:
+                self.retire(path)
+                handle = None
+
+            if handle:
+                self.counters["reuses"] += 1
+            else:
+                handle = self.handles[path] = FileHandle(open(path, "rb"), path)
+                self.files[id(handle.file)] = handle
+                self.counters["opens"] += 1
+
+            handle.refs += 1
+            self.handles.move_to_end(path)
+            self.trim()
+
+            return handle.file
+
+    def release(self, file):
+        with self.lock:
+            if (handle := self.files.get(id(file))) is None:
+                return
+
+            handle.refs -= 1
+            if handle.stale and not handle.refs:
+                self.close_handle(handle)
+
+            self.trim()
+
+    # The file changed on disk, its handle goes once the last download is done
+    def invalidate(self, path: str):
+        with self.lock:
+            self.retire(path)
+
+    def close(self):
+        with self.lock:
+            for path in list(self.handles):
+                self.retire(path)
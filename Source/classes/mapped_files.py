@@ -0,0 +1,111 @@
+import mmap
+from time import monotonic
+from threading import Thread, Event, Lock
+
+from shared.envs import MMAP_IDLE_TIMEOUT
+from utils.files import get_file_identity
+
+
+class MappedFile:
+    def __init__(self, map: mmap.mmap, path: str):
+        self.map = map
+        self.path = path
+        self.refs = 0
+        self.used = monotonic()
+        self.stale = False
+
+
+# Resources mapped once and shared by every connection sending them. Senders
+# get memoryview slices of the map, no buffer is allocated per chunk. A map is
+# closed once nobody holds it and it was idle or its file changed, idle maps
+# are also swept in the background when no connection comes by
+class MappedFiles:
+    def __init__(self, *, idle: float = MMAP_IDLE_TIMEOUT):
+        self.idle = idle
+
+        self.lock = Lock()
+        self.files: dict[tuple, MappedFile] = {}
+        self.counters = {"maps": 0, "reuses": 0, "unmaps": 0}
+
+        self.closed = Event()
+        self.sweeper = Thread(target=self.sweep_periodically, daemon=True)
+        self.sweeper.start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "mapped": len(self.files),
+                "size": sum(len(f.map) for f in self.files.values()),
+            }
+
+    def unmap(self, ident: tuple):
+        # A slice may still sit in a transport buffer, retried on the next sweep
+        try:
+            self.files[ident].map.close()
+        except BufferError:
+            return
+
+        del self.files[ident]
+        self.counters["unmaps"] += 1
+
+    def sweep(self):
+        now = monotonic()
+
+        for ident, file in list(self.files.items()):
+            if not file.refs and (file.stale or now - file.used > self.idle):
+                self.unmap(ident)
+
+    def sweep_periodically(self):
+        while not self.closed.wait(max(self.idle / 2, 0.01)):
+            with self.lock:
+                self.sweep()
+
+    # Returns the identity to release with and a view of the whole file,
+    # or None for files that cannot be mapped (empty ones)
+    def acquire(self, file, path: str) -> tuple[tuple, memoryview] | None:
+        ident = get_file_identity(file)
+
+        with self.lock:
+            self.sweep()
+
+            if mapped := self.files.get(ident):
+                self.counters["reuses"] += 1
+            else:
+                try:
+                    map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    return None
+
+                mapped = self.files[ident] = MappedFile(map, path)
+                self.counters["maps"] += 1
+
+            mapped.refs += 1
+            return ident, memoryview(mapped.map)
+
+    def release(self, ident: tuple, view: memoryview):
+        view.release()
+
+        with self.lock:
+            if mapped := self.files.get(ident):
+                mapped.refs -= 1
+                mapped.used = monotonic()
+
+            self.sweep()
+
+    # The file changed on disk, its map goes as soon as the last sender is done
+    def invalidate(self, path: str):
+        with self.lock:
+            for mapped in self.files.values():
+                mapped.stale = mapped.stale or mapped.path == path
+
+            self.sweep()
+
+    def close(self):
+        self.closed.set()
+
+        with self.lock:
+            for mapped in self.files.values():
+                mapped.stale = True
+
+            self.sweep()
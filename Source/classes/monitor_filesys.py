@@ -1,20 +1,95 @@
+import os
+from time import monotonic
+from threading import Event, Lock, Thread
 from watchdog.events import FileSystemEventHandler
 
+from shared.envs import WATCH_DEBOUNCE
+
+
+# Coalesces watcher events per path: a path is published once it has been quiet
+# for `window` seconds and its size did not change since the previous check, so
+# a file being written produces one change instead of thousands
+class EventDebouncer:
+    def __init__(self, publish, *, window: float = WATCH_DEBOUNCE):
+        self.publish = publish
+        self.window = window
+
+        self.lock = Lock()
+        self.pending: dict[str, list] = {}
+
+        self.stopped = Event()
+        self.flusher = Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    def push(self, event_type: str, path: str):
+        with self.lock:
+            entry = self.pending.get(path)
+
+            # A file created in this window is still new to the updater
+            if entry and entry[0] == "created" and event_type == "modified":
+                event_type = "created"
+
+            self.pending[path] = [event_type, monotonic(), entry[2] if entry else None]
+
+    def get_size(self, path: str) -> int | None:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def collect(self, force: bool = False) -> list[tuple[str, str]]:
+        changes, now = [], monotonic()
+
+        with self.lock:
+            for path, entry in list(self.pending.items()):
+                if not force and now - entry[1] < self.window:
+                    continue
+
+                if not force and entry[0] != "deleted":
+                    size = self.get_size(path)
+
+                    if size is not None and size != entry[2]:
+                        entry[1:] = [now, size]
+                        continue
+
+                changes.append((entry[0], path))
+                del self.pending[path]
+
+        return changes
+
+    def run(self):
+        while not self.stopped.wait(self.window / 2):
+            if changes := self.collect():
+                self.publish(changes=changes)
+
+    def stop(self):
+        self.stopped.set()
+        self.flusher.join()
+
+        if changes := self.collect(force=True):
+            self.publish(changes=changes)
+
 
 class MonitorFileSystemHandler(FileSystemEventHandler):
-    def __init__(self, updater) -> None:
+    def __init__(self, updater, *, window: float = WATCH_DEBOUNCE) -> None:
         super().__init__()
 
-        self.updater = updater
+        self.debouncer = EventDebouncer(updater, window=window)
 
     def on_modified(self, event):
-        self.updater(path=event.src_path, event_type="modified")
+        # Directory mtimes change with every entry, the entry has its own event
+        if not event.is_directory:
+            self.debouncer.push("modified", event.src_path)
 
     def on_created(self, event):
-        self.updater(path=event.src_path, event_type="created")
+        self.debouncer.push("created", event.src_path)
 
     def on_deleted(self, event):
-        self.updater(path=event.src_path, event_type="deleted")
+        self.debouncer.push("deleted", event.src_path)
 
     def on_moved(self, event):
-        self.updater(path=event.src_path, event_type="moved")
+        self.debouncer.push("deleted", event.src_path)
+        self.debouncer.push("created", event.dest_path)
+
+    def stop(self):
+        self.debouncer.stop()
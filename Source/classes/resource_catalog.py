@@ -0,0 +1,420 @@
+import os, json
+from time import sleep
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from stat import S_ISREG
+from threading import Thread, Event, Lock
+
+from shared.envs import SERVER_DIR_PATH, SERVER_RESOURCES_PATH
+from shared.protocol import encode_payload
+
+# Sort keys of a LIST page, the name last so every key is unique
+LIST_SORT_KEYS = {
+    "name": lambda name, entry: (name,),
+    "size": lambda name, entry: (entry[0], name),
+}
+
+
+# In-memory view of the resources folder, kept up to date one watchdog event
+# at a time. The JSON snapshot is written in the background, batched. Every
+# change bumps the version, which invalidates the pre-encoded listing and its ETag
+class ResourceCatalog:
+    # Whether reconcile descends into subfolders
+    recursive = False
+    # Whether followers read the same store instead of a copy, see load_snapshot
+    shared = False
+
+    def __init__(
+        self,
+        *,
+        root: str = SERVER_RESOURCES_PATH,
+        path: str = os.path.join(SERVER_DIR_PATH, "resources.json"),
+        interval: float = 0.5,
+    ):
+        self.root = root
+        self.path = path
+        self.interval = interval
+
+        self.lock = Lock()
+        self.entries: dict[str, tuple[int, str]] = {}
+
+        # mtime of every listed folder, by name, "" being the root
+        self.dirs: dict[str, int] = {}
+
+        self.version = 0
+        # Versions restart with the process, ETags carry the instance they are from
+        self.epoch = os.urandom(8).hex()
+        self.encoded: tuple[tuple, bytes, str] | None = None
+        self.encode_lock = Lock()
+        self.orders: dict[str, tuple[int, list[tuple]]] = {}
+
+        # Called with every batch of changes, see apply_changes. Batches are
+        # applied and published one at a time, so deltas never overlap
+        self.listeners: list = []
+        self.change_lock = Lock()
+
+        # Without a path nothing is persisted, see load_snapshot
+        self.closed = False
+        self.dirty = Event()
+        self.writer = Thread(target=self.persist, daemon=True) if path else None
+        if self.writer:
+            self.writer.start()
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, filename: str) -> tuple[int, str] | None:
+        return self.entries.get(filename)
+
+    def data(self) -> dict[str, tuple[int, str]]:
+        with self.lock:
+            return self.entries.copy()
+
+    # Every entry, for the passes over the whole catalog. The SQLite catalog
+    # reads them a batch at a time instead of all at once
+    def iter_entries(self, batch_size: int = 1000):
+        with self.lock:
+            entries = list(self.entries.items())
+
+        yield from entries
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.root, *name.split("/")) if name else self.root
+
+    def get_name(self, path: str) -> str | None:
+        name = os.path.relpath(path, self.root)
+
+        # Like the old listing, only the top level of the folder is served
+        return None if name.startswith("..") or os.sep in name or name == "." else name
+
+    def stat_entry(self, name: str) -> tuple[int, str] | None:
+        path = self.get_path(name)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return (stat.st_size, path) if S_ISREG(stat.st_mode) else None
+
+    def scan(self):
+        os.makedirs(self.root, exist_ok=True)
+
+        # Taken before listing, a change in between shows up on the next start
+        mtime = os.stat(self.root).st_mtime_ns
+
+        with os.scandir(self.root) as it:
+            entries = {
+                entry.name: (entry.stat().st_size, os.path.join(self.root, entry.name))
+                for entry in it
+                if entry.is_file()
+            }
+
+        with self.lock:
+            self.entries = entries
+            self.dirs = {"": mtime}
+            self.version += 1
+        self.dirty.set()
+
+    # Loads the last snapshot so the server can list right away, returns
+    # whether there was one. reconcile then catches up with the disk
+    def load(self) -> bool:
+        try:
+            with open(self.path, "r") as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return False
+
+        # Snapshots without folder mtimes get every folder listed again
+        files, dirs = (data["files"], data["dirs"]) if "files" in data else (data, {})
+
+        with self.lock:
+            self.entries = {name: tuple(entry) for name, entry in files.items()}
+            self.dirs = dirs
+            self.version += 1
+
+        return True
+
+    # Mirrors of another process's catalog, fed with its snapshot in batches
+    # then its deltas. The version is taken before the entries, which may only
+    # be newer than it
+    def load_snapshot(
+        self, version: int, entries: dict[str, tuple[int, str]], epoch: str = None
+    ):
+        with self.lock:
+            self.entries.update((name, tuple(entry)) for name, entry in entries.items())
+            self.version = version
+            # Same ETags as the other processes following the same catalog
+            self.epoch = epoch or self.epoch
+
+    # Makes the changes so far visible to the followers of a shared store
+    def flush(self):
+        pass
+
+    def apply_delta(self, delta: dict):
+        with self.lock:
+            # Already part of the snapshot
+            if delta["version"] <= self.version:
+                return
+
+            for name, entry in [*delta["added"].items(), *delta["changed"].items()]:
+                self.entries[name] = tuple(entry)
+            for name in delta["removed"]:
+                self.entries.pop(name, None)
+
+            self.version = delta["version"]
+
+        for listener in self.listeners:
+            listener(delta)
+
+    def get_dir_mtime(self, folder: str) -> int | None:
+        return self.dirs.get(folder)
+
+    def get_subdirs(self, folder: str) -> list[str]:
+        return []
+
+    # Sizes of the files right inside the folder
+    def list_folder(self, folder: str) -> dict[str, int]:
+        return {name: entry[0] for name, entry in self.data().items()}
+
+    def record_dirs(self, dirs: list[tuple[str, str | None, int]], removed: list[str]):
+        with self.lock:
+            for name in removed:
+                self.dirs.pop(name, None)
+            for name, _, mtime in dirs:
+                self.dirs[name] = mtime
+        self.dirty.set()
+
+    # Compares the snapshot with the disk and applies the difference as one
+    # batch of changes. Only folders whose mtime moved are listed again and
+    # their files stat'ed, the others are trusted as they are
+    def reconcile(self, batch_size: int = 1000):
+        changes, dirs, removed = [], [], []
+        folders = [""]
+
+        while folders:
+            folder = folders.pop()
+            path = self.get_path(folder)
+
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            if self.get_dir_mtime(folder) == mtime:
+                folders.extend(self.get_subdirs(folder))
+                continue
+
+            known = self.list_folder(folder)
+            subdirs = set(self.get_subdirs(folder))
+            start = len(changes)
+
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        name = f"{folder}/{entry.name}" if folder else entry.name
+
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                subdirs.discard(name)
+                                folders.append(name)
+                        elif entry.is_file():
+                            size = known.pop(name, None)
+
+                            if size is None:
+                                changes.append(("created", entry.path))
+                            elif size != entry.stat().st_size:
+                                changes.append(("modified", entry.path))
+            except OSError:
+                continue
+
+            # Deletions first, a file may have been replaced by a folder
+            changes[start:start] = [
+                ("deleted", self.get_path(name)) for name in [*known, *subdirs]
+            ]
+
+            parent = folder.rpartition("/")[0] if folder else None
+            dirs.append((folder, parent, mtime))
+            removed.extend(subdirs)
+
+        for i in range(0, len(changes), batch_size):
+            self.apply_changes(changes[i : i + batch_size])
+
+        # Recorded last, an interrupted pass is simply done again
+        self.record_dirs(dirs, removed)
+
+        return len(changes)
+
+    # Returns the entries the event touched, as they were before it
+    def apply(
+        self, event_type: str, src_path: str, dest_path: str = None
+    ) -> dict[str, tuple[int, str] | None]:
+        src = self.get_name(src_path)
+        dest = self.get_name(dest_path) if event_type == "moved" and dest_path else src
+
+        if not src and not dest:
+            return {}
+
+        with self.lock:
+            touched = {name: self.entries.get(name) for name in [src, dest] if name}
+
+            # Contents may change without the size, the listing is rebuilt anyway
+            self.version += 1
+
+            if event_type in ["deleted", "moved"] and src:
+                self.entries.pop(src, None)
+
+            if event_type != "deleted" and dest:
+                if entry := self.stat_entry(dest):
+                    self.entries[dest] = entry
+                else:
+                    self.entries.pop(dest, None)
+
+        self.dirty.set()
+        return touched
+
+    def apply_changes(self, changes: list[tuple[str, str]]):
+        with self.change_lock:
+            base, before = self.version, {}
+
+            for event_type, path in changes:
+                for name, entry in self.apply(event_type, path).items():
+                    before.setdefault(name, entry)
+
+            delta = {
+                "base": base,
+                "version": self.version,
+                "added": {},
+                "changed": {},
+                "removed": [],
+            }
+
+            for name, entry in before.items():
+                after = self.get(name)
+
+                if after is None and entry:
+                    delta["removed"].append(name)
+                elif after and entry is None:
+                    delta["added"][name] = after
+                elif after:
+                    delta["changed"][name] = after
+
+            if delta["added"] or delta["changed"] or delta["removed"]:
+                for listener in self.listeners:
+                    listener(delta)
+
+    # Tags the listing at this version without building it, the stamp being
+    # anything else the listing depends on (the digests)
+    def etag(self, stamp: int = 0, version: int = None) -> str:
+        return f"{self.epoch}-{self.version if version is None else version}-{stamp}"
+
+    def encode(self, build, stamp: int = 0) -> tuple[bytes, str]:
+        with self.encode_lock:
+            key = (self.version, stamp)
+
+            if not self.encoded or self.encoded[0] != key:
+                self.encoded = key, encode_payload(build()), self.etag(*key[::-1])
+
+            return self.encoded[1:]
+
+    def get_order(self, sort: str) -> list[tuple]:
+        if sort not in LIST_SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+
+        with self.lock:
+            version = self.version
+            if (cached := self.orders.get(sort)) and cached[0] == version:
+                return cached[1]
+
+            items = list(self.entries.items())
+
+        order = sorted(LIST_SORT_KEYS[sort](name, entry) for name, entry in items)
+        self.orders[sort] = version, order
+
+        return order
+
+    # Keyset pagination: the cursor is the sort key of the last entry sent, so
+    # pages stay consistent while the catalog changes in between
+    def page(
+        self,
+        *,
+        limit: int,
+        cursor: list = None,
+        match: str = None,
+        prefix: str = None,
+        sort: str = "name",
+    ) -> tuple[list[tuple[str, int, str]], list | None]:
+        desc = sort.startswith("-")
+        sort = sort.lstrip("-")
+        order = self.get_order(sort)
+
+        if cursor is None:
+            start = len(order) if desc else 0
+        elif desc:
+            start = bisect_left(order, tuple(cursor))
+        else:
+            start = bisect_right(order, tuple(cursor))
+
+        if prefix and sort == "name" and not desc:
+            start = max(start, bisect_left(order, (prefix,)))
+
+        files, last = [], None
+
+        for i in range(start - 1, -1, -1) if desc else range(start, len(order)):
+            name = order[i][-1]
+
+            if prefix and not name.startswith(prefix):
+                if sort == "name" and not desc and name > prefix:
+                    break
+                continue
+            if match and not fnmatchcase(name, match):
+                continue
+            if (entry := self.entries.get(name)) is None:
+                continue
+
+            # One more match exists, the client has to ask for the next page
+            if len(files) == limit:
+                return files, list(last)
+
+            files.append((name, *entry))
+            last = order[i]
+
+        return files, None
+
+    # Hooks for indexes that keep more than size and path
+    def record_digest(self, filename: str, digest: str):
+        pass
+
+    def record_hit(self, filename: str):
+        pass
+
+    def save(self):
+        with self.lock:
+            data = {"dirs": self.dirs.copy(), "files": self.entries.copy()}
+
+        with open(f"{self.path}.tmp", "w") as f:
+            f.write(json.dumps(data, separators=(",", ":")))
+
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def persist(self):
+        while not self.closed:
+            self.dirty.wait()
+
+            # Let a burst of events settle into one write
+            sleep(self.interval)
+            self.dirty.clear()
+
+            try:
+                self.save()
+            except OSError:
+                pass
+
+    def close(self):
+        self.closed = True
+        self.dirty.set()
+        if self.writer:
+            self.writer.join(timeout=self.interval * 4)
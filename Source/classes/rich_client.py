@@ -52,7 +52,10 @@ class RichClient:
     def convert_to_row(self, files: list[tuple[str, int]]):
         return [[file, str(size), convert_file_size(size)] for file, size in files]
 
-    def render_file_list(self, files: list[tuple[str, int]]):
+    def render_file_list(self, files: list[tuple[str, int]], append: bool = False):
         __files = self.convert_to_row(files)
-        self.rich_table.overwrite_rows(__files)
+        if append:
+            self.rich_table.append_rows(__files)
+        else:
+            self.rich_table.overwrite_rows(__files)
         self.rich_table.update_layout()
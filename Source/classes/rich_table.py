@@ -48,6 +48,11 @@ class RichTable:
         self.table_rows = rows
         self.create_table()
 
+    def append_rows(self, rows: list[list[str]] = []):
+        self.table_rows = self.table_rows + rows
+        for row in rows:
+            self.add_new_row(row)
+
     def add_new_row(self, row: list[str] = []):
         self.table.add_row(*row)
 
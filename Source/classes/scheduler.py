@@ -0,0 +1,162 @@
+import asyncio
+from threading import Condition
+from typing import TypeVar, Generic, Hashable
+
+from shared.envs import TRANSMIT_SLOTS
+
+K = TypeVar("K", bound=Hashable)
+
+
+# Start-time fair queueing: every key gets a share of the sent bytes
+# proportional to its weight, new keys start at the current virtual time
+class WeightedScheduler(Generic[K]):
+    def __init__(self):
+        self.vtime = 0.0
+        self.tags: dict[K, float] = {}
+        self.weights: dict[K, float] = {}
+        self.parked: dict[K, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.tags
+
+    def add(self, key: K, weight: float = 1):
+        tag = self.tags.get(key, self.parked.pop(key, self.vtime))
+
+        self.tags[key] = max(self.vtime, tag)
+        self.weights[key] = weight if weight > 0 else 1
+
+    def park(self, key: K):
+        if key in self.tags:
+            self.parked[key] = self.tags.pop(key)
+
+    def remove(self, key: K):
+        self.tags.pop(key, None)
+        self.parked.pop(key, None)
+        self.weights.pop(key, None)
+
+    def next(self) -> K | None:
+        if not self.tags:
+            return None
+
+        key = min(self.tags, key=self.tags.__getitem__)
+        self.vtime = self.tags[key]
+
+        return key
+
+    def charge(self, key: K, size: int):
+        if key in self.tags:
+            self.tags[key] += size / self.weights[key]
+
+
+# Arbitrates socket writes between all connections: at most `slots` chunks are
+# in flight, waiting connections are granted in weighted fair order. A flow
+# that still has data requeues on release so it competes with the waiters
+class TransmitScheduler(Generic[K]):
+    def __init__(self, *, slots: int = TRANSMIT_SLOTS):
+        self.slots = max(1, slots)
+        self.busy = 0
+
+        self.queue: WeightedScheduler[K] = WeightedScheduler()
+        self.requests: dict[K, int] = {}
+        self.granted: set[K] = set()
+
+        self.served: dict[K, int] = {}
+        self.served_by_prior: dict[float, int] = {}
+
+        self.condition = Condition()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queue_depth": len(self.queue),
+                "in_flight": self.busy,
+                "served": self.served.copy(),
+                "served_by_prior": self.served_by_prior.copy(),
+            }
+
+    def dispatch(self):
+        while self.busy < self.slots and (key := self.queue.next()) is not None:
+            self.queue.charge(key, self.requests.pop(key))
+            self.queue.park(key)
+
+            self.granted.add(key)
+            self.busy += 1
+
+        self.notify()
+
+    def notify(self):
+        self.condition.notify_all()
+
+    def request(self, key: K, size: int, share: float):
+        if key not in self.granted:
+            self.requests[key] = size
+            self.queue.add(key, share)
+            self.dispatch()
+
+    def acquire(self, key: K, size: int, share: float = 1):
+        with self.condition:
+            self.request(key, size, share)
+
+            self.condition.wait_for(lambda: key in self.granted)
+            self.granted.discard(key)
+
+    def release(self, key: K, sent: int, prior: float = 1, pending: int = 0):
+        with self.condition:
+            self.busy -= 1
+
+            self.served[key] = self.served.get(key, 0) + sent
+            self.served_by_prior[prior] = self.served_by_prior.get(prior, 0) + sent
+
+            if pending:
+                self.request(key, pending, self.queue.weights.get(key, 1))
+            else:
+                self.dispatch()
+
+    def cancel(self, key: K):
+        with self.condition:
+            if key in self.granted:
+                self.granted.discard(key)
+                self.busy -= 1
+            elif self.requests.pop(key, None) is not None:
+                self.queue.park(key)
+
+            self.dispatch()
+
+    def remove(self, key: K) -> int:
+        self.cancel(key)
+
+        with self.condition:
+            self.queue.remove(key)
+
+            return self.served.pop(key, 0)
+
+
+class AsyncTransmitScheduler(TransmitScheduler[K]):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.waiters: dict[K, asyncio.Future] = {}
+
+    def notify(self):
+        for key in self.granted:
+            if (waiter := self.waiters.pop(key, None)) and not waiter.done():
+                waiter.set_result(None)
+
+    async def acquire(self, key: K, size: int, share: float = 1):
+        if key not in self.granted:
+            waiter = self.waiters[key] = asyncio.get_running_loop().create_future()
+
+            with self.condition:
+                self.request(key, size, share)
+
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self.waiters.pop(key, None)
+                self.cancel(key)
+                raise
+
+        self.granted.discard(key)
@@ -0,0 +1,370 @@
+import os, sqlite3
+from itertools import islice
+
+from shared.envs import SERVER_RESOURCES_PATH, SERVER_INDEX_PATH
+from .resource_catalog import ResourceCatalog, LIST_SORT_KEYS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    digest TEXT,
+    popularity INTEGER NOT NULL DEFAULT 0,
+    seen INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS resources_by_size ON resources (size, name);
+CREATE TABLE IF NOT EXISTS dirs (
+    name TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_by_parent ON dirs (parent);
+"""
+
+# Keeps the digest and popularity of a file that did not change
+UPSERT = """
+INSERT INTO resources (name, size, mtime, seen) VALUES (?, ?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET
+    digest = CASE WHEN size = excluded.size AND mtime = excluded.mtime
+        THEN digest END,
+    size = excluded.size,
+    mtime = excluded.mtime,
+    seen = excluded.seen
+"""
+
+# "a" and everything below "a/": "0" is the character after "/"
+SUBTREE = "name = ? OR (name >= ? AND name < ?)"
+
+
+# Resource catalog kept in SQLite instead of memory: the whole tree under the
+# root is indexed, names are relative paths joined by "/". Lookups and LIST
+# pages are indexed queries, so memory stays flat with millions of files.
+# Pre-fork workers open the supervisor's database read-only, see flush
+class SQLiteResourceCatalog(ResourceCatalog):
+    recursive = True
+    shared = True
+
+    def __init__(
+        self,
+        *,
+        root: str = SERVER_RESOURCES_PATH,
+        path: str = SERVER_INDEX_PATH,
+        interval: float = 0.5,
+        batch_size: int = 1000,
+        readonly: bool = False,
+    ):
+        self.readonly = readonly
+
+        if readonly:
+            self.db = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+            self.db.executescript(SCHEMA)
+
+        self.batch_size = batch_size
+
+        # Scan generation, rows a scan did not see again are gone
+        self.seen = self.db.execute("SELECT MAX(seen) FROM resources").fetchone()[0]
+        self.seen = self.seen or 0
+
+        # Nothing to write back when read-only
+        super().__init__(root=root, path=None if readonly else path, interval=interval)
+
+    def __contains__(self, filename: str) -> bool:
+        return self.get(filename) is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM resources").fetchone()[0]
+
+    def get(self, filename: str) -> tuple[int, str] | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size FROM resources WHERE name = ?", (filename,)
+            ).fetchone()
+
+        return (row[0], self.get_path(filename)) if row else None
+
+    def data(self) -> dict[str, tuple[int, str]]:
+        with self.lock:
+            rows = self.db.execute("SELECT name, size FROM resources").fetchall()
+
+        return {name: (size, self.get_path(name)) for name, size in rows}
+
+    def iter_entries(self, batch_size: int = None):
+        batch_size, last = batch_size or self.batch_size, ""
+
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT name, size FROM resources WHERE name > ? "
+                    "ORDER BY name LIMIT ?",
+                    (last, batch_size),
+                ).fetchall()
+
+            for name, size in rows:
+                yield name, (size, self.get_path(name))
+
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def get_name(self, path: str) -> str | None:
+        name = os.path.relpath(path, self.root)
+
+        if name == "." or name == ".." or name.startswith(".." + os.sep):
+            return None
+        return name.replace(os.sep, "/")
+
+    def walk(self, name: str = "", found: list = None):
+        dirs = [name]
+
+        while dirs:
+            current = dirs.pop()
+            path = self.get_path(current)
+
+            try:
+                if found is not None:
+                    parent = current.rpartition("/")[0] if current else None
+                    found.append((current, parent, os.stat(path).st_mtime_ns))
+
+                with os.scandir(path) as it:
+                    for entry in it:
+                        child = f"{current}/{entry.name}" if current else entry.name
+
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(child)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            yield child, stat.st_size, stat.st_mtime_ns
+            except OSError:
+                continue
+
+    def upsert(self, rows, seen: int):
+        self.db.executemany(UPSERT, ((*row, seen) for row in rows))
+
+    def select_tree(self, name: str) -> dict[str, tuple[int, str]]:
+        rows = self.db.execute(
+            f"SELECT name, size FROM resources WHERE {SUBTREE}",
+            (name, f"{name}/", f"{name}0"),
+        ).fetchall()
+
+        return {child: (size, self.get_path(child)) for child, size in rows}
+
+    def scan(self):
+        os.makedirs(self.root, exist_ok=True)
+
+        seen, found = self.seen + 1, []
+
+        # Batches let lookups through while a big tree is indexed
+        files = self.walk(found=found)
+        while batch := list(islice(files, self.batch_size)):
+            with self.lock:
+                self.upsert(batch, seen)
+
+        with self.lock:
+            self.db.execute("DELETE FROM resources WHERE seen != ?", (seen,))
+            self.db.execute("DELETE FROM dirs")
+            self.db.executemany("INSERT INTO dirs VALUES (?, ?, ?)", found)
+            self.db.commit()
+            self.seen = seen
+            self.version += 1
+
+    # The database is the snapshot
+    def load(self) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM dirs LIMIT 1").fetchone() is not None
+
+    def get_dir_mtime(self, folder: str) -> int | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT mtime FROM dirs WHERE name = ?", (folder,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def get_subdirs(self, folder: str) -> list[str]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name FROM dirs WHERE parent = ?", (folder,)
+            ).fetchall()
+
+        return [name for name, in rows]
+
+    def list_folder(self, folder: str) -> dict[str, int]:
+        start = f"{folder}/" if folder else ""
+
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, size FROM resources WHERE name >= ? AND name < ?",
+                (start, f"{folder}0" if folder else chr(0x10FFFF)),
+            ).fetchall()
+
+        return {name: size for name, size in rows if "/" not in name[len(start) :]}
+
+    def record_dirs(self, dirs: list[tuple[str, str | None, int]], removed: list[str]):
+        with self.lock:
+            for name in removed:
+                self.db.execute(
+                    f"DELETE FROM dirs WHERE {SUBTREE}",
+                    (name, f"{name}/", f"{name}0"),
+                )
+            self.db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", dirs)
+        self.dirty.set()
+
+    def reconcile(self, batch_size: int = None):
+        return super().reconcile(batch_size or self.batch_size)
+
+    def apply(
+        self, event_type: str, src_path: str, dest_path: str = None
+    ) -> dict[str, tuple[int, str] | None]:
+        src = self.get_name(src_path)
+        dest = self.get_name(dest_path) if event_type == "moved" and dest_path else src
+
+        if not src and not dest:
+            return {}
+
+        with self.lock:
+            touched = {}
+            self.version += 1
+
+            # A folder takes everything below it along
+            if event_type in ["deleted", "moved"] and src:
+                touched.update(self.select_tree(src))
+                self.db.execute(
+                    f"DELETE FROM resources WHERE {SUBTREE}",
+                    (src, f"{src}/", f"{src}0"),
+                )
+
+            if event_type != "deleted" and dest:
+                path = self.get_path(dest)
+                before = self.select_tree(dest)
+
+                if os.path.isdir(path):
+                    rows = list(self.walk(dest))
+                elif os.path.isfile(path):
+                    stat = os.stat(path)
+                    rows = [(dest, stat.st_size, stat.st_mtime_ns)]
+                else:
+                    rows = []
+                    self.db.execute("DELETE FROM resources WHERE name = ?", (dest,))
+                    touched.setdefault(dest, before.get(dest))
+
+                for name, *_ in rows:
+                    touched.setdefault(name, before.get(name))
+                self.upsert(rows, self.seen)
+
+        self.dirty.set()
+        return touched
+
+    def page(
+        self,
+        *,
+        limit: int,
+        cursor: list = None,
+        match: str = None,
+        prefix: str = None,
+        sort: str = "name",
+    ) -> tuple[list[tuple[str, int, str]], list | None]:
+        desc = sort.startswith("-")
+        sort = sort.lstrip("-")
+
+        if sort not in LIST_SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+
+        keys = ["name"] if sort == "name" else ["size", "name"]
+        where, params = [], []
+
+        if cursor is not None:
+            if len(cursor) != len(keys):
+                raise ValueError(f"Invalid cursor: {cursor}")
+
+            where.append(
+                f"({', '.join(keys)}) {'<' if desc else '>'} "
+                f"({', '.join('?' * len(keys))})"
+            )
+            params.extend(cursor)
+        if prefix:
+            where.append("name >= ? AND name < ?")
+            params.extend([prefix, prefix + chr(0x10FFFF)])
+        if match:
+            where.append("name GLOB ?")
+            params.append(match)
+
+        query = (
+            "SELECT name, size FROM resources"
+            + (f" WHERE {' AND '.join(where)}" if where else "")
+            + f" ORDER BY {', '.join(f'{k} DESC' if desc else k for k in keys)}"
+            + " LIMIT ?"
+        )
+
+        with self.lock:
+            rows = self.db.execute(query, (*params, limit + 1)).fetchall()
+
+        files = [(name, size, self.get_path(name)) for name, size in rows[:limit]]
+        if len(rows) <= limit:
+            return files, None
+
+        name, size, _ = files[-1]
+        return files, list(LIST_SORT_KEYS[sort](name, (size,)))
+
+    # The rows are the supervisor's, only the version follows it
+    def load_snapshot(
+        self, version: int, entries: dict[str, tuple[int, str]], epoch: str = None
+    ):
+        with self.lock:
+            self.version = version
+            self.epoch = epoch or self.epoch
+
+    def apply_delta(self, delta: dict):
+        with self.lock:
+            if delta["version"] <= self.version:
+                return
+            self.version = delta["version"]
+
+        for listener in self.listeners:
+            listener(delta)
+
+    # Committed before the delta goes out, so followers find the rows in it
+    def flush(self):
+        self.save()
+
+    def record_digest(self, filename: str, digest: str):
+        if self.readonly:
+            return
+
+        with self.lock:
+            self.db.execute(
+                "UPDATE resources SET digest = ? WHERE name = ?", (digest, filename)
+            )
+        self.dirty.set()
+
+    def record_hit(self, filename: str):
+        if self.readonly:
+            return
+
+        with self.lock:
+            self.db.execute(
+                "UPDATE resources SET popularity = popularity + 1 WHERE name = ?",
+                (filename,),
+            )
+        self.dirty.set()
+
+    # Writes are committed in batches by the background writer
+    def save(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        super().close()
+
+        with self.lock:
+            self.db.commit()
+            self.db.close()
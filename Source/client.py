@@ -1,5 +1,6 @@
+import os, json
 from time import sleep
-from threading import Thread, Event
+from threading import Thread, Event, Lock, BoundedSemaphore
 from socket import (
     socket,
     AF_INET,
@@ -9,17 +10,22 @@ from socket import (
     gethostbyname,
 )
 
-from classes import ClientDownloadManager, RichClient
+from classes import ClientDownloadManager, ClientFileDownloader, RichClient
 from shared.envs import (
     VERSION,
     ADDR,
     MAX_BUF_SIZE,
-    ENCODING_FORMAT,
-    SEPARATOR,
+    SEGMENT_CONNECTIONS,
+    SEGMENT_MIN_SIZE,
+    SERVER_MAX_CONNECTIONS,
+    COMPRESS_CODECS,
     CLIENT_REQUEST_INPUT,
+    LIST_PAGE_SIZE,
+    CLIENT_CATALOG_CACHE,
 )
-from shared.constants import STATUS_SIGNAL, DAT_SIGNAL, get_prior_color
-from shared.command import show_help, get_command
+from shared.constants import STATUS_SIGNAL, get_prior_color
+from shared.command import show_help, parse_command, parse_list_query
+from shared.protocol import Frame, FrameDecoder, send_frame, recv_frame
 from utils.base import get_timestamp, stable_render
 from utils.logger import LogType, console_log
 from utils.files import (
@@ -27,18 +33,37 @@ from utils.files import (
     extract_download_input,
     convert_file_size,
     init_download_input,
+    get_download_path,
+    is_safe_filename,
+    get_partial_size,
+    get_tail_digest,
+    is_same_file,
 )
+from utils.delta import prepare_basis, get_block_size, get_block_signatures
 from utils.args import *
 from utils.gui import *
 
 
 class BaseClient:
-    def __init__(self, *, use_rich: bool = False, use_part1: bool = False):
+    def __init__(
+        self,
+        *,
+        use_rich: bool = False,
+        use_part1: bool = False,
+        use_resume: bool = False,
+        use_delta: bool = False,
+        use_subscribe: bool = False,
+    ):
         self.use_rich = use_rich
         self.use_part1 = use_part1
+        self.use_resume = use_resume
+        self.use_delta = use_delta
+        self.use_subscribe = use_subscribe
 
         self.is_served = False
         self.is_shutdown = False
+        # Position in the server's admission queue, 0 once served
+        self.queue_position = 0
         self.interval = 2
         self.conn_timeout = 10
         self.exception_catch = None
@@ -52,17 +77,33 @@ class BaseClient:
         )
 
         self.resources: dict[str, int] = {}
+        self.digests: dict[str, dict] = {}
         self.status: dict[str, tuple[int, bool]] = {}
         self.queue: dict[str, int] = {}
 
         self.exit_signal = Event()
         self.watch_signal = Event()
+        self.list_signal = Event()
+        self.list_page: dict = None
+
+        # Catalog version of the resources, deltas pushed by the server apply on it
+        self.catalog_version: int | None = None
+        self.catalog_etag: str | None = None
+        self.resync_lock = Lock()
 
         self.watch_thread = Thread(target=self.watch_download_list, daemon=False)
         self.download_thread = Thread(target=self.downloads, daemon=False)
+        self.recv_thread = Thread(target=self.receive_frames, daemon=True)
 
         self.client_addr = [gethostbyname(gethostname()), ""]
         self.client = socket(AF_INET, SOCK_STREAM)
+        self.decoder = FrameDecoder()
+        self.send_lock = Lock()
+
+        # Extra connections for segmented downloads, the main one is not counted
+        self.segment_slots = BoundedSemaphore(max(1, SERVER_MAX_CONNECTIONS - 1))
+
+        self.stream_ids: dict[str, int] = {}
 
     def exception_handler(
         self,
@@ -110,11 +151,36 @@ class BaseClient:
 
         return wrapper
 
+    def send_frame(
+        self, frame_type: str, payload: bytes | str | dict = b"", stream_id: int = 0
+    ):
+        with self.send_lock:
+            return send_frame(self.client, frame_type, payload, stream_id)
+
     def send_status_signal(self, signal: str):
-        return self.client.send(STATUS_SIGNAL[signal].encode(ENCODING_FORMAT))
+        return self.send_frame("status", STATUS_SIGNAL[signal])
 
-    def send_dat_signal(self, signal: str):
-        return self.client.send(DAT_SIGNAL[signal].encode(ENCODING_FORMAT))
+    def send_dat_signal(
+        self, signal: str, payload: bytes | dict = b"", stream_id: int = 0
+    ):
+        return self.send_frame(signal, payload, stream_id)
+
+    def send_command(self, cmd: str):
+        return self.send_frame("cmd", cmd)
+
+    def recv_frame(self):
+        return recv_frame(self.client, self.decoder)
+
+    def is_terminate_frame(self, frame: Frame | None):
+        return (
+            frame is not None
+            and frame.type == "status"
+            and frame.text()
+            in [
+                STATUS_SIGNAL["terminate"],
+                STATUS_SIGNAL["interrupt"],
+            ]
+        )
 
     def logging(self, content):
         with open("client.log", "a") as f:
@@ -130,22 +196,39 @@ class BaseClient:
         for _ in range(self.conn_timeout, 0, -1):
             if self.is_served:
                 return
-            stable_render(f"{_} seconds...\n", 2)
+            if self.queue_position:
+                stable_render(f"Number {self.queue_position} in the queue...\n", 2)
+            else:
+                stable_render(f"{_} seconds...\n", 2)
             sleep(1)
         stable_render("Server is busy now, please wait...\n\n", 3)
 
+    def handle_status_frame(self, frame: Frame):
+        signal, _, position = frame.text().partition(" ")
+
+        if signal == STATUS_SIGNAL["busy"]:
+            self.queue_position = int(position or 0)
+        elif signal == STATUS_SIGNAL["accept"]:
+            self.queue_position = 0
+        elif signal == STATUS_SIGNAL["reject"]:
+            raise Exception("Server is full, please try again later!")
+
     def add_to_download(
         self,
         *,
         filename: str,
         chunk_sz: int,
         tot: int,
+        stream_id: int = 0,
+        offset: int = 0,
         is_overwritten: bool = False,
     ):
         self.download_manager.add_download(
             filename=filename,
             chunk_sz=chunk_sz,
             tot=tot,
+            stream_id=stream_id,
+            offset=offset,
             is_overwritten=is_overwritten,
         )
 
@@ -184,6 +267,198 @@ class BaseClient:
             self.update_status()
             sleep(self.interval)
 
+    def get_resume_request(self, filename: str):
+        offset = get_partial_size(filename) if self.use_resume else 0
+
+        if not 0 < offset <= self.resources[filename]:
+            return {}
+
+        return {
+            "offset": offset,
+            "digest": get_tail_digest(get_download_path(filename), offset),
+        }
+
+    def reserve_segments(self, size: int):
+        if self.use_part1:
+            return 1
+
+        count = 1
+        while count < min(SEGMENT_CONNECTIONS, size // SEGMENT_MIN_SIZE):
+            if not self.segment_slots.acquire(blocking=False):
+                break
+            count += 1
+
+        return count
+
+    def request_segments(self, filename: str, chunk_sz: int, count: int):
+        stream_ids = [
+            self.stream_ids[filename],
+            *[self.download_manager.new_stream_id() for _ in range(count - 1)],
+        ]
+
+        self.add_to_download(
+            filename=filename,
+            chunk_sz=chunk_sz,
+            tot=self.resources[filename],
+            stream_id=stream_ids[0],
+            is_overwritten=True,
+        )
+
+        file = self.download_manager.download_list[filename]
+        segments = file.split(stream_ids, max(1, file.chunk_size))
+
+        for _ in range(len(stream_ids) - len(segments)):
+            self.segment_slots.release()
+
+        for stream_id, start, end in segments:
+            self.download_manager.add_stream(stream_id, filename)
+
+            request = {
+                "filename": filename,
+                "weight": max(1, chunk_sz // MAX_BUF_SIZE),
+                "range": [start, end],
+            }
+
+            if stream_id == stream_ids[0]:
+                self.send_dat_signal("file", request, stream_id)
+            else:
+                Thread(
+                    target=self.download_segment, args=(request, stream_id), daemon=True
+                ).start()
+
+    def download_segment(self, request: dict, stream_id: int):
+        conn = socket(AF_INET, SOCK_STREAM)
+        decoder = FrameDecoder()
+        frame = None
+
+        try:
+            conn.connect(ADDR)
+            send_frame(conn, "file", request, stream_id)
+
+            while not self.must_stop():
+                frame = recv_frame(conn, decoder)
+
+                if not frame or self.is_terminate_frame(frame):
+                    frame = None
+                    break
+
+                if frame.type in ["range", "data", "done", "error"]:
+                    self.handle_stream_frame(frame)
+                if frame.type in ["done", "error"]:
+                    break
+
+            send_frame(conn, "cmd", "quit")
+        except SocketError:
+            pass
+        finally:
+            conn.close()
+            self.segment_slots.release()
+
+            if not frame and not self.must_stop():
+                self.handle_stream_frame(
+                    Frame("error", stream_id, b"Segment connection is lost")
+                )
+
+    def is_up_to_date(self, filename: str):
+        digest = self.digests.get(filename, {}).get("blake2b")
+
+        return digest is not None and is_same_file(
+            get_download_path(filename), self.resources[filename], digest
+        )
+
+    def request_delta(self, filename: str, chunk_sz: int):
+        if not self.use_delta or not (
+            basis := prepare_basis(get_download_path(filename))
+        ):
+            return False
+
+        block_size = get_block_size(get_partial_size(f"{filename}.basis"))
+
+        self.add_to_download(
+            filename=filename,
+            chunk_sz=chunk_sz,
+            tot=self.resources[filename],
+            stream_id=self.stream_ids[filename],
+            is_overwritten=True,
+        )
+        self.download_manager.download_list[filename].use_basis(basis, block_size)
+
+        # The server answers with copy frames for the blocks we already have
+        self.send_dat_signal(
+            "file",
+            {
+                "filename": filename,
+                "weight": max(1, chunk_sz // MAX_BUF_SIZE),
+                "delta": {
+                    "block_size": block_size,
+                    "blocks": get_block_signatures(basis, block_size),
+                },
+            },
+            self.stream_ids[filename],
+        )
+
+        return True
+
+    def request_file(self, filename: str, chunk_sz: int):
+        self.stream_ids[filename] = self.download_manager.new_stream_id()
+
+        if self.is_up_to_date(filename):
+            self.status[filename] = (chunk_sz, True)
+            console_log(LogType.INFO, f"{filename} is already up to date")
+            return
+
+        if self.request_delta(filename, chunk_sz):
+            return
+
+        resume = self.get_resume_request(filename)
+
+        # Large files are split over several connections unless resuming one
+        if (
+            not resume
+            and (count := self.reserve_segments(self.resources[filename])) > 1
+        ):
+            return self.request_segments(filename, chunk_sz, count)
+
+        self.add_to_download(
+            filename=filename,
+            chunk_sz=chunk_sz,
+            tot=self.resources[filename],
+            stream_id=self.stream_ids[filename],
+            offset=resume.get("offset", 0),
+            is_overwritten=True,
+        )
+
+        # The server interleaves all requested files, priority only weights the share
+        self.send_dat_signal(
+            "file",
+            {
+                "filename": filename,
+                "weight": max(1, chunk_sz // MAX_BUF_SIZE),
+                "codecs": COMPRESS_CODECS,
+                **resume,
+            },
+            self.stream_ids[filename],
+        )
+
+    def handle_range_frame(self, file: ClientFileDownloader, frame: Frame):
+        payload = frame.json()
+        offset = int(payload["offset"])
+
+        if codec := payload.get("codec"):
+            file.use_codec(codec)
+
+        if "chunks" in payload:
+            file.expect_digests(payload)
+
+        # The server starts over when the partial file does not match its copy
+        if offset != file.ranges[frame.stream_id][0]:
+            file.seek(offset)
+        elif offset and len(file.ranges) == 1:
+            console_log(
+                LogType.INFO,
+                f"Resuming {file.filename} from {convert_file_size(offset)}",
+            )
+
     def downloads(self, sleep_time: float = -1):
         try:
             while not self.must_stop():
@@ -196,7 +471,7 @@ class BaseClient:
                         self.watch_download_list()
                         continue
 
-                    sleep(sleep_time) if sleep_time > 0 else None
+                    sleep(sleep_time if sleep_time > 0 else 0.1)
                     continue
 
                 to_remove = []
@@ -204,112 +479,249 @@ class BaseClient:
 
                 for filename, chunk_sz in __queue.items():
                     if self.status[filename][1]:
+                        to_remove.append(filename)
                         continue
 
-                    try:
-                        self.client.send("file".encode(ENCODING_FORMAT))
-                        accept = self.client.recv(MAX_BUF_SIZE).decode(ENCODING_FORMAT)
-                    except SocketError:
-                        self.exception_catch = SocketError
-                        console_log(LogType.ERR, "Connection is lost!")
-                        self.close_connection(True)
-                        exit()
-                    except Exception as e:
-                        self.exception_catch = e
-                        continue
-
-                    if accept in [
-                        STATUS_SIGNAL["terminate"],
-                        STATUS_SIGNAL["interrupt"],
-                    ]:
-                        raise Exception("Server is terminated!")
-
-                    if accept != STATUS_SIGNAL["accept"]:
+                    if filename in self.stream_ids:
                         continue
 
-                    self.client.send(
-                        f"{DAT_SIGNAL['data']}{SEPARATOR}{filename}{SEPARATOR}{chunk_sz}{SEPARATOR}".encode(
-                            ENCODING_FORMAT
-                        )
-                    )
-
-                    data = self.client.recv(chunk_sz)
-                    if not data:
+                    if self.use_part1 and any(
+                        f in self.stream_ids and not self.status[f][1] for f in __queue
+                    ):
                         break
 
-                    if data == STATUS_SIGNAL["terminate"].encode(ENCODING_FORMAT):
-                        raise Exception("Server is terminated!")
+                    self.request_file(filename, chunk_sz)
 
-                    if data == b"done":
-                        continue
+                for filename in to_remove:
+                    self.queue.pop(filename, None)
+                __queue.clear()
 
-                    if filename not in self.download_manager.download_list:
-                        self.add_to_download(
-                            filename=filename,
-                            chunk_sz=chunk_sz,
-                            tot=self.resources[filename],
-                            is_overwritten=True,
-                        )
+                sleep(sleep_time if sleep_time > 0 else 0.1)
+        except SocketError:
+            self.exception_catch = SocketError
+            console_log(LogType.ERR, "Connection is lost!")
 
-                    self.download_manager.download((filename, data))
+            self.close_connection(True)
+        except Exception as e:
+            self.exception_catch = e
+            console_log(LogType.ERR, f"An error occurs when downloading: {e}")
 
-                    __is_done = self.download_manager.download_list[filename].is_done()
-                    self.status[filename] = (
-                        chunk_sz,
-                        __is_done,
-                    )
-                    if __is_done:
-                        to_remove.append(filename)
+    def handle_stream_frame(self, frame: Frame):
+        if not (file := self.download_manager.get_stream(frame.stream_id)):
+            return
 
-                    if self.use_part1:
-                        break
+        if frame.type == "range":
+            return self.handle_range_frame(file, frame)
 
-                for filename in to_remove:
-                    del self.queue[filename]
-                __queue.clear()
+        if frame.type == "data":
+            self.download_manager.download_stream(frame.stream_id, frame.payload)
+        elif frame.type == "copy":
+            self.download_manager.copy_stream(frame.stream_id, frame.json())
+        elif frame.type == "error":
+            console_log(
+                LogType.ERR, f"Failed to download {file.filename}: {frame.text()}"
+            )
+
+        self.status[file.filename] = (
+            self.status[file.filename][0],
+            frame.type == "error" or file.is_done(),
+        )
 
-                sleep(sleep_time) if sleep_time > 0 else None
+    def receive_frames(self):
+        try:
+            while not self.must_stop():
+                frame = self.recv_frame()
+
+                if not frame:
+                    raise ConnectionResetError
+
+                if self.is_terminate_frame(frame):
+                    raise Exception("Server is terminated!")
+
+                if frame.type == "status":
+                    self.handle_status_frame(frame)
+                elif frame.type == "list":
+                    self.list_page = frame.json()
+                    self.list_signal.set()
+                elif frame.type == "delta":
+                    self.apply_catalog_delta(frame.json())
+                elif frame.type in ["range", "data", "copy", "done", "error"]:
+                    self.handle_stream_frame(frame)
         except SocketError:
+            if self.must_stop():
+                return
+
             self.exception_catch = SocketError
             console_log(LogType.ERR, "Connection is lost!")
 
             self.close_connection(True)
         except Exception as e:
+            if self.must_stop():
+                return
+
             self.exception_catch = e
-            console_log(LogType.ERR, f"An error occurs when downloading: {e}")
+            console_log(LogType.ERR, f"An error occurs when receiving: {e}")
+
+            self.close_connection(True)
 
-    def update_resources(self, msg: str):
-        for line in msg.strip().split("\n"):
-            line = line.strip()
-            if line == "" or not line:
+    def update_resources(self, files: dict[str, dict]):
+        for filename, info in files.items():
+            # Never write outside the downloads folder, whatever the server says
+            if not is_safe_filename(filename):
                 continue
 
-            _, filename, size = line.split(SEPARATOR)[:3]
-            self.resources[filename] = int(size)
+            self.resources[filename] = int(info["size"])
 
-    def fetch_list(self):
-        self.client.send("list".encode(ENCODING_FORMAT))
-        msg = self.client.recv(MAX_BUF_SIZE).decode(ENCODING_FORMAT)
+            if "blake2b" in info:
+                self.digests[filename] = info
+            else:
+                self.digests.pop(filename, None)
 
-        if msg in [
-            STATUS_SIGNAL["terminate"],
-            STATUS_SIGNAL["interrupt"],
-        ]:
+    def fetch_page(self, query: dict):
+        self.list_signal.clear()
+        self.send_command(f"list {json.dumps(query, separators=(',', ':'))}")
+
+        # A queued client keeps waiting, the command is read once it is served
+        while not self.list_signal.wait(self.conn_timeout):
+            if not self.queue_position or self.must_stop():
+                return None
+
+        return self.list_page
+
+    def load_catalog_cache(self) -> dict:
+        try:
+            with open(CLIENT_CATALOG_CACHE, "r") as f:
+                cache = json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+        return cache if cache.get("server") == f"{ADDR[0]}:{ADDR[1]}" else {}
+
+    def save_catalog_cache(self):
+        cache = {
+            "server": f"{ADDR[0]}:{ADDR[1]}",
+            "etag": self.catalog_etag,
+            "files": {
+                filename: {**self.digests.get(filename, {}), "size": size}
+                for filename, size in self.resources.items()
+            },
+        }
+
+        try:
+            os.makedirs(os.path.dirname(CLIENT_CATALOG_CACHE), exist_ok=True)
+            with open(f"{CLIENT_CATALOG_CACHE}.tmp", "w") as f:
+                f.write(json.dumps(cache, separators=(",", ":")))
+            os.replace(f"{CLIENT_CATALOG_CACHE}.tmp", CLIENT_CATALOG_CACHE)
+        except OSError:
+            pass
+
+    def fetch_list(self, query: dict = {}, on_page=None) -> bool:
+        is_full = not {"match", "prefix"} & query.keys()
+
+        # The listing of the last run stands in until the server says otherwise
+        cache = self.load_catalog_cache() if is_full and not self.resources else {}
+        etag = (self.catalog_etag or cache.get("etag")) if is_full else None
+
+        listed: set[str] = set()
+        cursor, version = None, None
+
+        while True:
+            page = self.fetch_page(
+                {**query, "cursor": cursor, "limit": LIST_PAGE_SIZE, "etag": etag}
+            )
+
+            if not page or "error" in page:
+                console_log(LogType.ERR, (page or {}).get("error", "No list received"))
+                return False
+
+            if page.get("not_modified"):
+                if cache:
+                    self.update_resources(cache["files"])
+                    on_page(cache["files"]) if on_page else None
+
+                self.catalog_version, self.catalog_etag = page["version"], etag
+                return False
+
+            # Changes made during the walk come again as deltas after it
+            if cursor is None:
+                version, etag = page.get("version"), page.get("etag")
+
+            self.update_resources(page["files"])
+            listed.update(page["files"])
+            on_page(page["files"]) if on_page else None
+
+            if not (cursor := page["next"]):
+                break
+
+        # Only a complete, unfiltered listing tells which files are gone
+        if is_full:
+            for filename in [f for f in self.resources if f not in listed]:
+                self.resources.pop(filename, None)
+                self.digests.pop(filename, None)
+
+            self.catalog_version, self.catalog_etag = version, etag
+            self.save_catalog_cache()
+
+        return True
+
+    def apply_catalog_delta(self, delta: dict):
+        if self.catalog_version is None or delta["version"] <= self.catalog_version:
             return
 
-        if msg[:4] == DAT_SIGNAL["list"]:
-            self.resources.clear()
-            self.update_resources(msg)
+        # Missed a delta, only a new listing can tell what changed
+        if delta["base"] != self.catalog_version:
+            Thread(target=self.resync_catalog, daemon=True).start()
+            return
+
+        self.update_resources({**delta["added"], **delta["changed"]})
+        for filename in delta["removed"]:
+            self.resources.pop(filename, None)
+            self.digests.pop(filename, None)
+
+        self.catalog_version = delta["version"]
+        self.catalog_etag = None
+
+        console_log(
+            LogType.INFO,
+            f"Resources updated: {len(delta['added'])} added, "
+            f"{len(delta['changed'])} changed, {len(delta['removed'])} removed",
+        )
+        self.render_catalog_change()
 
-    def handle_fetch(self):
-        self.fetch_list()
+    def resync_catalog(self):
+        if not self.resync_lock.acquire(blocking=False):
+            return
 
+        try:
+            self.fetch_list()
+            self.render_catalog_change()
+        finally:
+            self.resync_lock.release()
+
+    def render_catalog_change(self):
         if self.use_rich:
-            self.rich_renderer.render_file_list(
-                [item for item in self.resources.items()]
-            )
-        else:
-            render_file_list([item for item in self.resources.items()])
+            self.rich_renderer.render_file_list(list(self.resources.items()))
+
+    def subscribe(self):
+        if self.use_subscribe:
+            self.send_command("subscribe")
+
+    def handle_fetch(self, query: dict = {}):
+        files: list[tuple[str, int]] = []
+
+        def on_page(page: dict[str, dict]):
+            rows = [(filename, int(info["size"])) for filename, info in page.items()]
+
+            if self.use_rich:
+                self.rich_renderer.render_file_list(rows, append=bool(files))
+            files.extend(rows)
+
+        # Not modified: the table already shows the listing, the console does not
+        if not self.fetch_list(query, on_page) and not files:
+            files = list(self.resources.items())
+
+        if not self.use_rich:
+            render_file_list(files)
 
     def close_connection(self, terminate: bool = False):
         self.exit_signal.set()
@@ -321,7 +733,7 @@ class BaseClient:
 
             if self.client:
                 if not terminate and not self.is_shutdown:
-                    self.client.send("quit".encode(ENCODING_FORMAT))
+                    self.send_command("quit")
 
                 self.client.close()
         except Exception:
@@ -349,8 +761,10 @@ class Client(BaseClient):
             console_log(LogType.INFO, "Waiting for being served...")
 
             Thread(target=self.count_down, daemon=True).start()
+            self.recv_thread.start()
 
             self.handle_fetch()
+            self.subscribe()
             self.update_status()
 
             self.is_served = True
@@ -364,13 +778,15 @@ class Client(BaseClient):
                 if self.must_exit():
                     break
 
-                cmd = get_command(inp.lower())
+                cmd, args = parse_command(inp)
 
                 if cmd == "quit":
                     self.exit_signal.set()
                     break
                 elif cmd == "list":
-                    self.handle_fetch()
+                    self.handle_fetch(parse_list_query(args))
+                elif cmd in ["subscribe", "unsubscribe"]:
+                    self.send_command(cmd)
                 elif cmd == "file":
                     console_log(
                         LogType.INFO,
@@ -459,7 +875,7 @@ class GUIClient(BaseClient):
         )
 
         self.threads["download-files"] = Thread(
-            target=self.downloads, args=(10 ** (-4),), daemon=False
+            target=self.downloads, args=(0.1,), daemon=False
         )
         self.threads["run"] = Thread(
             target=self.exception_handler(self.run, exception_msg="Error when running"),
@@ -500,6 +916,9 @@ class GUIClient(BaseClient):
 
         self.component["download-process"] = {}
 
+    def render_catalog_change(self):
+        self.render_resource_list()
+
     def render_resource_list(self):
         if "lt-sidebar" not in self.component:
             return
@@ -550,7 +969,9 @@ class GUIClient(BaseClient):
                     label=f"{filename}",
                     row=len(self.component["download-process"]) + 1,
                     col=0,
-                    progress_color=get_prior_color(download.chunk_sz // MAX_BUF_SIZE),
+                    progress_color=get_prior_color(
+                        max(1, download.chunk_sz // MAX_BUF_SIZE)
+                    ),
                 )
 
                 self.component["download-process"][filename] = self.component[
@@ -674,8 +1095,10 @@ class GUIClient(BaseClient):
         console_log(LogType.INFO, "Connected to the server!")
 
         self.is_ready = True
+        self.recv_thread.start()
 
         self.handle_fetch()
+        self.subscribe()
         self.update_status()
 
         self.render_resource_list()
@@ -696,12 +1119,23 @@ if __name__ == "__main__":
     args = parse_args(
         prog="Socket Client",
         desc="A simple socket client for downloading files",
-        wrappers=[with_gui_arg, with_rich_arg, with_part1_arg, with_version_arg],
+        wrappers=[
+            with_gui_arg,
+            with_rich_arg,
+            with_part1_arg,
+            with_resume_arg,
+            with_delta_arg,
+            with_subscribe_arg,
+            with_version_arg,
+        ],
     )
 
     use_gui = args.gui
     use_rich = args.rich
     use_part1 = args.part1
+    use_resume = args.resume
+    use_delta = args.delta
+    use_subscribe = args.subscribe
     use_version = args.version
 
     if use_version:
@@ -710,11 +1144,29 @@ if __name__ == "__main__":
 
     print("--part1 detected, using part1 version") if use_part1 else None
     print("--gui detected, using GUI version") if use_gui else None
+    print("--resume detected, resuming partial downloads") if use_resume else None
+    print("--delta detected, fetching changed blocks only") if use_delta else None
+    (
+        print("--subscribe detected, resource changes are pushed")
+        if use_subscribe
+        else None
+    )
 
     if use_gui:
         print()
-        GUIClient(use_part1=use_part1).render()
+        GUIClient(
+            use_part1=use_part1,
+            use_resume=use_resume,
+            use_delta=use_delta,
+            use_subscribe=use_subscribe,
+        ).render()
     else:
         print("--rich detected, using rich version") if use_rich else None
         print()
-        Client(use_rich=use_rich, use_part1=use_part1).run()
+        Client(
+            use_rich=use_rich,
+            use_part1=use_part1,
+            use_resume=use_resume,
+            use_delta=use_delta,
+            use_subscribe=use_subscribe,
+        ).run()
@@ -1,37 +1,96 @@
-from time import sleep
-from threading import Thread, Event
+import json, asyncio
+import multiprocessing
+from collections import deque
+from itertools import islice
+from time import sleep, monotonic
+from selectors import EVENT_READ, EVENT_WRITE
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
 from socket import (
     socket,
     AF_INET,
     SOCK_STREAM,
+    SOL_SOCKET,
     SHUT_RDWR,
     error as SocketError,
     gethostname,
     gethostbyname,
 )
 
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    SO_REUSEPORT = None
+
 import customtkinter as tk
 
-from classes import ServerDownloadManager
+from classes import (
+    AdmissionController,
+    BlockCache,
+    CompressionCache,
+    DigestIndex,
+    FileHandles,
+    MappedFiles,
+    ResourceCatalog,
+    SQLiteResourceCatalog,
+    ServerDownloadManager,
+    ServerFileDownloader,
+    TransmitScheduler,
+    AsyncTransmitScheduler,
+)
 from shared.envs import (
     VERSION,
     ADDR,
     BACKLOG,
-    MAX_BUF_SIZE,
-    ENCODING_FORMAT,
-    SEPARATOR,
+    STREAM_CHUNK_SIZE,
+    CLIENT_SHARES,
+    PRIOR_SHARES,
     SERVER_RESOURCES_PATH,
+    LIST_PAGE_SIZE,
+    SUBSCRIBE_QUEUE_SIZE,
+    RESOURCE_INDEX,
+    BLOCK_CACHE_SIZE,
+    SERVER_READER,
+    SERVER_WORKERS,
+    MAX_ACTIVE_TRANSFERS,
+    STATS_INTERVAL,
+    TRANSMIT_TIMEOUT,
+)
+from shared.constants import (
+    STATUS_SIGNAL,
+    get_prior_color,
+    get_prior_share,
+    get_request_weight,
+)
+from shared.command import parse_command
+from shared.protocol import (
+    Frame,
+    FrameDecoder,
+    send_frame,
+    recv_frame,
+    read_frame,
+    encode_frame,
+    encode_payload,
+    wait_ready,
 )
-from shared.constants import STATUS_SIGNAL, DAT_SIGNAL, get_prior_color
-from shared.command import get_command
 from utils.base import get_timestamp
 from utils.logger import LogType, raw_log, local_log, console_log
-from utils.files import get_resource_list_data, get_asset_size, convert_file_size
+from utils.files import (
+    get_tail_digest,
+    convert_file_size,
+)
 from utils.resources_watching import start_watching, update_resource_list
+from utils.delta import check_delta_request, compute_delta
 from utils.args import *
 from utils.gui import *
 
 
+def create_catalog():
+    if RESOURCE_INDEX == "sqlite":
+        return SQLiteResourceCatalog()
+    return ResourceCatalog()
+
+
 class BaseServer:
     def __init__(
         self,
@@ -39,8 +98,13 @@ class BaseServer:
         use_part1=False,
         client_updater=None,
         watching_updater=update_resource_list,
+        upstream=None,
+        addr: tuple[str, int] = ADDR,
     ):
         self.use_part1 = use_part1
+        self.addr = addr
+        # Set in pre-fork workers, the pipe the supervisor feeds the catalog to
+        self.upstream = upstream
 
         self.is_shutdown = False
         self.resources_path = SERVER_RESOURCES_PATH
@@ -50,74 +114,446 @@ class BaseServer:
         self.addresses: dict[socket, tuple[str, int]] = {}
         self.resources: dict[str, tuple[int, str]] = {}
 
+        self.transmit_scheduler = self.create_transmit_scheduler()
+
+        # The last snapshot is served right away, see reconcile_resources
+        self.catalog = self.create_catalog()
+        if not upstream:
+            self.catalog.load() or self.catalog.scan()
+
+        # Connections that get catalog deltas pushed, with their pending frames
+        self.subscribers: dict[socket, deque[bytes]] = {}
+        self.catalog.listeners.append(self.publish_catalog_delta)
+
+        self.digest_index = DigestIndex(workers=0) if upstream else DigestIndex()
+        self.digest_index.listeners.append(self.record_digest)
+        self.load_upstream_snapshot() if upstream else None
+
+        self.compression_cache = CompressionCache()
+        self.file_handles = FileHandles()
+        self.admission: AdmissionController = self.create_admission()
+        self.block_cache = self.mapped_files = None
+        if SERVER_READER == "cache" and BLOCK_CACHE_SIZE > 0:
+            self.block_cache = BlockCache()
+        elif SERVER_READER == "mmap":
+            self.mapped_files = MappedFiles()
+        self.catalog.listeners.append(self.release_changed_files)
+
         self.exit_signal = Event()
         self.watching_thread: Thread = None
 
         try:
-            self.server_addr = [gethostbyname(gethostname()), ADDR]
+            self.server_addr = [gethostbyname(gethostname()), addr]
             self.server = socket(AF_INET, SOCK_STREAM)
-            self.server.bind(ADDR)
+            # Every worker listens on ADDR, the kernel spreads the connections
+            if upstream:
+                self.server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            self.server.bind(addr)
         except SocketError:
             console_log(LogType.ERR, "Failed to create server socket!")
             self.shutdown_server()
             exit()
 
     def send_status_signal(self, conn: socket, signal: str):
-        return conn.send(STATUS_SIGNAL[signal].encode(ENCODING_FORMAT))
+        return send_frame(conn, "status", STATUS_SIGNAL[signal])
 
-    def send_dat_signal(self, conn: socket, signal: str):
-        return conn.send(DAT_SIGNAL[signal].encode(ENCODING_FORMAT))
+    def get_busy_signal(self, position: int):
+        return f"{STATUS_SIGNAL['busy']} {position}"
+
+    def send_dat_signal(
+        self, conn: socket, signal: str, payload: bytes = b"", stream_id: int = 0
+    ):
+        return send_frame(conn, signal, payload, stream_id)
 
     def client_log(self, type: str, addr: str, msg: str):
         console_log(type, f"[CLIENT] - {addr}: {msg}")
 
-    def send_resource_list(self, conn: socket):
-        self.resources = get_resource_list_data()
+    def create_catalog(self):
+        # The supervisor keeps the catalog on disk, workers read its SQLite
+        # database or keep a copy of the JSON one in memory
+        if self.upstream and RESOURCE_INDEX == "sqlite":
+            return SQLiteResourceCatalog(readonly=True)
+        if self.upstream:
+            return ResourceCatalog(path=None)
+        return create_catalog()
 
-        available_files = "\n".join(
-            [
-                f"{DAT_SIGNAL['list']}{SEPARATOR}{filename}{SEPARATOR}{fileinfo[0]}{SEPARATOR}"
-                for filename, fileinfo in self.resources.items()
+    # See PreforkSupervisor.send_snapshot
+    def load_upstream_snapshot(self):
+        _, version, epoch, digests_version = self.upstream.recv()
+
+        while (message := self.upstream.recv())[0] != "ready":
+            kind, batch = message
+
+            if kind == "entries":
+                self.catalog.load_snapshot(version, batch)
+            elif kind == "digests":
+                self.digest_index.entries.update(batch)
+
+        self.catalog.load_snapshot(version, {}, epoch)
+        self.digest_index.version = digests_version
+
+    def record_digest(self, filename: str, entry: dict):
+        self.catalog.record_digest(filename, entry["blake2b"])
+
+    # Open handles and maps of changed files are not reused
+    def release_changed_files(self, delta: dict):
+        paths = [path for _, path in delta["changed"].values()]
+        paths += [self.catalog.get_path(filename) for filename in delta["removed"]]
+
+        for path in paths:
+            self.file_handles.invalidate(path)
+            self.mapped_files.invalidate(path) if self.mapped_files else None
+
+    def reconcile_resources(self):
+        if changes := self.catalog.reconcile():
+            console_log(LogType.INFO, f"{changes} resources changed while stopped")
+
+        self.digest_index.refresh(self.catalog.iter_entries())
+
+    def create_transmit_scheduler(self):
+        return TransmitScheduler()
+
+    def create_admission(self):
+        return AdmissionController()
+
+    def get_transmit_share(self, conn: socket, weight: int):
+        host = (self.addresses.get(conn) or [""])[0]
+        client_share = CLIENT_SHARES.get(host, CLIENT_SHARES.get("*", 1))
+
+        return client_share * get_prior_share(weight, PRIOR_SHARES)
+
+    def get_pending_size(self, conn: socket):
+        file = self.download_manager[conn].next_download()
+        return file.next_chunk_size() if file else 0
+
+    def remove_transmit_flow(self, conn: socket, addr: str):
+        served = self.transmit_scheduler.remove(conn)
+        self.client_log(LogType.INFO, addr, f"Served {convert_file_size(served)}")
+
+    def is_closing_frame(self, frame: Frame | None):
+        return not frame or (
+            frame.type == "status"
+            and frame.text()
+            in [
+                STATUS_SIGNAL["terminate"],
+                STATUS_SIGNAL["interrupt"],
             ]
         )
 
-        conn.sendall(available_files.encode(ENCODING_FORMAT))
+    def get_resource_info(self, filename: str, size: int, path: str):
+        # Digests show up once the background workers have hashed the file, the
+        # chunk list grows with it and is only sent with the file's range
+        digests = self.digest_index.get(filename, path, self.catalog.version)
+        return {"size": size, **({"blake2b": digests["blake2b"]} if digests else {})}
 
-    def send_files(self, conn: socket):
-        if self.exit_signal.is_set() or self.is_shutdown:
-            return
+    def get_resource_list_payload(self):
+        return {
+            filename: self.get_resource_info(filename, *fileinfo)
+            for filename, fileinfo in self.catalog.iter_entries()
+        }
 
-        self.send_status_signal(conn, "accept")
-        msg = conn.recv(MAX_BUF_SIZE).decode(ENCODING_FORMAT)
+    def get_resource_list_bytes(self):
+        return self.get_encoded_resource_list()[0]
 
-        if not msg or msg in [
-            "quit",
-            STATUS_SIGNAL["terminate"],
-            STATUS_SIGNAL["interrupt"],
-        ]:
-            self.close_connection(conn, self.addresses[conn])
-            return
+    def get_resource_list_etag(self, version: int = None):
+        return self.catalog.etag(self.digest_index.version, version)
 
-        if not msg.startswith(DAT_SIGNAL["data"]):
-            return
+    def get_encoded_resource_list(self):
+        return self.catalog.encode(
+            self.get_resource_list_payload, self.digest_index.version
+        )
+
+    def get_resource_page(self, query: dict):
+        version, etag = self.catalog.version, None
+
+        # A full walk starts with the ETag, the client may have the listing already
+        if query.get("cursor") is None and not {"match", "prefix"} & query.keys():
+            etag = self.get_resource_list_etag(version)
+
+            if query.get("etag") == etag:
+                return {
+                    "files": {},
+                    "next": None,
+                    "version": version,
+                    "etag": etag,
+                    "not_modified": True,
+                }
+
+        files, cursor = self.catalog.page(
+            limit=max(
+                1, min(int(query.get("limit") or 0) or LIST_PAGE_SIZE, LIST_PAGE_SIZE)
+            ),
+            cursor=query.get("cursor"),
+            match=query.get("match"),
+            prefix=query.get("prefix"),
+            sort=query.get("sort") or "name",
+        )
+
+        return {
+            "files": {
+                name: self.get_resource_info(name, *info) for name, *info in files
+            },
+            "next": cursor,
+            "version": version,
+            "etag": etag,
+        }
+
+    def get_resource_list_reply(self, args: str):
+        # A bare "list" gets the whole catalog, a JSON query gets one page
+        if not args:
+            return self.get_resource_list_bytes()
+
+        try:
+            return self.get_resource_page(json.loads(args))
+        except (TypeError, ValueError, AttributeError) as e:
+            return {"files": {}, "next": None, "error": f"Invalid list query: {e}"}
+
+    def get_catalog_delta_payload(self, delta: dict):
+        payload = {**delta}
+
+        for key in ["added", "changed"]:
+            payload[key] = {
+                name: self.get_resource_info(name, *entry)
+                for name, entry in delta[key].items()
+            }
+
+        return payload
 
-        if len(msg_plit := msg.split(SEPARATOR)) < 3:
+    def publish_catalog_delta(self, delta: dict):
+        if not self.subscribers:
             return
 
-        _, filename, prior = msg_plit[:3]
+        payload = encode_payload(self.get_catalog_delta_payload(delta))
+
+        # A full queue drops the oldest delta, the client sees the version gap
+        for conn, pending in list(self.subscribers.items()):
+            pending.append(payload)
+            self.notify_subscriber(conn)
+
+    def notify_subscriber(self, conn: socket):
+        pass
+
+    def subscribe(self, conn: socket):
+        self.subscribers.setdefault(conn, deque(maxlen=SUBSCRIBE_QUEUE_SIZE))
+
+        # An empty delta tells the client the version it has to be at
+        version = self.catalog.version
+        return {
+            "base": version,
+            "version": version,
+            "added": {},
+            "changed": {},
+            "removed": [],
+        }
+
+    def handle_subscribe(self, conn: socket, cmd: str):
+        if cmd == "subscribe":
+            self.send_dat_signal(conn, "delta", self.subscribe(conn))
+        else:
+            self.subscribers.pop(conn, None)
+            self.send_status_signal(conn, "accept")
+
+    def flush_catalog_deltas(self, conn: socket):
+        pending = self.subscribers.get(conn)
+
+        while pending:
+            self.send_dat_signal(conn, "delta", pending.popleft())
+
+    def has_pending_frame(self, conn: socket, decoder: FrameDecoder, timeout=0):
+        return bool(decoder.frames) or wait_ready(conn, EVENT_READ, timeout)
+
+    def get_resume_offset(self, path: str, tot: int, request: dict):
+        offset = int(request.get("offset", 0))
+
+        # Resume only when the client's partial file ends like ours
+        if not 0 < offset <= tot or request.get("digest") != get_tail_digest(
+            path, offset
+        ):
+            return 0
+
+        return offset
+
+    def get_request_range(self, filename: str, request: dict):
+        size, path = self.catalog.get(filename)
+
+        if "range" not in request:
+            return self.get_resume_offset(path, size, request), size
+
+        start, end = map(int, request["range"])
+        if not 0 <= start <= end <= size:
+            raise ValueError(f"Invalid range {start}-{end} of {filename}")
+
+        return start, end
+
+    def prepare_file_request(self, frame: Frame):
+        prepared = {"copies": {}, "variant": None}
+
+        try:
+            request = frame.json()
+            filename = request["filename"]
+
+            if filename not in self.catalog:
+                return prepared
+
+            size, path = self.catalog.get(filename)
+
+            if "delta" in request:
+                block_size, blocks = (
+                    request["delta"]["block_size"],
+                    request["delta"]["blocks"],
+                )
+                check_delta_request(block_size, blocks, size)
+
+                prepared["copies"] = compute_delta(path, block_size, blocks)
+            # Only whole files are compressed, ranges index the original bytes
+            elif (
+                not {"range", "offset"} & request.keys()
+                and (
+                    codec := self.compression_cache.choose(
+                        filename, path, request.get("codecs", [])
+                    )
+                )
+                and (
+                    variant := self.compression_cache.get_variant(filename, path, codec)
+                )
+            ):
+                prepared["variant"] = (codec, *variant)
+        except (OSError, KeyError, TypeError, ValueError):
+            pass
+
+        return prepared
+
+    def log_variant(
+        self, conn: socket, file: ServerFileDownloader, size: int, cpu: float
+    ):
+        self.client_log(
+            LogType.INFO,
+            self.addresses.get(conn),
+            f"{file.filename} sent as {file.codec}, {convert_file_size(size)} -> "
+            f"{convert_file_size(file.tot)} ({file.tot / max(1, size):.2%}), "
+            + (f"compressed in {cpu:.2f}s CPU" if cpu else "cached variant"),
+        )
+
+    def get_range_payload(self, file: ServerFileDownloader):
+        payload = {"offset": file.cur, "tot": file.tot}
+
+        if file.codec:
+            payload["codec"] = file.codec
+
+        if (entry := self.catalog.get(file.filename)) and (
+            digests := self.digest_index.get(
+                file.filename, entry[1], self.catalog.version
+            )
+        ):
+            payload["chunk_size"] = digests["chunk_size"]
+            payload["chunks"] = digests["chunks"]
+
+        return payload
+
+    def add_file_request(self, conn: socket, frame: Frame, prepared: dict = None):
+        try:
+            request = frame.json()
+            filename = request["filename"]
+
+            if filename not in self.catalog:
+                return None
+
+            offset, tot = self.get_request_range(filename, request)
 
-        if filename not in self.download_manager[conn].queue:
             self.download_manager[conn].add_download(
                 filename=filename,
-                chunk_sz=int(prior),
-                tot=get_asset_size(filename),
+                chunk_sz=STREAM_CHUNK_SIZE,
+                tot=tot,
+                stream_id=frame.stream_id,
+                weight=get_request_weight(int(request.get("weight", 1))),
+                offset=offset,
+                path=self.catalog.get(filename)[1],
+                is_overwritten=True,
+            )
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+
+        self.catalog.record_hit(filename)
+
+        prepared = prepared or self.prepare_file_request(frame)
+
+        file = self.download_manager[conn].download_list[filename]
+        file.copies = prepared["copies"]
+
+        if prepared["variant"]:
+            codec, path, cpu = prepared["variant"]
+            size = file.tot
+
+            try:
+                file.use_variant(path, codec)
+            except OSError:
+                # Rebuilt or removed as stale since, the file is sent as is
+                return file
+
+            self.log_variant(conn, file, size, cpu)
+
+        return file
+
+    def handle_file_request(self, conn: socket, frame: Frame):
+        file = self.add_file_request(conn, frame)
+
+        if not file:
+            self.send_dat_signal(
+                conn, "error", "File is not available", stream_id=frame.stream_id
             )
+            return
 
+        self.send_dat_signal(
+            conn, "range", self.get_range_payload(file), file.stream_id
+        )
+
+        if file.is_done():
+            self.send_dat_signal(conn, "done", stream_id=frame.stream_id)
+
+    def send_resource_list(self, conn: socket, args: str = ""):
+        self.send_dat_signal(conn, "list", self.get_resource_list_reply(args))
+
+    def send_files(self, conn: socket):
+        if self.exit_signal.is_set() or self.is_shutdown:
+            return
+
+        file = self.download_manager[conn].next_download()
+        if not file:
+            return
+
+        # Don't hold a transmit slot while the client is not reading
+        if not wait_ready(conn, EVENT_WRITE, 0.1):
+            self.transmit_scheduler.cancel(conn)
+            return
+
+        sent = 0
+        self.transmit_scheduler.acquire(
+            conn, file.next_chunk_size(), self.get_transmit_share(conn, file.weight)
+        )
+        # Writable does not mean the whole chunk fits, a client that stops
+        # reading must not keep its slot. Its frame is cut, so it is dropped
+        conn.settimeout(TRANSMIT_TIMEOUT)
         try:
-            bytes_to_send = self.download_manager[conn].download(filename)
-            conn.sendall(bytes_to_send)
-        except StopIteration:
-            self.send_dat_signal(conn, "done")
+            sent = self.download_manager[conn].download(file.filename, conn)
+        except TimeoutError:
+            self.log_stalled(conn)
+            conn.shutdown(SHUT_RDWR)
+            raise
+        finally:
+            conn.settimeout(None)
+            self.transmit_scheduler.release(
+                conn, sent or 0, file.weight, self.get_pending_size(conn)
+            )
+
+        if file.is_done():
+            self.send_dat_signal(conn, "done", stream_id=file.stream_id)
+
+    def log_stalled(self, conn: socket):
+        self.client_log(
+            LogType.ERR,
+            self.addresses.get(conn),
+            f"Stopped reading for {TRANSMIT_TIMEOUT}s, dropped",
+        )
 
     def handle_client(self, conn: socket, addr: str):
         try:
@@ -128,25 +564,50 @@ class BaseServer:
 
             self.updater["client"]() if self.updater["client"] else None
 
-            self.download_manager[conn] = ServerDownloadManager(files=[])
+            self.download_manager[conn] = ServerDownloadManager(
+                files=[],
+                cache=self.block_cache,
+                maps=self.mapped_files,
+                handles=self.file_handles,
+            )
+            decoder = FrameDecoder()
 
             while not self.exit_signal.is_set() and not self.is_shutdown:
-                msg = conn.recv(MAX_BUF_SIZE).decode(ENCODING_FORMAT)
-                cmd = get_command(msg[:4])
+                self.flush_catalog_deltas(conn)
 
-                if not msg or msg in [
-                    STATUS_SIGNAL["terminate"],
-                    STATUS_SIGNAL["interrupt"],
-                ]:
+                # Keep streaming until the client has something new to say
+                if self.download_manager[
+                    conn
+                ].next_download() and not self.has_pending_frame(conn, decoder):
+                    self.send_files(conn)
+                    continue
+
+                # Subscribers wake up now and then to push the queued deltas
+                if conn in self.subscribers and not self.has_pending_frame(
+                    conn, decoder, 0.5
+                ):
+                    continue
+
+                frame = recv_frame(conn, decoder)
+
+                if self.is_closing_frame(frame):
                     break
 
+                if frame.type == "file":
+                    self.handle_file_request(conn, frame)
+                    continue
+
+                cmd, args = (
+                    parse_command(frame.text()) if frame.type == "cmd" else (None, "")
+                )
+
                 if cmd == "quit":
                     self.close_connection(conn, addr)
                     break
                 elif cmd == "list":
-                    self.send_resource_list(conn)
-                elif cmd == "file":
-                    self.send_files(conn)
+                    self.send_resource_list(conn, args)
+                elif cmd in ["subscribe", "unsubscribe"]:
+                    self.handle_subscribe(conn, cmd)
                 else:
                     self.send_status_signal(conn, "invalid")
         except SocketError:
@@ -157,11 +618,13 @@ class BaseServer:
             )
         finally:
             self.client_log(LogType.INFO, addr, "Connection closed!")
+            self.subscribers.pop(conn, None)
+            self.remove_transmit_flow(conn, addr)
             try:
+                self.download_manager.pop(conn).close()
+
                 del self.addresses[conn]
                 self.updater["client"]() if self.updater["client"] else None
-
-                del self.download_manager[conn]
             except KeyError:
                 pass
 
@@ -188,8 +651,44 @@ class BaseServer:
         finally:
             self.client_log(LogType.INFO, addr, "Connection closed!")
 
+    # Bytes served to the connected clients, summed over their connections
+    def get_transmit_stats(self):
+        stats, served = self.transmit_scheduler.stats(), {}
+
+        for conn, size in stats["served"].items():
+            if addr := self.addresses.get(conn):
+                served[addr[0]] = served.get(addr[0], 0) + size
+
+        stats["served"] = {
+            host: convert_file_size(size) for host, size in served.items()
+        }
+        return stats
+
+    # Hit ratio and evictions, to size BLOCK_CACHE_SIZE and the others
+    def log_stats(self):
+        if self.block_cache:
+            console_log(LogType.INFO, f"Block cache: {self.block_cache.stats()}")
+        if self.mapped_files:
+            console_log(LogType.INFO, f"Mapped files: {self.mapped_files.stats()}")
+
+        console_log(LogType.INFO, f"File handles: {self.file_handles.stats()}")
+        console_log(LogType.INFO, f"Admission: {self.admission.stats()}")
+        console_log(LogType.INFO, f"Transmit: {self.get_transmit_stats()}")
+
+    def log_stats_periodically(self):
+        while not self.exit_signal.wait(STATS_INTERVAL):
+            self.log_stats()
+
     def shutdown_server(self):
         self.exit_signal.set()
+        self.digest_index.close()
+        self.compression_cache.close()
+        self.catalog.close()
+
+        self.log_stats()
+        self.block_cache.close() if self.block_cache else None
+        self.mapped_files.close() if self.mapped_files else None
+        self.file_handles.close()
 
         (
             self.watching_thread.join()
@@ -197,42 +696,147 @@ class BaseServer:
             else None
         )
 
-        if len(self.addresses) > 0:
+        # Sessions end and leave meanwhile, and one closed connection must
+        # not keep the others open
+        for conn, addr in list(self.addresses.items()):
+            console_log(LogType.INFO, f"Ensure closing connection from {addr}!")
             try:
-                for conn, addr in self.addresses.items():
-                    console_log(LogType.INFO, f"Ensure closing connection from {addr}!")
-                    self.send_status_signal(conn, "terminate")
-                    conn.close()
+                self.send_status_signal(conn, "terminate")
+                # Wakes the pool thread blocked reading from it
+                conn.shutdown(SHUT_RDWR)
             except SocketError:
                 pass
+            conn.close()
 
-            self.addresses.clear()
+        self.addresses.clear()
 
-        # self.server.shutdown(SHUT_RDWR) if not self.is_shutdown else None
+        # Wakes the accept loop, closing alone leaves it blocked
+        try:
+            self.server.shutdown(SHUT_RDWR)
+        except SocketError:
+            pass
         self.server.close()
         self.is_shutdown = True
         console_log(LogType.INFO, "Server stopped!")
 
+    # Catalog deltas and digests from the supervisor, see PreforkSupervisor
+    def follow_upstream(self):
+        try:
+            while not self.exit_signal.is_set():
+                kind, *message = self.upstream.recv()
+
+                if kind == "delta":
+                    self.catalog.apply_delta(*message)
+                elif kind == "digest":
+                    self.digest_index.put(*message)
+                elif kind == "digest_version":
+                    self.digest_index.follow(*message)
+        except (EOFError, OSError):
+            console_log(LogType.ERR, "Lost the supervisor, shutting down...")
+            self.exit_signal.set()
+
     def pipe_res_watching_thread(self):
         if self.watching_thread:
             return
 
+        Thread(target=self.log_stats_periodically, daemon=True).start()
+
+        if self.upstream:
+            self.watching_thread = Thread(target=self.follow_upstream, daemon=True)
+            self.watching_thread.start()
+            return
+
         self.watching_thread = Thread(
             target=start_watching,
-            args=(self.resources_path, self.exit_signal, self.updater["watching"]),
+            args=(
+                self.resources_path,
+                self.exit_signal,
+                self.updater["watching"],
+                self.catalog,
+            ),
             daemon=False,
         )
         self.watching_thread.start()
 
+        Thread(target=self.reconcile_resources, daemon=True).start()
+
 
 class Server(BaseServer):
     def __init__(self, **kwargs):
+        # Sessions run on a fixed pool, the connections past it wait their turn.
+        # Before the socket is bound, a failed bind shuts the pool down
+        self.workers = self.create_workers()
+        self.queue_lock = Lock()
+
         super().__init__(**kwargs)
 
+    def create_workers(self):
+        return ThreadPoolExecutor(max_workers=SERVER_WORKERS)
+
+    def reject_client(self, conn: socket, addr: str):
+        try:
+            self.send_status_signal(conn, "reject")
+            conn.close()
+        except SocketError:
+            pass
+
+        self.addresses.pop(conn, None)
+        self.client_log(LogType.ERR, addr, "Turned away, the server is full!")
+
+    def admit_client(self, conn: socket, addr: str):
+        with self.queue_lock:
+            position = self.admission.offer(conn)
+
+            if position is None:
+                self.reject_client(conn, addr)
+            elif position == 0:
+                self.workers.submit(self.serve_client, conn, addr)
+            else:
+                try:
+                    send_frame(conn, "status", self.get_busy_signal(position))
+                    self.client_log(
+                        LogType.INFO, addr, f"Waiting at {position} in queue"
+                    )
+                except SocketError:
+                    self.admission.release(conn)
+
+    def serve_client(self, conn: socket, addr: str):
+        try:
+            self.handle_client(conn, addr)
+        finally:
+            self.release_client(conn)
+
+    def release_client(self, conn: socket):
+        with self.queue_lock:
+            for admitted in self.admission.release(conn):
+                addr = self.addresses.get(admitted)
+
+                try:
+                    self.send_status_signal(admitted, "accept")
+                except SocketError:
+                    pass
+                self.workers.submit(self.serve_client, admitted, addr)
+
+            for waiting, position in self.admission.positions():
+                try:
+                    send_frame(waiting, "status", self.get_busy_signal(position))
+                except SocketError:
+                    self.admission.release(waiting)
+                    self.addresses.pop(waiting, None)
+                    waiting.close()
+
+    def shutdown_server(self):
+        super().shutdown_server()
+
+        if self.workers:
+            self.workers.shutdown(wait=False, cancel_futures=True)
+
     def start_server(self):
         try:
             self.server.listen(BACKLOG)
-            console_log(LogType.INFO, f"Server has started at {ADDR}")
+            console_log(
+                LogType.INFO, f"Server has started at {self.server.getsockname()}"
+            )
 
             while not self.exit_signal.is_set() and not self.is_shutdown:
                 if not self.server:
@@ -244,7 +848,7 @@ class Server(BaseServer):
                 if self.use_part1:
                     self.handle_client(conn, addr)
                 else:
-                    Thread(target=self.handle_client, args=(conn, addr)).start()
+                    self.admit_client(conn, addr)
         except SocketError:
             pass
         except Exception as e:
@@ -274,6 +878,389 @@ class Server(BaseServer):
             self.shutdown_server()
 
 
+class AsyncServer(Server):
+    def __init__(self, **kwargs):
+        self.loop: asyncio.AbstractEventLoop = None
+        self.async_server: asyncio.Server = None
+        self.part1_lock: asyncio.Lock = None
+
+        self.write_locks: dict[asyncio.StreamWriter, asyncio.Lock] = {}
+        self.wakeups: dict[asyncio.StreamWriter, asyncio.Event] = {}
+        # Connections waiting to send, resolved with whether they got their turn
+        self.admission_waiters: dict[asyncio.StreamWriter, asyncio.Future] = {}
+
+        super().__init__(**kwargs)
+
+    # Sessions are tasks on the loop, there is no pool of threads to run them
+    def create_workers(self):
+        return None
+
+    def create_transmit_scheduler(self):
+        return AsyncTransmitScheduler()
+
+    # Idle connections cost next to nothing here, only the ones with files to
+    # send are limited and queued
+    def create_admission(self):
+        return AdmissionController(workers=MAX_ACTIVE_TRANSFERS)
+
+    def send_status_signal(self, conn: asyncio.StreamWriter, signal: str):
+        data = encode_frame("status", STATUS_SIGNAL[signal])
+        conn.write(data)
+        return len(data)
+
+    def send_dat_signal(
+        self,
+        conn: asyncio.StreamWriter,
+        signal: str,
+        payload: bytes = b"",
+        stream_id: int = 0,
+    ):
+        data = encode_frame(signal, payload, stream_id)
+        conn.write(data)
+        return len(data)
+
+    async def write_frame(
+        self,
+        conn: asyncio.StreamWriter,
+        frame_type: str,
+        payload: bytes | str | dict = b"",
+        stream_id: int = 0,
+    ):
+        # Control frames must not land in the middle of a sendfile'd chunk
+        async with self.write_locks.setdefault(conn, asyncio.Lock()):
+            self.send_dat_signal(conn, frame_type, payload, stream_id)
+            await conn.drain()
+
+    async def send_resource_list(self, conn: asyncio.StreamWriter, args: str = ""):
+        await self.write_frame(conn, "list", self.get_resource_list_reply(args))
+
+    def notify_subscriber(self, conn: asyncio.StreamWriter):
+        if self.loop and (wakeup := self.wakeups.get(conn)):
+            self.loop.call_soon_threadsafe(wakeup.set)
+
+    async def handle_subscribe(self, conn: asyncio.StreamWriter, cmd: str):
+        if cmd == "subscribe":
+            await self.write_frame(conn, "delta", self.subscribe(conn))
+        else:
+            self.subscribers.pop(conn, None)
+            await self.write_frame(conn, "status", STATUS_SIGNAL["accept"])
+
+    async def flush_catalog_deltas(self, conn: asyncio.StreamWriter):
+        if not (pending := self.subscribers.get(conn)):
+            return
+
+        async with self.write_locks[conn]:
+            while pending:
+                self.send_dat_signal(conn, "delta", pending.popleft())
+            await conn.drain()
+
+    async def handle_file_request(self, conn: asyncio.StreamWriter, frame: Frame):
+        # Matching delta blocks and compressing are CPU bound, keep them off
+        # the event loop
+        prepared = await asyncio.to_thread(self.prepare_file_request, frame)
+
+        # Hold the writer so the range frame goes out before any of the data
+        async with self.write_locks[conn]:
+            file = self.add_file_request(conn, frame, prepared)
+
+            if not file:
+                self.send_dat_signal(
+                    conn, "error", "File is not available", stream_id=frame.stream_id
+                )
+            else:
+                self.send_dat_signal(
+                    conn, "range", self.get_range_payload(file), file.stream_id
+                )
+
+                if file.is_done():
+                    self.send_dat_signal(conn, "done", stream_id=frame.stream_id)
+
+            await conn.drain()
+
+        self.wakeups[conn].set()
+
+    async def send_files(self, conn: asyncio.StreamWriter):
+        try:
+            while not self.exit_signal.is_set() and not self.is_shutdown:
+                await self.flush_catalog_deltas(conn)
+
+                file = self.download_manager[conn].next_download()
+
+                if not file:
+                    self.transmit_scheduler.cancel(conn)
+                    await self.release_transfer(conn)
+                    self.wakeups[conn].clear()
+
+                    if not self.subscribers.get(conn):
+                        await self.wakeups[conn].wait()
+                    continue
+
+                if not await self.admit_transfer(conn, self.addresses.get(conn)):
+                    conn.close()
+                    return
+
+                await self.transmit_scheduler.acquire(
+                    conn,
+                    file.next_chunk_size(),
+                    self.get_transmit_share(conn, file.weight),
+                )
+
+                # The slot is given back once the chunk is in the transport,
+                # not once the client has read it. The next chunk is asked for
+                # after that, a client that stops reading is not granted one
+                held = True
+
+                def handoff(sent: int):
+                    nonlocal held
+                    if held:
+                        held = False
+                        self.transmit_scheduler.release(conn, sent, file.weight)
+
+                try:
+                    async with self.write_locks[conn]:
+                        await self.download_manager[conn].async_download(
+                            file.filename, conn, handoff
+                        )
+
+                        if file.is_done():
+                            self.send_dat_signal(conn, "done", stream_id=file.stream_id)
+                            await conn.drain()
+                finally:
+                    handoff(0)
+        except asyncio.CancelledError:
+            pass
+        except TimeoutError:
+            self.log_stalled(conn)
+            conn.close()
+        except Exception as e:
+            self.client_log(
+                LogType.ERR,
+                self.addresses.get(conn),
+                f"An error occurs when sending files::{e}",
+            )
+            conn.close()
+
+    async def accept_client(
+        self, reader: asyncio.StreamReader, conn: asyncio.StreamWriter
+    ):
+        self.addresses[conn] = conn.get_extra_info("peername")
+
+        if self.use_part1:
+            async with self.part1_lock:
+                await self.handle_client(reader, conn, self.addresses[conn])
+        else:
+            await self.handle_client(reader, conn, self.addresses[conn])
+
+    async def reject_client(self, conn: asyncio.StreamWriter, addr: str):
+        try:
+            await self.write_frame(conn, "status", STATUS_SIGNAL["reject"])
+        except SocketError:
+            pass
+
+        self.client_log(LogType.ERR, addr, "Turned away, too many transfers waiting!")
+
+    # Whether the connection may send now, after waiting its turn if needed.
+    # The slot is kept until it has nothing left to send
+    async def admit_transfer(self, conn: asyncio.StreamWriter, addr: str) -> bool:
+        if conn in self.admission:
+            return True
+
+        position = self.admission.offer(conn)
+
+        if position is None:
+            await self.reject_client(conn, addr)
+            return False
+        if position == 0:
+            return True
+
+        waiter = self.admission_waiters[conn] = self.loop.create_future()
+        try:
+            await self.write_frame(conn, "status", self.get_busy_signal(position))
+            self.client_log(LogType.INFO, addr, f"Waiting at {position} to send")
+
+            return await waiter
+        except SocketError:
+            await self.release_transfer(conn)
+            return False
+        finally:
+            self.admission_waiters.pop(conn, None)
+
+    async def release_transfer(self, conn: asyncio.StreamWriter):
+        if conn not in self.admission:
+            return
+
+        for admitted in self.admission.release(conn):
+            try:
+                await self.write_frame(admitted, "status", STATUS_SIGNAL["accept"])
+            except SocketError:
+                pass
+
+            if (waiter := self.admission_waiters.get(admitted)) and not waiter.done():
+                waiter.set_result(True)
+
+        for waiting, position in self.admission.positions():
+            try:
+                await self.write_frame(
+                    waiting, "status", self.get_busy_signal(position)
+                )
+            except SocketError:
+                self.admission.release(waiting)
+                if (
+                    waiter := self.admission_waiters.get(waiting)
+                ) and not waiter.done():
+                    waiter.set_result(False)
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, conn: asyncio.StreamWriter, addr: str
+    ):
+        sender: asyncio.Task = None
+
+        try:
+            if not conn or not addr:
+                return
+
+            self.client_log(LogType.INFO, addr, "Connection established!")
+
+            self.updater["client"]() if self.updater["client"] else None
+
+            self.download_manager[conn] = ServerDownloadManager(
+                files=[],
+                cache=self.block_cache,
+                maps=self.mapped_files,
+                handles=self.file_handles,
+            )
+            self.write_locks[conn] = asyncio.Lock()
+            self.wakeups[conn] = asyncio.Event()
+
+            sender = asyncio.create_task(self.send_files(conn))
+
+            while not self.exit_signal.is_set() and not self.is_shutdown:
+                frame = await read_frame(reader)
+
+                if self.is_closing_frame(frame):
+                    break
+
+                if frame.type == "file":
+                    await self.handle_file_request(conn, frame)
+                    continue
+
+                cmd, args = (
+                    parse_command(frame.text()) if frame.type == "cmd" else (None, "")
+                )
+
+                if cmd == "quit":
+                    await self.close_connection(conn, addr)
+                    break
+                elif cmd == "list":
+                    await self.send_resource_list(conn, args)
+                elif cmd in ["subscribe", "unsubscribe"]:
+                    await self.handle_subscribe(conn, cmd)
+                else:
+                    await self.write_frame(conn, "status", STATUS_SIGNAL["invalid"])
+        except SocketError:
+            await self.close_connection(conn, addr)
+        except Exception as e:
+            self.client_log(
+                LogType.ERR, addr, f"An error occurs when handling request::{e}"
+            )
+        finally:
+            if sender:
+                sender.cancel()
+                await asyncio.gather(sender, return_exceptions=True)
+            await self.release_transfer(conn)
+
+            self.client_log(LogType.INFO, addr, "Connection closed!")
+            self.subscribers.pop(conn, None)
+            self.remove_transmit_flow(conn, addr)
+            try:
+                conn.close()
+                self.write_locks.pop(conn, None)
+                self.wakeups.pop(conn, None)
+                self.download_manager.pop(conn).close()
+
+                del self.addresses[conn]
+                self.updater["client"]() if self.updater["client"] else None
+            except KeyError:
+                pass
+
+    async def close_connection(self, conn: asyncio.StreamWriter, addr: str):
+        try:
+            if not conn or not addr or conn not in self.addresses:
+                return
+
+            self.updater["client"]() if self.updater["client"] else None
+
+            await self.write_frame(conn, "status", STATUS_SIGNAL["terminate"])
+
+            conn.close()
+            await conn.wait_closed()
+
+            del self.addresses[conn]
+            self.updater["client"]() if self.updater["client"] else None
+        except SocketError:
+            self.client_log(LogType.ERR, addr, "Connection is lost!")
+        except Exception as e:
+            self.client_log(
+                LogType.ERR, addr, f"An error occurs when closing connection::{e}"
+            )
+        finally:
+            self.client_log(LogType.INFO, addr, "Connection closed!")
+
+    async def close_all_connections(self):
+        self.async_server.close() if self.async_server else None
+
+        for conn, addr in list(self.addresses.items()):
+            console_log(LogType.INFO, f"Ensure closing connection from {addr}!")
+            try:
+                self.send_status_signal(conn, "terminate")
+            except (SocketError, RuntimeError):
+                pass
+            conn.close()
+
+        self.addresses.clear()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.part1_lock = asyncio.Lock()
+
+        self.server.setblocking(False)
+        self.async_server = await asyncio.start_server(
+            self.accept_client, sock=self.server, backlog=BACKLOG
+        )
+        console_log(
+            LogType.INFO, f"Async server has started at {self.server.getsockname()}"
+        )
+
+        async with self.async_server:
+            while not self.exit_signal.is_set() and not self.is_shutdown:
+                await asyncio.sleep(0.5)
+
+    def start_server(self):
+        try:
+            asyncio.run(self.serve())
+        except SocketError:
+            pass
+        except Exception as e:
+            local_log(
+                LogType.ERR,
+                message=f"[start_server] - An error occurs when handling client: {e}",
+                path="server.log",
+            )
+
+    def shutdown_server(self):
+        self.exit_signal.set()
+
+        if self.loop and self.loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(
+                    self.close_all_connections(), self.loop
+                ).result(timeout=5)
+            except Exception:
+                pass
+
+        super().shutdown_server()
+
+
 class GUIServer(Server):
     def __init__(self, **kwargs):
         def updater(**kwargs):
@@ -381,7 +1368,7 @@ class GUIServer(Server):
         if self.exit_signal.is_set():
             return
 
-        self.resources = get_resource_list_data()
+        self.resources = self.catalog.data()
 
         self.component["resource-list"].configure(state="normal")
         self.component["resource-list"].delete("1.0", "end")
@@ -483,7 +1470,7 @@ class GUIServer(Server):
                         label=_label,
                         row=len(self.component["download-process"]) + 1,
                         col=0,
-                        progress_color=get_prior_color(file.chunk_sz // MAX_BUF_SIZE),
+                        progress_color=get_prior_color(file.weight),
                     )
 
                     self.component["download-process"][_label] = (
@@ -559,16 +1546,188 @@ class GUIServer(Server):
             self.threads["run"].join() if self.threads["run"].is_alive() else None
 
 
+class AsyncGUIServer(AsyncServer, GUIServer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+
+def run_worker(upstream, use_async: bool, use_part1: bool):
+    server = (AsyncServer if use_async else Server)(
+        use_part1=use_part1, upstream=upstream
+    )
+    server.run()
+
+
+# Pre-fork mode: N worker processes accept on ADDR with SO_REUSEPORT, the
+# kernel balancing the connections. The supervisor alone watches and indexes
+# the resources, every worker gets a snapshot of the catalog and the digests
+# when started, then each delta and new digest through its pipe. Workers that
+# die are started again, with a fresh snapshot
+class PreforkSupervisor:
+    def __init__(self, *, processes: int, use_async=False, use_part1=False):
+        self.processes = processes
+        self.args = (use_async, use_part1)
+        self.context = multiprocessing.get_context("spawn")
+
+        self.catalog = create_catalog()
+        self.catalog.load() or self.catalog.scan()
+        self.catalog.listeners.append(self.publish_catalog_delta)
+
+        self.digest_index = DigestIndex()
+        self.digest_index.listeners.append(self.publish_digest)
+
+        # Worker processes and their pipes by slot, the lock keeps every pipe
+        # in catalog order
+        self.lock = Lock()
+        self.workers: dict[int, tuple[multiprocessing.Process, object]] = {}
+        self.restarts: dict[int, float] = {}
+
+        self.exit_signal = Event()
+
+    def start_worker(self, slot: int):
+        upstream, pipe = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_worker, args=(upstream, *self.args), name=f"worker-{slot}"
+        )
+
+        with self.lock:
+            process.start()
+            upstream.close()
+
+            try:
+                self.send_snapshot(pipe)
+            except OSError:
+                pass
+            self.workers[slot] = process, pipe
+
+        console_log(LogType.INFO, f"Worker {slot} started (pid {process.pid})")
+
+    # In batches, the catalog is never held in memory at once. Workers of a
+    # SQLite catalog read the database itself and only get the version. The
+    # versions and epoch make up the listing ETag, the same in every worker
+    def send_snapshot(self, pipe, batch_size: int = 1000):
+        pipe.send(
+            (
+                "snapshot",
+                self.catalog.version,
+                self.catalog.epoch,
+                self.digest_index.version,
+            )
+        )
+
+        if not self.catalog.shared:
+            entries = self.catalog.iter_entries()
+            while batch := dict(islice(entries, batch_size)):
+                pipe.send(("entries", batch))
+
+        with self.digest_index.lock:
+            digests = iter(list(self.digest_index.entries.items()))
+        while batch := dict(islice(digests, batch_size)):
+            pipe.send(("digests", batch))
+
+        pipe.send(("ready",))
+
+    def broadcast(self, message: tuple):
+        with self.lock:
+            for process, pipe in self.workers.values():
+                try:
+                    pipe.send(message)
+                except OSError:
+                    pass
+
+    def publish_catalog_delta(self, delta: dict):
+        self.catalog.flush()
+        self.broadcast(("delta", delta))
+
+        # Workers do not hash, the new versions are hashed here
+        for filename, (_, path) in [*delta["added"].items(), *delta["changed"].items()]:
+            self.digest_index.get(filename, path)
+
+    def publish_digest(self, filename: str, entry: dict):
+        self.catalog.record_digest(filename, entry["blake2b"])
+        self.broadcast(("digest", filename, entry, self.digest_index.version))
+
+    def reconcile_resources(self):
+        if changes := self.catalog.reconcile():
+            console_log(LogType.INFO, f"{changes} resources changed while stopped")
+
+        self.digest_index.refresh(self.catalog.iter_entries())
+
+        # Entries of files gone while stopped are dropped without a digest
+        self.broadcast(("digest_version", self.digest_index.version))
+
+    # At most one restart a second per slot, a worker failing at startup does
+    # not spin the supervisor
+    def restart_workers(self):
+        for slot, (process, pipe) in list(self.workers.items()):
+            if process.is_alive() or monotonic() - self.restarts.get(slot, 0) < 1:
+                continue
+
+            console_log(
+                LogType.ERR, f"Worker {slot} exited ({process.exitcode}), restarting"
+            )
+            pipe.close()
+            self.restarts[slot] = monotonic()
+            self.start_worker(slot)
+
+    def run(self):
+        try:
+            Thread(
+                target=start_watching,
+                args=(
+                    SERVER_RESOURCES_PATH,
+                    self.exit_signal,
+                    update_resource_list,
+                    self.catalog,
+                ),
+                daemon=False,
+            ).start()
+            Thread(target=self.reconcile_resources, daemon=True).start()
+
+            for slot in range(self.processes):
+                self.start_worker(slot)
+
+            while not self.exit_signal.is_set():
+                sleep(0.5)
+                self.restart_workers()
+        except KeyboardInterrupt:
+            console_log(LogType.INFO, "Server is shutting down...")
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.exit_signal.set()
+
+        with self.lock:
+            for process, pipe in self.workers.values():
+                pipe.close()
+                process.terminate()
+            for process, _ in self.workers.values():
+                process.join(timeout=5)
+
+        self.digest_index.close()
+        self.catalog.close()
+        console_log(LogType.INFO, "Supervisor stopped!")
+
+
 if __name__ == "__main__":
     args = parse_args(
         prog="Socket Server",
         desc="A simple socket server for downloading files",
-        wrappers=[with_gui_arg, with_part1_arg, with_version_arg],
+        wrappers=[
+            with_gui_arg,
+            with_part1_arg,
+            with_async_arg,
+            with_processes_arg,
+            with_version_arg,
+        ],
     )
 
     use_gui = args.gui
     use_part1 = args.part1
+    use_async = args.use_async
     use_version = args.version
+    processes = args.processes
 
     if use_version:
         print(f"Socket Server v{VERSION}")
@@ -576,9 +1735,20 @@ if __name__ == "__main__":
 
     print("--part1 detected, using part1 version") if use_part1 else None
     print("--gui detected, using GUI version") if use_gui else None
+    print("--async detected, using asyncio version") if use_async else None
     print()
 
+    if processes > 1 and use_gui:
+        print("--processes is not supported with --gui, using one process")
+    elif processes > 1 and SO_REUSEPORT is None:
+        print("--processes needs SO_REUSEPORT, using one process")
+    elif processes > 1:
+        PreforkSupervisor(
+            processes=processes, use_async=use_async, use_part1=use_part1
+        ).run()
+        exit()
+
     if use_gui:
-        GUIServer(use_part1=use_part1).render()
+        (AsyncGUIServer if use_async else GUIServer)(use_part1=use_part1).render()
     else:
-        Server(use_part1=use_part1).run()
+        (AsyncServer if use_async else Server)(use_part1=use_part1).run()
@@ -11,12 +11,20 @@ COMMANDS = {
     },
     "list": {
         "alias": ["list", "l"],
-        "desc": "Get list of available files from server",
+        "desc": "Get list of available files, e.g. list *.jpg -size",
     },
     "file": {
         "alias": ["file", "f"],
         "desc": "Download files from server",
     },
+    "subscribe": {
+        "alias": ["subscribe", "sub"],
+        "desc": "Get resource changes pushed by server",
+    },
+    "unsubscribe": {
+        "alias": ["unsubscribe", "unsub"],
+        "desc": "Stop resource changes from server",
+    },
 }
 
 
@@ -27,6 +35,25 @@ def get_command(command: str):
     return None
 
 
+def parse_command(command: str) -> tuple[str | None, str]:
+    alias, _, args = command.strip().partition(" ")
+    return get_command(alias.lower()), args.strip()
+
+
+def parse_list_query(args: str) -> dict[str, str]:
+    query = {}
+
+    for arg in args.split():
+        if arg.lstrip("-") in ["name", "size"]:
+            query["sort"] = arg
+        elif any(c in arg for c in "*?["):
+            query["match"] = arg
+        else:
+            query["prefix"] = arg
+
+    return query
+
+
 def show_help():
     print()
     print_divider()
@@ -3,6 +3,9 @@ STATUS_SIGNAL = {
     "invalid": "[invalid]",
     "terminate": "[terminate]",
     "interrupt": "[interrupt]",
+    # Followed by the position in the queue
+    "busy": "[busy]",
+    "reject": "[reject]",
 }
 
 DAT_SIGNAL = {
@@ -12,6 +15,26 @@ DAT_SIGNAL = {
     "error": "ERROR",
 }
 
+FRAME_TYPE = {
+    "cmd": 0x01,
+    "status": 0x02,
+    "list": 0x03,
+    "file": 0x04,
+    "data": 0x05,
+    "done": 0x06,
+    "error": 0x07,
+    "range": 0x08,
+    "copy": 0x09,
+    "delta": 0x0A,
+}
+
+# Formats that are already compressed, never worth compressing again
+PRECOMPRESSED_EXTENSIONS = {
+    *[".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic"],
+    *[".mp3", ".aac", ".ogg", ".flac", ".mp4", ".mkv", ".avi", ".mov", ".webm"],
+    *[".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".jar"],
+}
+
 PRIOR_MAPPING = {
     "CRIT": 2**6,
     "HIGH": 2**4,
@@ -33,6 +56,18 @@ def get_prior_weight(prior: str) -> int:
     return PRIOR_MAPPING.get(prior, 1)
 
 
+# Weight asked for by a client, anything but a priority counts as NORM
+def get_request_weight(weight: int) -> int:
+    return weight if weight in PRIOR_MAPPING.values() and weight > 0 else 1
+
+
+def get_prior_share(weight: int, shares: dict[str, float] = {}) -> float:
+    for prior, sz in PRIOR_MAPPING.items():
+        if sz == weight and prior in shares:
+            return shares[prior]
+    return weight
+
+
 def get_prior_color(prior: str | int) -> str:
     _ = [*[p for (p, sz) in PRIOR_MAPPING.items() if sz == prior], "NORM"]
     return PRIOR_COLOR.get(prior if isinstance(prior, str) else _[0], "green")
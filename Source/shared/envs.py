@@ -4,6 +4,17 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def parse_shares(value: str | None) -> dict[str, float]:
+    shares: dict[str, float] = {}
+
+    for item in (value or "").split(","):
+        if ":" in item:
+            key, share = item.rsplit(":", 1)
+            shares[key.strip()] = float(share)
+
+    return shares
+
+
 VERSION = getenv("VERSION") or "no version info"
 
 # Socket config
@@ -13,6 +24,73 @@ ADDR = (HOST, PORT)
 
 BACKLOG = int(getenv("BACKLOG")) or 5
 MAX_BUF_SIZE = int(getenv("MAX_BUF_SIZE")) or 1024
+MAX_FRAME_SIZE = int(getenv("MAX_FRAME_SIZE") or 0) or 64 * 1024**2
+RECV_BUF_SIZE = int(getenv("RECV_BUF_SIZE") or 0) or 256 * 1024
+STREAM_CHUNK_SIZE = int(getenv("STREAM_CHUNK_SIZE") or 0) or 256 * 1024
+# Trailing bytes of a partial download compared against the server before resuming
+RESUME_CHECK_SIZE = int(getenv("RESUME_CHECK_SIZE") or 0) or 64 * 1024
+
+# Segmented downloads: connections per file, smallest segment, connections per server
+SEGMENT_CONNECTIONS = int(getenv("SEGMENT_CONNECTIONS") or 0) or 4
+SEGMENT_MIN_SIZE = int(getenv("SEGMENT_MIN_SIZE") or 0) or 16 * 1024**2
+SERVER_MAX_CONNECTIONS = int(getenv("SERVER_MAX_CONNECTIONS") or 0) or 8
+
+# Admission: connections served at once, and waiting for a turn before the next
+# ones are turned away
+SERVER_WORKERS = int(getenv("SERVER_WORKERS") or 0) or 32
+ADMISSION_QUEUE_SIZE = int(getenv("ADMISSION_QUEUE_SIZE") or 0) or 64
+# The asyncio server keeps every connection, it only limits the ones sending
+MAX_ACTIVE_TRANSFERS = int(getenv("MAX_ACTIVE_TRANSFERS") or 0) or 256
+
+# Digest index: size of the verified chunks and hashing threads
+DIGEST_CHUNK_SIZE = int(getenv("DIGEST_CHUNK_SIZE") or 0) or 4 * 1024**2
+DIGEST_WORKERS = int(getenv("DIGEST_WORKERS") or 0) or 2
+
+# Filesystem watcher: seconds a path must stay quiet and size-stable before publishing
+WATCH_DEBOUNCE = float(getenv("WATCH_DEBOUNCE") or 0) or 0.5
+# Most entries in one LIST page
+LIST_PAGE_SIZE = int(getenv("LIST_PAGE_SIZE") or 0) or 1000
+# Catalog deltas queued per subscriber, a slow one misses older deltas and resyncs
+SUBSCRIBE_QUEUE_SIZE = int(getenv("SUBSCRIBE_QUEUE_SIZE") or 0) or 64
+
+# Delta transfer: smallest block and most blocks in a signature list
+DELTA_BLOCK_SIZE = int(getenv("DELTA_BLOCK_SIZE") or 0) or 64 * 1024
+DELTA_MAX_BLOCKS = int(getenv("DELTA_MAX_BLOCKS") or 0) or 64 * 1024
+
+# Compression: codecs in order of preference, largest sampled ratio worth it
+COMPRESS_CODECS = [
+    c.strip() for c in (getenv("COMPRESS_CODECS") or "zlib,lzma,bz2").split(",")
+]
+COMPRESS_MAX_RATIO = float(getenv("COMPRESS_MAX_RATIO") or 0) or 0.9
+COMPRESS_MIN_SIZE = int(getenv("COMPRESS_MIN_SIZE") or 0) or 64 * 1024
+COMPRESS_WORKERS = int(getenv("COMPRESS_WORKERS") or 0) or 2
+
+# Transmit scheduling, e.g. CLIENT_SHARES="127.0.0.1:2,*:1" PRIOR_SHARES="CRIT:8"
+TRANSMIT_SLOTS = int(getenv("TRANSMIT_SLOTS") or 0) or 8
+# Seconds a client may stop reading in the middle of a chunk before it is dropped
+TRANSMIT_TIMEOUT = float(getenv("TRANSMIT_TIMEOUT") or 0) or 30
+CLIENT_SHARES = parse_shares(getenv("CLIENT_SHARES"))
+PRIOR_SHARES = parse_shares(getenv("PRIOR_SHARES"))
+# Seconds between two logs of the server stats, they are logged on shutdown too
+STATS_INTERVAL = float(getenv("STATS_INTERVAL") or 0) or 60
+
+# Shared block cache of the served files, 0 sends straight from disk with sendfile.
+# Eviction is "2q" (a big cold download does not flush hot files) or "lru"
+BLOCK_CACHE_SIZE = int(getenv("BLOCK_CACHE_SIZE") or 64 * 1024**2)
+BLOCK_CACHE_BLOCK = int(getenv("BLOCK_CACHE_BLOCK") or 0) or 256 * 1024
+BLOCK_CACHE_POLICY = getenv("BLOCK_CACHE_POLICY") or "2q"
+# Read-ahead: chunks read in advance per download (0 disables), reading threads
+# and most bytes being read ahead at once over all downloads
+PREFETCH_CHUNKS = int(getenv("PREFETCH_CHUNKS") or 4)
+PREFETCH_WORKERS = int(getenv("PREFETCH_WORKERS") or 0) or 4
+PREFETCH_MAX_SIZE = int(getenv("PREFETCH_MAX_SIZE") or 0) or 16 * 1024**2
+# Open resource handles kept around for the next download, shared by all of them
+FILE_HANDLE_BUDGET = int(getenv("FILE_HANDLE_BUDGET") or 0) or 256
+# How chunks are read: "cache" (the block cache), "mmap" or "sendfile". mmap maps
+# each file once for all connections, files must not be truncated while mapped
+SERVER_READER = getenv("SERVER_READER") or "cache"
+# Seconds an unused map is kept
+MMAP_IDLE_TIMEOUT = float(getenv("MMAP_IDLE_TIMEOUT") or 0) or 30
 
 SEPARATOR = getenv("SEPARATOR") or "<SEPARATOR>"
 ENCODING_FORMAT = "utf8"
@@ -24,6 +102,12 @@ SERVER_DIR_PATH = path.join(APP_ROOT_PATH, "server")
 SERVER_RESOURCES_PATH = getenv("SERVER_RESOURCES_PATH") or path.join(
     SERVER_DIR_PATH, "resources"
 )
+SERVER_CACHE_PATH = getenv("SERVER_CACHE_PATH") or path.join(SERVER_DIR_PATH, "cache")
+# Resource catalog backend: "json" (top level, in memory) or "sqlite" (recursive)
+RESOURCE_INDEX = getenv("RESOURCE_INDEX") or "json"
+SERVER_INDEX_PATH = getenv("SERVER_INDEX_PATH") or path.join(
+    SERVER_DIR_PATH, "resources.db"
+)
 
 CLIENT_DIR_PATH = path.join(APP_ROOT_PATH, "client")
 CLIENT_DOWNLOADS_PATH = getenv("CLIENT_DOWNLOADS_PATH") or path.join(
@@ -32,3 +116,6 @@ CLIENT_DOWNLOADS_PATH = getenv("CLIENT_DOWNLOADS_PATH") or path.join(
 CLIENT_REQUEST_INPUT = getenv("CLIENT_REQUEST_INPUT") or path.join(
     CLIENT_DIR_PATH, "input.txt"
 )
+CLIENT_CATALOG_CACHE = getenv("CLIENT_CATALOG_CACHE") or path.join(
+    CLIENT_DIR_PATH, "catalog.json"
+)
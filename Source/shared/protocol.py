@@ -0,0 +1,140 @@
+import json, asyncio, selectors
+from struct import Struct
+from socket import socket
+from collections import deque
+
+from shared.envs import ENCODING_FORMAT, MAX_FRAME_SIZE, RECV_BUF_SIZE
+from shared.constants import FRAME_TYPE
+
+PROTOCOL_VERSION = 1
+
+# version (1B) | frame type (1B) | stream id (4B) | payload length (4B)
+FRAME_HEADER = Struct("!BBII")
+
+FRAME_NAME = {code: name for name, code in FRAME_TYPE.items()}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Frame:
+    def __init__(self, frame_type: str, stream_id: int = 0, payload: bytes = b""):
+        self.type = frame_type
+        self.stream_id = stream_id
+        self.payload = payload
+
+    def text(self) -> str:
+        return self.payload.decode(ENCODING_FORMAT)
+
+    def json(self):
+        return json.loads(self.payload.decode(ENCODING_FORMAT) or "null")
+
+    def __repr__(self) -> str:
+        return f"Frame({self.type}, stream={self.stream_id}, {len(self.payload)}B)"
+
+
+def encode_payload(payload: bytes | str | dict | list) -> bytes:
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode(ENCODING_FORMAT)
+    return json.dumps(payload, separators=(",", ":")).encode(ENCODING_FORMAT)
+
+
+def encode_header(frame_type: str, length: int, stream_id: int = 0) -> bytes:
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length}B exceeds {MAX_FRAME_SIZE}B")
+
+    return FRAME_HEADER.pack(
+        PROTOCOL_VERSION, FRAME_TYPE[frame_type], stream_id, length
+    )
+
+
+def encode_frame(
+    frame_type: str, payload: bytes | str | dict | list = b"", stream_id: int = 0
+) -> bytes:
+    data = encode_payload(payload)
+    return encode_header(frame_type, len(data), stream_id) + data
+
+
+def decode_header(header: bytes) -> tuple[str, int, int]:
+    version, code, stream_id, length = FRAME_HEADER.unpack(header)
+
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version: {version}")
+    if code not in FRAME_NAME:
+        raise ProtocolError(f"Unknown frame type: {code}")
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length}B exceeds {MAX_FRAME_SIZE}B")
+
+    return FRAME_NAME[code], stream_id, length
+
+
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames: deque[Frame] = deque()
+
+    def feed(self, data: bytes):
+        self.buffer += data
+
+        while len(self.buffer) >= FRAME_HEADER.size:
+            frame_type, stream_id, length = decode_header(
+                self.buffer[: FRAME_HEADER.size]
+            )
+
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+
+            self.frames.append(
+                Frame(
+                    frame_type, stream_id, bytes(self.buffer[FRAME_HEADER.size : end])
+                )
+            )
+            del self.buffer[:end]
+
+    def next_frame(self) -> Frame | None:
+        return self.frames.popleft() if self.frames else None
+
+
+def send_frame(
+    conn: socket,
+    frame_type: str,
+    payload: bytes | str | dict | list = b"",
+    stream_id: int = 0,
+) -> int:
+    data = encode_frame(frame_type, payload, stream_id)
+    conn.sendall(data)
+
+    return len(data)
+
+
+# Unlike select.select, not limited to descriptors below FD_SETSIZE
+def wait_ready(conn: socket, events: int, timeout: float | None) -> bool:
+    selector = getattr(selectors, "PollSelector", selectors.SelectSelector)()
+
+    with selector:
+        selector.register(conn, events)
+        return bool(selector.select(timeout))
+
+
+def recv_frame(conn: socket, decoder: FrameDecoder) -> Frame | None:
+    while not (frame := decoder.next_frame()):
+        data = conn.recv(RECV_BUF_SIZE)
+        if not data:
+            return None
+        decoder.feed(data)
+
+    return frame
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Frame | None:
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        frame_type, stream_id, length = decode_header(header)
+
+        return Frame(frame_type, stream_id, await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        return None
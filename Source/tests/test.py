@@ -1,12 +1,75 @@
-import sys
+import os, sys, json, errno, asyncio
+from time import sleep, monotonic
+from random import Random
+from threading import Thread, Event
+from socket import (
+    socket,
+    socketpair,
+    create_connection,
+    SOL_SOCKET,
+    SO_RCVBUF,
+    SO_SNDBUF,
+    SHUT_RDWR,
+)
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest import TestCase, TestSuite, TestLoader, TextTestRunner
+from unittest.mock import patch
 
-sys.path.append("..")
+# Absolute, the spawned server processes start in the temporary folders
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from shared.envs import MAX_BUF_SIZE
-from shared.constants import PRIOR_MAPPING, get_prior_weight, get_prior_color
-from shared.command import get_command
-from utils.files import convert_file_size, extract_download_input
+from shared.envs import (
+    MAX_BUF_SIZE,
+    STREAM_CHUNK_SIZE,
+    DELTA_BLOCK_SIZE,
+    DELTA_MAX_BLOCKS,
+)
+from shared.constants import (
+    PRIOR_MAPPING,
+    get_prior_weight,
+    get_prior_color,
+    get_prior_share,
+    get_request_weight,
+)
+from shared.command import get_command, parse_command, parse_list_query
+from shared.protocol import (
+    FRAME_HEADER,
+    PROTOCOL_VERSION,
+    ProtocolError,
+    FrameDecoder,
+    encode_frame,
+    send_frame,
+    recv_frame,
+)
+from utils.files import (
+    convert_file_size,
+    extract_download_input,
+    get_tail_digest,
+    get_file_digest,
+    get_file_digests,
+    is_same_file,
+)
+from classes.scheduler import WeightedScheduler, AsyncTransmitScheduler
+from classes.download_manager import ClientFileDownloader, ServerFileDownloader
+from classes.digest_index import DigestIndex
+from utils.delta import (
+    get_weak_checksum,
+    get_strong_checksum,
+    get_block_signatures,
+    check_delta_request,
+    compute_delta,
+)
+from utils.compression import new_decompressor, is_precompressed
+from classes.compression_cache import CompressionCache
+from classes.resource_catalog import ResourceCatalog
+from classes.sqlite_catalog import SQLiteResourceCatalog
+from classes.monitor_filesys import EventDebouncer
+from classes.block_cache import BlockCache
+from classes.mapped_files import MappedFiles
+from classes.file_handles import FileHandles
+from classes.admission import AdmissionController
+from server import Server, AsyncServer, PreforkSupervisor
+from client import BaseClient
 
 
 class UtilsTest(TestCase):
@@ -18,6 +81,14 @@ class UtilsTest(TestCase):
 
         self.assertEqual(get_prior_weight("UNKNOWN"), 1)
 
+    def test_get_request_weight(self):
+        self.assertEqual(get_request_weight(2**6), 2**6)
+        self.assertEqual(get_request_weight(2**4), 2**4)
+
+        # A client cannot take more than the highest priority
+        for weight in [10**9, 3, 0, -1]:
+            self.assertEqual(get_request_weight(weight), 1)
+
     def test_get_prior_color(self):
         self.assertEqual(get_prior_color("CRIT"), "red")
         self.assertEqual(get_prior_color("HIGH"), "orange")
@@ -49,6 +120,36 @@ class UtilsTest(TestCase):
 
         self.assertEqual(convert_file_size(1024**4), "1024.00GB")
 
+    def test_get_tail_digest(self):
+        with NamedTemporaryFile() as a, NamedTemporaryFile() as b:
+            a.write(b"x" * 10 + b"tail")
+            b.write(b"y" * 10 + b"tail")
+            a.flush()
+            b.flush()
+
+            self.assertEqual(
+                get_tail_digest(a.name, 14, 4), get_tail_digest(b.name, 14, 4)
+            )
+            self.assertNotEqual(
+                get_tail_digest(a.name, 14), get_tail_digest(b.name, 14)
+            )
+            self.assertNotEqual(
+                get_tail_digest(a.name, 10), get_tail_digest(a.name, 14)
+            )
+
+    def test_is_same_file(self):
+        with TemporaryDirectory() as folder:
+            path = f"{folder}/empty.txt"
+            digest = "0e5751c026e543b2e8ab2eb06099daa1d1e5df47778f7787faab45cdf12fe3a8"
+
+            # An empty resource that was never downloaded is not up to date
+            self.assertFalse(is_same_file(path, 0, digest))
+
+            open(path, "wb").close()
+            self.assertEqual(get_file_digest(path), digest)
+            self.assertTrue(is_same_file(path, 0, digest))
+            self.assertFalse(is_same_file(path, 1, digest))
+
     def test_extract_download_input(self):
         self.assertEqual(extract_download_input(""), ("", MAX_BUF_SIZE))
         self.assertEqual(
@@ -108,11 +209,1561 @@ class SharedTest(TestCase):
 
         self.assertEqual(get_command("unknown"), None)
 
+    def test_parse_list_query(self):
+        self.assertEqual(parse_command("L *.jpg -size"), ("list", "*.jpg -size"))
+        self.assertEqual(parse_command("list"), ("list", ""))
+
+        self.assertEqual(
+            parse_list_query("*.jpg -size"), {"match": "*.jpg", "sort": "-size"}
+        )
+        self.assertEqual(
+            parse_list_query("rose name"), {"prefix": "rose", "sort": "name"}
+        )
+
+
+class ProtocolTest(TestCase):
+    def test_encode_frame(self):
+        frame = encode_frame("data", b"abc", 7)
+
+        self.assertEqual(len(frame), FRAME_HEADER.size + 3)
+        self.assertEqual(FRAME_HEADER.unpack(frame[: FRAME_HEADER.size])[0], 1)
+        self.assertEqual(frame[FRAME_HEADER.size :], b"abc")
+
+    def test_decode_coalesced_frames(self):
+        decoder = FrameDecoder()
+        decoder.feed(
+            encode_frame("cmd", "list")
+            + encode_frame("list", {"a.txt": 12})
+            + encode_frame("data", b"", 3)
+        )
+
+        frame = decoder.next_frame()
+        self.assertEqual((frame.type, frame.text()), ("cmd", "list"))
+
+        frame = decoder.next_frame()
+        self.assertEqual((frame.type, frame.json()), ("list", {"a.txt": 12}))
+
+        frame = decoder.next_frame()
+        self.assertEqual((frame.type, frame.stream_id, frame.payload), ("data", 3, b""))
+
+        self.assertIsNone(decoder.next_frame())
+
+    def test_decode_fragmented_frame(self):
+        decoder = FrameDecoder()
+        data = encode_frame("data", bytes(range(256)) * 64, 2)
+
+        for i in range(0, len(data), 1000):
+            self.assertIsNone(decoder.next_frame())
+            decoder.feed(data[i : i + 1000])
+
+        frame = decoder.next_frame()
+        self.assertEqual(frame.stream_id, 2)
+        self.assertEqual(frame.payload, bytes(range(256)) * 64)
+
+    def test_decode_invalid_frame(self):
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(FRAME_HEADER.pack(PROTOCOL_VERSION + 1, 1, 0, 0))
+
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(FRAME_HEADER.pack(PROTOCOL_VERSION, 0xFF, 0, 0))
+
+
+class SchedulerTest(TestCase):
+    def serve(self, scheduler, rounds: int, size: int = 1024):
+        served: dict[str, int] = {}
+        for _ in range(rounds):
+            key = scheduler.next()
+            scheduler.charge(key, size)
+            served[key] = served.get(key, 0) + size
+        return served
+
+    def test_weighted_shares(self):
+        scheduler = WeightedScheduler()
+        scheduler.add("crit", 64)
+        scheduler.add("midd", 4)
+        scheduler.add("norm", 1)
+
+        served = self.serve(scheduler, 69 * 10)
+        self.assertEqual(
+            served, {"crit": 640 * 1024, "midd": 40 * 1024, "norm": 10 * 1024}
+        )
+
+    def test_new_key_does_not_burst(self):
+        scheduler = WeightedScheduler()
+        scheduler.add("a", 1)
+        self.serve(scheduler, 100)
+
+        scheduler.add("b", 1)
+        served = self.serve(scheduler, 10)
+        self.assertEqual(served, {"a": 5 * 1024, "b": 5 * 1024})
+
+    def test_remove(self):
+        scheduler = WeightedScheduler()
+        self.assertIsNone(scheduler.next())
+
+        scheduler.add("a", 1)
+        scheduler.remove("a")
+        self.assertIsNone(scheduler.next())
+        self.assertEqual(len(scheduler), 0)
+
+
+class TransmitSchedulerTest(TestCase):
+    def transmit(self, scheduler, shares: dict[str, float], rounds: int):
+        async def flow(key: str):
+            for i in range(rounds, 0, -1):
+                await scheduler.acquire(key, 1024, shares[key])
+                await asyncio.sleep(0)
+                scheduler.release(key, 1024, shares[key], 1024 if i > 1 else 0)
+
+        async def main():
+            await asyncio.wait(
+                [asyncio.create_task(flow(key)) for key in shares],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            return scheduler.stats()
+
+        return asyncio.run(main())
+
+    def test_client_shares(self):
+        stats = self.transmit(AsyncTransmitScheduler(slots=1), {"a": 3, "b": 1}, 90)
+
+        self.assertEqual(stats["served"]["a"], 90 * 1024)
+        self.assertAlmostEqual(stats["served"]["b"], 30 * 1024, delta=2 * 1024)
+        self.assertEqual(stats["in_flight"], 1)
+
+    def test_slots(self):
+        stats = self.transmit(AsyncTransmitScheduler(slots=2), {"a": 3, "b": 1}, 30)
+
+        self.assertEqual(stats["served"], {"a": 30 * 1024, "b": 30 * 1024})
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_prior_share(self):
+        self.assertEqual(get_prior_share(PRIOR_MAPPING["CRIT"]), 64)
+        self.assertEqual(get_prior_share(PRIOR_MAPPING["CRIT"], {"CRIT": 8}), 8)
+        self.assertEqual(get_prior_share(PRIOR_MAPPING["NORM"], {"CRIT": 8}), 1)
+
+
+class SegmentTest(TestCase):
+    def test_split_and_assemble(self):
+        data = bytes(range(256)) * 40
+
+        with TemporaryDirectory() as folder:
+            file = ClientFileDownloader(
+                filename=f"{folder}/file", chunk_sz=1024, tot=len(data), stream_id=1
+            )
+            segments = file.split([1, 2, 3])
+
+            self.assertEqual(
+                [(end - start) for _, start, end in segments], [3414, 3414, 3412]
+            )
+
+            for stream_id, start, end in reversed(segments):
+                for pos in range(start, end, 1000):
+                    file.download(data[pos : min(pos + 1000, end)], stream_id)
+
+            self.assertTrue(file.is_done())
+            with open(f"{folder}/file", "rb") as f:
+                self.assertEqual(f.read(), data)
+
+
+class DigestTest(TestCase):
+    def test_index_cache(self):
+        with TemporaryDirectory() as folder:
+            path = f"{folder}/file"
+            with open(path, "wb") as f:
+                f.write(b"x" * 100)
+
+            index = DigestIndex(path=f"{folder}/digests.json", workers=1)
+            index.compute("file", path)
+
+            digests = index.get("file", path, 1)
+            self.assertEqual(digests, get_file_digests(path))
+
+            # Written in the background, and on close at the latest
+            index.close()
+            self.assertEqual(
+                DigestIndex(path=f"{folder}/digests.json", workers=0).entries,
+                index.entries,
+            )
+
+            with open(path, "ab") as f:
+                f.write(b"y")
+
+            # The file is only checked again once the catalog changed
+            self.assertEqual(index.get("file", path, 1), digests)
+            self.assertIsNone(index.get("file", path, 2))
+            self.assertIsNone(index.get("file", path))
+
+    def test_follow_versions(self):
+        follower = DigestIndex(path=os.devnull, workers=0)
+
+        # Followers take the version of the index the digests come from,
+        # whatever order they arrive in
+        follower.put("a", {"blake2b": "a"}, 7)
+        follower.put("b", {"blake2b": "b"}, 5)
+        follower.follow(6)
+        self.assertEqual(follower.version, 7)
+
+        follower.put("c", {"blake2b": "c"})
+        self.assertEqual(follower.version, 8)
+
+    def test_verify_chunks(self):
+        data = bytes(range(256)) * 40
+
+        with TemporaryDirectory() as folder:
+            with open(f"{folder}/source", "wb") as f:
+                f.write(data)
+
+            file = ClientFileDownloader(
+                filename=f"{folder}/file", chunk_sz=1024, tot=len(data), stream_id=1
+            )
+            file.expect_digests(get_file_digests(f"{folder}/source", 1000))
+
+            segments = file.split([1, 2], 1000)
+            self.assertEqual([start for _, start, _ in segments], [0, 6000])
+
+            corrupted = data[:2500] + b"?" + data[2501:]
+            for stream_id, start, end in segments:
+                for pos in range(start, end, 700):
+                    file.download(corrupted[pos : min(pos + 700, end)], stream_id)
+
+            self.assertTrue(file.is_done())
+            self.assertEqual(file.corrupted, {2})
+
+
+class DeltaTest(TestCase):
+    def delta(self, old: bytes, new: bytes, block_size: int):
+        with TemporaryDirectory() as folder:
+            for name, data in [("old", old), ("new", new)]:
+                with open(f"{folder}/{name}", "wb") as f:
+                    f.write(data)
+
+            blocks = get_block_signatures(f"{folder}/old", block_size)
+            copies = compute_delta(f"{folder}/new", block_size, blocks)
+
+        result, pos = b"", 0
+        for offset, copy in copies.items():
+            result += new[pos:offset]
+            start = copy["block"] * block_size
+            result += old[start : start + copy["size"]]
+            pos = offset + copy["size"]
+
+        self.assertEqual(result + new[pos:], new)
+        return copies
+
+    def test_weak_checksum(self):
+        self.assertEqual(get_weak_checksum(b""), 0)
+        self.assertEqual(get_weak_checksum(b"\x01\x02"), 3 | 4 << 16)
+
+    def test_shifted_blocks(self):
+        old = Random(0).randbytes(16384)
+        new = b"head" + old[:4096] + b"changed" + old[4096:]
+
+        copies = self.delta(old, new, 1024)
+        self.assertEqual(
+            copies,
+            {
+                4: {"block": 0, "count": 4, "size": 4096},
+                4107: {"block": 4, "count": 12, "size": 12288},
+            },
+        )
+
+    def test_unrelated_files(self):
+        self.assertEqual(self.delta(b"a" * 4096, b"b" * 4096, 1024), {})
+
+    def test_invalid_requests(self):
+        block = [get_weak_checksum(b"x"), get_strong_checksum(b"x")]
+        size = DELTA_BLOCK_SIZE * 4
+
+        check_delta_request(DELTA_BLOCK_SIZE, [block], size)
+        for block_size, blocks in [
+            # An empty block never moves the scan forward
+            (0, [[0, get_strong_checksum(b"")]]),
+            (-1, [block]),
+            (DELTA_BLOCK_SIZE - 1, [block]),
+            (size + 1, [block]),
+            (str(DELTA_BLOCK_SIZE), [block]),
+            (DELTA_BLOCK_SIZE, [block] * (DELTA_MAX_BLOCKS + 1)),
+            (DELTA_BLOCK_SIZE, {"0": block}),
+            (DELTA_BLOCK_SIZE, [block[:1]]),
+            (DELTA_BLOCK_SIZE, [[-1, block[1]]]),
+            (DELTA_BLOCK_SIZE, [[1 << 32, block[1]]]),
+            (DELTA_BLOCK_SIZE, [[block[0], "abc"]]),
+            (DELTA_BLOCK_SIZE, [[block[0], 0]]),
+        ]:
+            with self.subTest(block_size=block_size):
+                self.assertRaises(
+                    ValueError, check_delta_request, block_size, blocks, size
+                )
+
+
+class CompressionTest(TestCase):
+    def test_is_precompressed(self):
+        self.assertTrue(is_precompressed("photo.JPG"))
+        self.assertTrue(is_precompressed("archive.tar.gz"))
+        self.assertFalse(is_precompressed("data.csv"))
+
+    def test_variants(self):
+        data = b"id,name,value\n" + b"".join(
+            f"{i},row{i % 7},{i * 3}\n".encode() for i in range(20000)
+        )
+
+        with TemporaryDirectory() as folder:
+            path = f"{folder}/data.csv"
+            with open(path, "wb") as f:
+                f.write(data)
+
+            cache = CompressionCache(path=f"{folder}/cache", workers=0)
+            self.assertEqual(cache.choose("data.csv", path, ["bz2", "zlib"]), "zlib")
+            self.assertIsNone(cache.choose("data.csv", path, []))
+
+            for codec in ["zlib", "bz2", "lzma"]:
+                variant, cpu = cache.get_variant("data.csv", path, codec)
+                self.assertGreater(cpu, 0)
+                self.assertEqual(cache.get_variant("data.csv", path, codec)[1], 0)
+
+                with open(variant, "rb") as f:
+                    self.assertEqual(new_decompressor(codec).decompress(f.read()), data)
+
+            with open(path, "ab") as f:
+                f.write(b"0,changed,0\n")
+
+            cache.get_variant("data.csv", path, "zlib")
+            self.assertEqual(len(os.listdir(f"{folder}/cache")), 1)
+
+    def test_variant_gone(self):
+        with TemporaryDirectory() as folder:
+            path = f"{folder}/data.csv"
+            with open(path, "wb") as f:
+                f.write(b"0,row,0\n" * 100)
+
+            file = ServerFileDownloader(
+                filename="data.csv", chunk_sz=4096, tot=800, path=path
+            )
+
+            # Removed between the lookup and the open, the file is kept
+            self.assertRaises(
+                OSError, file.use_variant, f"{folder}/data.csv.zlib", "zlib"
+            )
+            self.assertIsNone(file.codec)
+            self.assertEqual(file.read_chunk(8), b"0,row,0\n")
+            file.close()
+
+    def test_background_build(self):
+        with TemporaryDirectory() as folder:
+            path = f"{folder}/data.csv"
+            with open(path, "wb") as f:
+                f.write(b"0,row,0\n" * 20000)
+
+            # The file is sent as is until its variant is ready
+            cache = CompressionCache(path=f"{folder}/cache", workers=1)
+            self.assertIsNone(cache.get_variant("data.csv", path, "zlib"))
+            cache.pool.shutdown(wait=True)
+
+            self.assertEqual(cache.pending, set())
+            variant, cpu = cache.get_variant("data.csv", path, "zlib")
+            self.assertGreater(cpu, 0)
+            self.assertEqual(cache.get_variant("data.csv", path, "zlib"), (variant, 0))
+            cache.close()
+
+
+class CatalogTest(TestCase):
+    def test_apply_events(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(f"{root}/sub")
+            with open(f"{root}/a.txt", "w") as f:
+                f.write("a")
+
+            catalog = ResourceCatalog(
+                root=root, path=f"{folder}/resources.json", interval=0.01
+            )
+            catalog.scan()
+            self.assertEqual(catalog.data(), {"a.txt": (1, f"{root}/a.txt")})
+
+            with open(f"{root}/b.txt", "w") as f:
+                f.write("bb")
+            catalog.apply("created", f"{root}/b.txt")
+            catalog.apply("created", f"{root}/sub")
+            self.assertEqual(catalog.get("b.txt"), (2, f"{root}/b.txt"))
+
+            os.rename(f"{root}/b.txt", f"{root}/c.txt")
+            catalog.apply("moved", f"{root}/b.txt", f"{root}/c.txt")
+            os.remove(f"{root}/a.txt")
+            catalog.apply("deleted", f"{root}/a.txt")
+
+            self.assertEqual(catalog.data(), {"c.txt": (2, f"{root}/c.txt")})
+
+            catalog.close()
+            with open(f"{folder}/resources.json") as f:
+                self.assertEqual(json.load(f)["files"], {"c.txt": [2, f"{root}/c.txt"]})
+
+    def test_reconcile_snapshot(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(root)
+            for name in ["a.txt", "b.txt"]:
+                with open(f"{root}/{name}", "w") as f:
+                    f.write(name)
+
+            catalog = ResourceCatalog(root=root, path=f"{folder}/resources.json")
+            catalog.scan()
+            catalog.close()
+
+            os.remove(f"{root}/a.txt")
+            with open(f"{root}/c.txt", "w") as f:
+                f.write("c")
+
+            catalog = ResourceCatalog(root=root, path=f"{folder}/resources.json")
+            self.assertTrue(catalog.load())
+            self.assertEqual(sorted(catalog.data()), ["a.txt", "b.txt"])
+
+            deltas = []
+            catalog.listeners.append(deltas.append)
+
+            self.assertEqual(catalog.reconcile(), 2)
+            self.assertEqual(sorted(catalog.data()), ["b.txt", "c.txt"])
+            self.assertEqual(deltas[0]["removed"], ["a.txt"])
+            self.assertEqual(list(deltas[0]["added"]), ["c.txt"])
+
+            # The folder did not change since, nothing is listed again
+            self.assertEqual(catalog.reconcile(), 0)
+            catalog.close()
+
+    def test_follow_deltas(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(root)
+            with open(f"{root}/a.txt", "w") as f:
+                f.write("a")
+
+            catalog = ResourceCatalog(root=root, path=f"{folder}/resources.json")
+            catalog.scan()
+
+            deltas = []
+            catalog.listeners.append(deltas.append)
+            follower = ResourceCatalog(root=root, path=None)
+            follower.load_snapshot(catalog.version, catalog.data(), catalog.epoch)
+
+            with open(f"{root}/b.txt", "w") as f:
+                f.write("b")
+            catalog.apply_changes([("created", f"{root}/b.txt")])
+            os.remove(f"{root}/a.txt")
+            catalog.apply_changes([("deleted", f"{root}/a.txt")])
+
+            for delta in deltas:
+                follower.apply_delta(delta)
+            self.assertEqual(follower.data(), catalog.data())
+            self.assertEqual(follower.version, catalog.version)
+            self.assertEqual(follower.etag(3), catalog.etag(3))
+
+            # Deltas already in the snapshot are not applied again
+            follower.load_snapshot(catalog.version, catalog.data())
+            follower.apply_delta(deltas[0])
+            self.assertEqual(sorted(follower.data()), ["b.txt"])
+
+            follower.close()
+            catalog.close()
+
+    def test_concurrent_changes(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(root)
+            for i in range(200):
+                with open(f"{root}/{i}.txt", "w") as f:
+                    f.write(str(i))
+
+            catalog = ResourceCatalog(root=root, path=None)
+            deltas = []
+            catalog.listeners.append(deltas.append)
+
+            def apply(names):
+                for name in names:
+                    catalog.apply_changes([("created", f"{root}/{name}.txt")])
+
+            threads = [Thread(target=apply, args=(range(i, 200, 2),)) for i in [0, 1]]
+            [thread.start() for thread in threads]
+            [thread.join() for thread in threads]
+
+            # Every delta starts where the previous one ended
+            for previous, delta in zip(deltas, deltas[1:]):
+                self.assertEqual(delta["base"], previous["version"])
+
+            follower = ResourceCatalog(root=root, path=None)
+            for delta in deltas:
+                follower.apply_delta(delta)
+            self.assertEqual(follower.data(), catalog.data())
+            self.assertEqual(len(follower), 200)
+
+    def test_encoded_listing(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            catalog = ResourceCatalog(root=root, path=f"{folder}/resources.json")
+            catalog.scan()
+
+            builds = []
+
+            def build():
+                builds.append(catalog.version)
+                return {name: entry[0] for name, entry in catalog.data().items()}
+
+            data, etag = catalog.encode(build)
+            self.assertEqual(data, b"{}")
+            self.assertIs(catalog.encode(build)[0], data)
+            self.assertEqual(len(builds), 1)
+
+            with open(f"{root}/a.txt", "w") as f:
+                f.write("a")
+            catalog.apply("created", f"{root}/a.txt")
+            catalog.apply("modified", f"{folder}/outside.txt")
+
+            data, changed = catalog.encode(build)
+            self.assertEqual(data, b'{"a.txt":1}')
+            self.assertNotEqual(changed, etag)
+
+            # The digests the listing depends on are part of the ETag
+            self.assertNotEqual(catalog.encode(build, stamp=1)[1], changed)
+            self.assertEqual(len(builds), 3)
+
+            catalog.close()
+
+    def test_page(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(root)
+            for i, name in enumerate(["b.jpg", "a.txt", "c.jpg", "ab.jpg"]):
+                with open(f"{root}/{name}", "w") as f:
+                    f.write("x" * (4 - i))
+
+            catalog = ResourceCatalog(root=root, path=f"{folder}/resources.json")
+            catalog.scan()
+
+            def walk(**query):
+                names, cursor = [], None
+                while True:
+                    files, cursor = catalog.page(limit=2, cursor=cursor, **query)
+                    names.append([name for name, *_ in files])
+                    if not cursor:
+                        return names
+
+            self.assertEqual(walk(), [["a.txt", "ab.jpg"], ["b.jpg", "c.jpg"]])
+            self.assertEqual(
+                walk(sort="-size"), [["b.jpg", "a.txt"], ["c.jpg", "ab.jpg"]]
+            )
+            self.assertEqual(
+                walk(match="*.jpg", sort="-name"), [["c.jpg", "b.jpg"], ["ab.jpg"]]
+            )
+            self.assertEqual(walk(prefix="a"), [["a.txt", "ab.jpg"]])
+
+            # A file added behind the cursor does not shift the next page
+            files, cursor = catalog.page(limit=2)
+            with open(f"{root}/0.txt", "w") as f:
+                f.write("x")
+            catalog.apply("created", f"{root}/0.txt")
+            self.assertEqual(catalog.page(limit=2, cursor=cursor)[0][0][0], "b.jpg")
+
+            with self.assertRaises(ValueError):
+                catalog.page(limit=2, sort="mtime")
+
+            catalog.close()
+
+    def test_etag(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(root)
+            catalog = ResourceCatalog(root=root, path=None)
+            catalog.scan()
+
+            etag = catalog.etag(1)
+            self.assertEqual(catalog.etag(1), etag)
+            self.assertNotEqual(catalog.etag(2), etag)
+
+            # Tagged without building the listing, the same tag once built
+            self.assertIsNone(catalog.encoded)
+            self.assertEqual(catalog.encode(dict, 1)[1], etag)
+
+            with open(f"{root}/a.txt", "w") as f:
+                f.write("a")
+            catalog.apply_changes([("created", f"{root}/a.txt")])
+            self.assertNotEqual(catalog.etag(1), etag)
+
+            # Versions start over with the process, the tags do not match
+            other = ResourceCatalog(root=root, path=None)
+            other.version = catalog.version
+            self.assertNotEqual(other.etag(1), catalog.etag(1))
+
+    def test_apply_changes(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(root)
+            for name in ["a.txt", "b.txt"]:
+                with open(f"{root}/{name}", "w") as f:
+                    f.write(name)
+
+            catalog = ResourceCatalog(root=root, path=f"{folder}/resources.json")
+            catalog.scan()
+
+            deltas = []
+            catalog.listeners.append(deltas.append)
+
+            os.remove(f"{root}/a.txt")
+            with open(f"{root}/b.txt", "a") as f:
+                f.write("b")
+            with open(f"{root}/c.txt", "w") as f:
+                f.write("c")
+
+            base = catalog.version
+            catalog.apply_changes(
+                [
+                    ("deleted", f"{root}/a.txt"),
+                    ("modified", f"{root}/b.txt"),
+                    ("created", f"{root}/c.txt"),
+                    ("created", f"{folder}/outside.txt"),
+                ]
+            )
+            catalog.apply_changes([("deleted", f"{root}/missing.txt")])
+
+            self.assertEqual(
+                deltas,
+                [
+                    {
+                        "base": base,
+                        "version": catalog.version - 1,
+                        "added": {"c.txt": (1, f"{root}/c.txt")},
+                        "changed": {"b.txt": (6, f"{root}/b.txt")},
+                        "removed": ["a.txt"],
+                    }
+                ],
+            )
+
+            catalog.close()
+
+
+# A server on an ephemeral port serving `files`, from a temporary working
+# directory so the app folders of the tests do not mix with the real ones
+class ServerTestCase(TestCase):
+    engine = Server
+    files: dict[str, bytes] = {}
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = TemporaryDirectory()
+        os.chdir(self.folder.name)
+
+        os.makedirs("app/server/resources")
+        for name, data in self.files.items():
+            with open(f"app/server/resources/{name}", "wb") as f:
+                f.write(data)
+
+        self.server = self.engine(addr=("127.0.0.1", 0))
+        self.addr = self.server.server.getsockname()
+        Thread(target=self.server.start_server, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown_server()
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def connect(self, timeout: float = 5):
+        deadline = monotonic() + timeout
+
+        while True:
+            try:
+                return create_connection(self.addr)
+            except ConnectionRefusedError:
+                if monotonic() > deadline:
+                    raise
+                sleep(0.05)
+
+    def wait_for_digests(self, timeout: float = 10):
+        index, deadline = self.server.digest_index, monotonic() + timeout
+        index.refresh(self.server.catalog.iter_entries())
+
+        while len(index.entries) < len(self.files) and monotonic() < deadline:
+            sleep(0.05)
+
+
+class ListingTest(ServerTestCase):
+    files = {f"{i:04}.txt": str(i).encode() for i in range(1500)}
+
+    def test_not_modified(self):
+        self.wait_for_digests()
+
+        page = self.server.get_resource_page({})
+        self.assertEqual(len(page["files"]), 1000)
+
+        # Checked against the versions, the whole listing is never encoded
+        cached = self.server.get_resource_page({"etag": page["etag"]})
+        self.assertTrue(cached["not_modified"])
+        self.assertIsNone(self.server.catalog.encoded)
+
+        with open("app/server/resources/new.txt", "w") as f:
+            f.write("new")
+        self.server.catalog.apply_changes([("created", "app/server/resources/new.txt")])
+
+        page = self.server.get_resource_page({"etag": page["etag"]})
+        self.assertNotIn("not_modified", page)
+
+    def test_client_pages(self):
+        self.wait_for_digests()
+
+        client = BaseClient()
+        client.client = self.connect()
+        client.recv_thread.start()
+
+        self.assertTrue(client.fetch_list())
+        self.assertEqual(sorted(client.resources), sorted(self.files))
+        self.assertEqual(len(client.digests), len(self.files))
+
+        # Nothing changed, the listing is not sent again
+        self.assertFalse(client.fetch_list())
+        self.assertEqual(len(client.resources), len(self.files))
+
+        # A new run of the client starts from its cache of the listing
+        fresh = BaseClient()
+        fresh.client = self.connect()
+        fresh.recv_thread.start()
+
+        self.assertFalse(fresh.fetch_list())
+        self.assertEqual(fresh.resources, client.resources)
+
+        for each in [client, fresh]:
+            each.exit_signal.set()
+            each.client.shutdown(SHUT_RDWR)
+            each.client.close()
+
+
+class TransferTest(ServerTestCase):
+    files = {
+        "big.bin": Random(0).randbytes(STREAM_CHUNK_SIZE * 3 + 123),
+        "small.txt": b"small",
+    }
+
+    def download(self, filename: str, stream_id: int = 1, **request):
+        conn, decoder, frames = self.connect(), FrameDecoder(), []
+        conn.settimeout(10)
+        request = {"filename": filename, "weight": 1, **request}
+        send_frame(conn, "file", request, stream_id)
+
+        while (frame := recv_frame(conn, decoder)) and frame.type not in [
+            "done",
+            "error",
+        ]:
+            frames.append(frame)
+
+        return conn, [*frames, frame]
+
+    def close(self, conn):
+        send_frame(conn, "cmd", "quit")
+        conn.shutdown(SHUT_RDWR)
+        conn.close()
+
+    def test_stream_chunks(self):
+        conn, frames = self.download("big.bin")
+        data = [frame for frame in frames if frame.type == "data"]
+
+        self.assertEqual(frames[0].type, "range")
+        self.assertEqual(frames[0].json()["tot"], len(self.files["big.bin"]))
+        self.assertEqual(frames[-1].type, "done")
+
+        # One request, then the body as chunks of the stream size
+        self.assertEqual(len(data), 4)
+        self.assertTrue(all(len(f.payload) <= STREAM_CHUNK_SIZE for f in data))
+        self.assertTrue(all(f.stream_id == 1 for f in frames))
+        self.assertEqual(b"".join(f.payload for f in data), self.files["big.bin"])
+
+        stats = self.server.get_transmit_stats()
+        self.assertEqual(list(stats["served"]), ["127.0.0.1"])
+        self.close(conn)
+
+    def test_chunk_digests(self):
+        self.wait_for_digests()
+        digests = get_file_digests("app/server/resources/big.bin")
+
+        # The listing only has the whole-file digest, the chunk list comes with
+        # the range reply
+        page = self.server.get_resource_page({})
+        self.assertEqual(
+            page["files"]["big.bin"],
+            {"size": 3 * STREAM_CHUNK_SIZE + 123, "blake2b": digests["blake2b"]},
+        )
+
+        conn, frames = self.download("big.bin")
+        self.assertEqual(frames[0].json()["chunks"], digests["chunks"])
+        self.assertEqual(frames[0].json()["chunk_size"], digests["chunk_size"])
+        self.close(conn)
+
+    def test_resume(self):
+        path, data = "app/server/resources/big.bin", self.files["big.bin"]
+        offset = STREAM_CHUNK_SIZE + 100
+
+        def resume(offset, digest):
+            conn, frames = self.download("big.bin", offset=offset, digest=digest)
+            self.close(conn)
+            body = b"".join(frame.payload for frame in frames if frame.type == "data")
+            return frames[0].json()["offset"], body, frames[-1].type
+
+        # The partial file ends like the server's copy, it goes on from there
+        self.assertEqual(
+            resume(offset, get_tail_digest(path, offset)),
+            (offset, data[offset:], "done"),
+        )
+
+        # A partial file that does not match is sent again from the start
+        self.assertEqual(resume(offset, "0" * 32), (0, data, "done"))
+
+        # Already complete, nothing is left to send
+        size = len(data)
+        conn, frames = self.download(
+            "big.bin", offset=size, digest=get_tail_digest(path, size)
+        )
+        self.close(conn)
+        self.assertEqual([f.type for f in frames], ["range", "done"])
+        self.assertEqual(frames[0].json()["offset"], size)
+
+    def test_sendfile_fallback(self):
+        # Straight from disk with sendfile, then with plain sends when the
+        # kernel refuses it
+        self.server.block_cache.close()
+        self.server.block_cache = None
+
+        conn, frames = self.download("big.bin")
+        data = b"".join(frame.payload for frame in frames if frame.type == "data")
+        self.assertEqual(data, self.files["big.bin"])
+        self.close(conn)
+
+        with patch("os.sendfile", side_effect=OSError(errno.EINVAL, "refused")):
+            conn, frames = self.download("big.bin")
+
+        data = b"".join(frame.payload for frame in frames if frame.type == "data")
+        self.assertEqual(data, self.files["big.bin"])
+        self.close(conn)
+
+    def test_invalid_delta(self):
+        # An empty block would match everywhere, the file is sent whole
+        delta = {"block_size": 0, "blocks": [[0, get_strong_checksum(b"")]]}
+        conn, frames = self.download("big.bin", delta=delta)
+
+        self.assertNotIn("copy", [frame.type for frame in frames])
+        data = b"".join(frame.payload for frame in frames if frame.type == "data")
+        self.assertEqual(data, self.files["big.bin"])
+        self.close(conn)
+
+    def test_unknown_file(self):
+        conn, frames = self.download("missing.txt", stream_id=3)
+
+        self.assertEqual([(f.type, f.stream_id) for f in frames], [("error", 3)])
+
+        # The session goes on after the error
+        send_frame(conn, "file", {"filename": "small.txt"}, 5)
+        decoder = FrameDecoder()
+        frames = [recv_frame(conn, decoder) for _ in range(3)]
+        self.assertEqual([f.type for f in frames], ["range", "data", "done"])
+        self.assertEqual(frames[1].payload, b"small")
+        self.close(conn)
+
+    def test_high_descriptor(self):
+        # Past FD_SETSIZE, select() refuses the socket
+        left, right = socketpair()
+        fd = os.dup2(right.fileno(), 1500)
+        conn = socket(fileno=fd)
+        right.close()
+
+        try:
+            self.assertFalse(self.server.has_pending_frame(conn, FrameDecoder()))
+            left.sendall(encode_frame("cmd", "quit"))
+            self.assertTrue(self.server.has_pending_frame(conn, FrameDecoder(), 1))
+        finally:
+            conn.close()
+            left.close()
+
+
+class AsyncTransferTest(TransferTest):
+    engine = AsyncServer
+
+    def test_no_thread_pool(self):
+        self.assertIsNone(self.server.workers)
+
+
+class StallTest(ServerTestCase):
+    files = {"huge.bin": bytes(16 * 1024**2), "small.txt": b"small"}
+
+    def test_stalled_sendfile(self):
+        self.server.block_cache.close()
+        self.server.block_cache = None
+
+        with patch("classes.download_manager.TRANSMIT_TIMEOUT", 0.5):
+            self.test_stalled_client()
+
+    @patch("server.TRANSMIT_TIMEOUT", 0.5)
+    def test_stalled_client(self):
+        self.server.transmit_scheduler.slots = 1
+        self.connect().close()
+
+        # Asks for more than the socket buffers hold and never reads it
+        stalled = socket()
+        stalled.setsockopt(SOL_SOCKET, SO_RCVBUF, 4096)
+        stalled.connect(self.addr)
+        sleep(0.2)
+
+        for conn in list(self.server.addresses):
+            conn = conn if self.engine is Server else conn.get_extra_info("socket")
+            conn.setsockopt(SOL_SOCKET, SO_SNDBUF, 4096)
+
+        send_frame(stalled, "file", {"filename": "huge.bin"}, 1)
+        sleep(0.2)
+
+        # The only slot is given back, dropping the client if it has to
+        start = monotonic()
+        conn, frames = TransferTest.download(self, "small.txt")
+
+        self.assertEqual([f.type for f in frames], ["range", "data", "done"])
+        self.assertLess(monotonic() - start, 5)
+
+        TransferTest.close(self, conn)
+        stalled.close()
+
+
+class AsyncStallTest(StallTest):
+    engine = AsyncServer
+
+
+class SubscribeTest(ServerTestCase):
+    files = {"a.txt": b"a"}
+
+    def next_delta(self, conn, decoder):
+        frame = recv_frame(conn, decoder)
+        self.assertEqual(frame.type, "delta")
+        return frame.json()
+
+    def test_pushed_deltas(self):
+        conn, decoder = self.connect(), FrameDecoder()
+        conn.settimeout(10)
+        path = "app/server/resources/new.txt"
+
+        send_frame(conn, "cmd", "subscribe")
+        delta = self.next_delta(conn, decoder)
+        version = self.server.catalog.version
+        self.assertEqual((delta["base"], delta["version"]), (version, version))
+
+        # Each change is pushed on its own, one version after the last
+        for data, event_type in [(b"new", "created"), (b"changed", "modified")]:
+            with open(path, "wb") as f:
+                f.write(data)
+            self.server.catalog.apply_changes([(event_type, path)])
+
+            delta = self.next_delta(conn, decoder)
+            self.assertEqual(delta["base"], version)
+            version = delta["version"]
+
+            key = "added" if event_type == "created" else "changed"
+            self.assertEqual(list(delta[key]), ["new.txt"])
+            self.assertEqual(delta[key]["new.txt"]["size"], len(data))
+
+        os.remove(path)
+        self.server.catalog.apply_changes([("deleted", path)])
+
+        delta = self.next_delta(conn, decoder)
+        self.assertEqual(delta["base"], version)
+        self.assertEqual(delta["removed"], ["new.txt"])
+        self.assertEqual((delta["added"], delta["changed"]), ({}, {}))
+
+        send_frame(conn, "cmd", "quit")
+        conn.close()
+
+
+class AsyncSubscribeTest(SubscribeTest):
+    engine = AsyncServer
+
+
+class PreforkTest(TestCase):
+    files = {"a.txt": b"a", "b.txt": b"b"}
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = TemporaryDirectory()
+        os.chdir(self.folder.name)
+
+        os.makedirs("app/server/resources")
+        for name, data in self.files.items():
+            with open(f"app/server/resources/{name}", "wb") as f:
+                f.write(data)
+
+        # The workers read the port from the environment they are spawned with
+        with socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.addr = probe.getsockname()
+        self.env = patch.dict(os.environ, {"PORT": str(self.addr[1])})
+        self.env.start()
+
+        self.supervisor = PreforkSupervisor(processes=2)
+        self.thread = Thread(target=self.supervisor.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.supervisor.exit_signal.set()
+        self.thread.join()
+        self.env.stop()
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def list(self, conn):
+        send_frame(conn, "cmd", "list {}")
+
+        while (frame := recv_frame(conn, self.decoders[conn])).type != "list":
+            pass
+
+        return frame.json()
+
+    # The worker process holding the server end of the connection
+    def get_worker(self, conn) -> int:
+        port = f":{conn.getsockname()[1]:04X}"
+
+        with open("/proc/net/tcp") as f:
+            sockets = {
+                f"socket:[{line.split()[9]}]"
+                for line in f.readlines()[1:]
+                if line.split()[2].endswith(port)
+            }
+
+        for slot, (process, _) in self.supervisor.workers.items():
+            for fd in os.listdir(f"/proc/{process.pid}/fd"):
+                try:
+                    if os.readlink(f"/proc/{process.pid}/fd/{fd}") in sockets:
+                        return slot
+                except OSError:
+                    pass
+
+    # One connection to each worker, the kernel picks the worker
+    def connect_workers(self, timeout: float = 20):
+        conns, deadline, self.decoders = {}, monotonic() + timeout, {}
+
+        while len(conns) < 2 and monotonic() < deadline:
+            try:
+                conn = create_connection(self.addr)
+            except ConnectionRefusedError:
+                sleep(0.1)
+                continue
+
+            conn.settimeout(10)
+            self.decoders[conn] = FrameDecoder()
+            self.list(conn)
+
+            if (slot := self.get_worker(conn)) not in conns:
+                conns[slot] = conn
+            else:
+                conn.close()
+
+        self.assertEqual(len(conns), 2)
+        return list(conns.values())
+
+    # Until every worker has caught up with the supervisor
+    def wait_for_listing(self, conns, check, timeout: float = 10):
+        deadline = monotonic() + timeout
+
+        while True:
+            pages = [self.list(conn) for conn in conns]
+            if all(map(check, pages)) and pages[0]["etag"] == pages[1]["etag"]:
+                return pages
+            if monotonic() > deadline:
+                self.fail(f"Workers did not catch up: {pages}")
+            sleep(0.1)
+
+    def test_two_workers(self):
+        conns = self.connect_workers()
+
+        digest = get_file_digests("app/server/resources/a.txt")["blake2b"]
+        pages = self.wait_for_listing(
+            conns, lambda page: page["files"].get("a.txt", {}).get("blake2b") == digest
+        )
+        self.assertEqual(pages[0]["files"], pages[1]["files"])
+        self.assertEqual(sorted(pages[0]["files"]), sorted(self.files))
+
+        with open("app/server/resources/a.txt", "wb") as f:
+            f.write(b"changed")
+        with open("app/server/resources/new.txt", "wb") as f:
+            f.write(b"new")
+
+        digest = get_file_digests("app/server/resources/a.txt")["blake2b"]
+        changed = self.wait_for_listing(
+            conns,
+            lambda page: "new.txt" in page["files"]
+            and page["files"]["a.txt"] == {"size": 7, "blake2b": digest},
+        )
+        self.assertEqual(changed[0]["files"], changed[1]["files"])
+        self.assertNotEqual(changed[0]["etag"], pages[0]["etag"])
+
+        for conn in conns:
+            send_frame(conn, "cmd", "quit")
+            conn.close()
+
+
+class SQLiteCatalogTest(TestCase):
+    def test_recursive_index(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(f"{root}/sub/deep")
+            for name, size in [("a.txt", 3), ("sub/b.jpg", 1), ("sub/deep/c.jpg", 2)]:
+                with open(f"{root}/{name}", "w") as f:
+                    f.write("x" * size)
+
+            catalog = SQLiteResourceCatalog(
+                root=root, path=f"{folder}/resources.db", batch_size=2
+            )
+            catalog.scan()
+
+            self.assertEqual(len(catalog), 3)
+            self.assertEqual(
+                catalog.get("sub/deep/c.jpg"), (2, f"{root}/sub/deep/c.jpg")
+            )
+            self.assertNotIn("sub", catalog)
+
+            files, cursor = catalog.page(limit=1, sort="-size")
+            self.assertEqual(files, [("a.txt", 3, f"{root}/a.txt")])
+            self.assertEqual(
+                [
+                    name
+                    for name, *_ in catalog.page(limit=5, cursor=cursor, sort="-size")[
+                        0
+                    ]
+                ],
+                ["sub/deep/c.jpg", "sub/b.jpg"],
+            )
+            self.assertEqual(
+                [
+                    name
+                    for name, *_ in catalog.page(limit=5, prefix="sub/", match="*.jpg")[
+                        0
+                    ]
+                ],
+                ["sub/b.jpg", "sub/deep/c.jpg"],
+            )
+
+            catalog.record_hit("a.txt")
+            catalog.record_digest("a.txt", "abc")
+
+            deltas = []
+            catalog.listeners.append(deltas.append)
+
+            for name in ["sub/b.jpg", "sub/deep/c.jpg"]:
+                os.remove(f"{root}/{name}")
+            os.removedirs(f"{root}/sub/deep")
+            catalog.apply_changes([("deleted", f"{root}/sub")])
+
+            self.assertEqual(
+                sorted(deltas[0]["removed"]), ["sub/b.jpg", "sub/deep/c.jpg"]
+            )
+
+            # Unchanged files keep what the index learnt about them
+            catalog.scan()
+            catalog.close()
+
+            catalog = SQLiteResourceCatalog(root=root, path=f"{folder}/resources.db")
+            self.assertEqual(
+                catalog.db.execute(
+                    "SELECT name, digest, popularity FROM resources"
+                ).fetchall(),
+                [("a.txt", "abc", 1)],
+            )
+            catalog.close()
+
+    def test_reconcile_changed_folders(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            for name in ["a/x.txt", "b/y.txt", "b/old/z.txt"]:
+                os.makedirs(os.path.dirname(f"{root}/{name}"), exist_ok=True)
+                with open(f"{root}/{name}", "w") as f:
+                    f.write("x")
+
+            catalog = SQLiteResourceCatalog(root=root, path=f"{folder}/resources.db")
+            self.assertFalse(catalog.load())
+            catalog.scan()
+            catalog.close()
+
+            # Rewritten in place, "a" keeps its mtime and is not listed again
+            stat = os.stat(f"{root}/a")
+            with open(f"{root}/a/x.txt", "w") as f:
+                f.write("xx")
+            os.utime(f"{root}/a", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+            os.remove(f"{root}/b/old/z.txt")
+            os.rmdir(f"{root}/b/old")
+            os.makedirs(f"{root}/b/new")
+            with open(f"{root}/b/new/w.txt", "w") as f:
+                f.write("w")
+
+            catalog = SQLiteResourceCatalog(root=root, path=f"{folder}/resources.db")
+            self.assertTrue(catalog.load())
+            self.assertEqual(catalog.reconcile(), 2)
+            self.assertEqual(
+                sorted(catalog.data()), ["a/x.txt", "b/new/w.txt", "b/y.txt"]
+            )
+            self.assertEqual(catalog.get("a/x.txt")[0], 1)
+            self.assertEqual(catalog.get_subdirs("b"), ["b/new"])
+
+            self.assertEqual(catalog.reconcile(), 0)
+            catalog.close()
+
+    def test_readonly_follower(self):
+        with TemporaryDirectory() as folder:
+            root = f"{folder}/resources"
+            os.makedirs(root)
+            for name in ["a.txt", "b.txt", "c.txt"]:
+                with open(f"{root}/{name}", "w") as f:
+                    f.write(name)
+
+            path = f"{folder}/resources.db"
+            catalog = SQLiteResourceCatalog(root=root, path=path)
+            catalog.scan()
+            self.assertEqual(
+                [name for name, _ in catalog.iter_entries(batch_size=2)],
+                ["a.txt", "b.txt", "c.txt"],
+            )
+
+            deltas = []
+            catalog.listeners.append(deltas.append)
+            follower = SQLiteResourceCatalog(root=root, path=path, readonly=True)
+            follower.load_snapshot(catalog.version, {})
+
+            with open(f"{root}/d.txt", "w") as f:
+                f.write("d")
+            catalog.apply_changes([("created", f"{root}/d.txt")])
+            catalog.flush()
+
+            for delta in deltas:
+                follower.apply_delta(delta)
+            self.assertEqual(follower.version, catalog.version)
+            self.assertEqual(follower.get("d.txt")[0], 1)
+
+            # Only the supervisor writes to the database
+            follower.record_hit("d.txt")
+            follower.close()
+            catalog.close()
+
+
+class DebounceTest(TestCase):
+    def test_coalesce_until_stable(self):
+        batches = []
+
+        with TemporaryDirectory() as folder:
+            debouncer = EventDebouncer(
+                lambda changes: batches.append(changes), window=3600
+            )
+
+            with open(f"{folder}/a.txt", "w") as f:
+                f.write("a")
+            debouncer.push("created", f"{folder}/a.txt")
+            debouncer.push("modified", f"{folder}/a.txt")
+            debouncer.push("created", f"{folder}/b.txt")
+            debouncer.push("deleted", f"{folder}/b.txt")
+
+            self.assertEqual(debouncer.collect(), [])
+
+            # Pretend the window passed: a.txt is seen growing, b.txt is gone
+            debouncer.window = 0
+            self.assertEqual(debouncer.collect(), [("deleted", f"{folder}/b.txt")])
+
+            with open(f"{folder}/a.txt", "a") as f:
+                f.write("a")
+            self.assertEqual(debouncer.collect(), [])
+            self.assertEqual(debouncer.collect(), [("created", f"{folder}/a.txt")])
+
+            debouncer.window = 3600
+            debouncer.push("modified", f"{folder}/a.txt")
+            debouncer.stop()
+
+        self.assertEqual(batches, [[("modified", f"{folder}/a.txt")]])
+
+
+class BlockCacheTest(TestCase):
+    def test_read_through(self):
+        data = os.urandom(10_000)
+
+        with NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+
+            cache = BlockCache(capacity=4096, block_size=1024, policy="lru")
+            ident = cache.identity(f)
+
+            self.assertEqual(cache.read(f, ident, 1000, 100), data[1000:1100])
+            self.assertEqual(cache.read(f, ident, 1020, 10), data[1020:1030])
+            self.assertEqual(cache.read(f, ident, 9500, 1000), data[9500:])
+            self.assertEqual(cache.peek(ident, 1000, 48), data[1000:1048])
+            self.assertIsNone(cache.peek(ident, 5000, 10))
+
+            stats = cache.stats()
+            self.assertEqual((stats["misses"], stats["hits"]), (4, 4))
+            self.assertLessEqual(stats["size"], 4096)
+
+            # Rewritten files get another identity
+            f.write(b"x")
+            f.flush()
+            self.assertNotEqual(cache.identity(f), ident)
+
+    def test_scan_resistance(self):
+        with NamedTemporaryFile() as f:
+            f.write(os.urandom(64 * 1024))
+            f.flush()
+            ident = BlockCache.identity(f)
+
+            for policy, kept in [("lru", False), ("2q", True)]:
+                cache = BlockCache(capacity=8 * 1024, block_size=1024, policy=policy)
+
+                # Block 0 is asked for again once out of the FIFO, then one
+                # pass over the rest of the file
+                for i in [0, *range(1, 9), 0, *range(9, 64)]:
+                    cache.read(f, ident, i * 1024, 1024)
+
+                self.assertEqual(cache.peek(ident, 0, 1024) is not None, kept)
+                self.assertGreater(cache.stats()["evictions"], 0)
+
+    def test_single_flight(self):
+        from threading import Thread, Barrier
+        from time import sleep
+
+        class SlowCache(BlockCache):
+            def load(self, fd, index):
+                loads.append(index)
+                sleep(0.1)
+                return super().load(fd, index)
+
+        loads, results = [], []
+        with NamedTemporaryFile() as f:
+            f.write(b"abcd" * 1024)
+            f.flush()
+
+            cache = SlowCache(capacity=64 * 1024, block_size=4096)
+            ident = cache.identity(f)
+            barrier = Barrier(8)
+
+            def read():
+                barrier.wait()
+                results.append(cache.read(f, ident, 0, 8))
+
+            threads = [Thread(target=read) for _ in range(8)]
+            [t.start() for t in threads]
+            [t.join() for t in threads]
+
+        self.assertEqual(loads, [0])
+        self.assertEqual(results, [b"abcdabcd"] * 8)
+        self.assertEqual(cache.stats()["misses"] + cache.stats()["coalesced"], 8)
+
+    def test_prefetch(self):
+        data = os.urandom(16 * 1024)
+
+        with NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+
+            cache = BlockCache(capacity=64 * 1024, block_size=1024, max_prefetch=8192)
+            ident = cache.identity(f)
+
+            # More than may be read ahead at once
+            cache.prefetch(f, ident, 0, 16 * 1024)
+            self.assertEqual(cache.stats()["prefetch_dropped"], 1)
+
+            cache.prefetch(f, ident, 0, 8192)
+            cache.pool.shutdown(wait=True)
+
+            self.assertEqual(cache.peek(ident, 0, 8192), data[:8192])
+            self.assertEqual(cache.read(f, ident, 1000, 5000), data[1000:6000])
+
+            stats = cache.stats()
+            self.assertEqual(stats["misses"], 0)
+            self.assertEqual(stats["prefetched"], 8)
+            self.assertEqual(stats["prefetching"], 0)
+
+    def test_cancelled_prefetch(self):
+        with NamedTemporaryFile() as f:
+            f.write(os.urandom(8192))
+            f.flush()
+
+            cache = BlockCache(capacity=64 * 1024, block_size=1024, workers=1)
+            ident, opened = cache.identity(f), len(os.listdir("/proc/self/fd"))
+
+            # The only worker is busy, the read-aheads queue up behind it
+            busy = Event()
+            cache.pool.submit(busy.wait, 10)
+            for i in range(4):
+                cache.prefetch(f, ident, i * 2048, 2048)
+
+            self.assertEqual(len(os.listdir("/proc/self/fd")), opened + 4)
+
+            cache.close()
+            busy.set()
+            cache.pool.shutdown(wait=True)
+
+            self.assertEqual(len(os.listdir("/proc/self/fd")), opened)
+            self.assertEqual(cache.stats()["prefetching"], 0)
+
+
+class MappedFilesTest(TestCase):
+    def test_shared_maps(self):
+        maps = MappedFiles(idle=60)
+
+        with NamedTemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+
+            with open(f.name, "rb") as a, open(f.name, "rb") as b:
+                ident, view = maps.acquire(a, f.name)
+                other = maps.acquire(b, f.name)
+
+                self.assertEqual(other[0], ident)
+                self.assertEqual(bytes(view[2:5]), b"234")
+                self.assertEqual(maps.stats()["maps"], 1)
+
+                # Still sent from, the map stays until the last release
+                maps.invalidate(f.name)
+                maps.release(ident, view)
+                self.assertEqual(maps.stats()["mapped"], 1)
+
+                maps.release(*other)
+                self.assertEqual(maps.stats()["mapped"], 0)
+
+            with open(f.name, "rb") as a:
+                maps.idle = 0
+                maps.release(*maps.acquire(a, f.name))
+                maps.sweep()
+
+                self.assertEqual(maps.stats()["unmaps"], 2)
+
+        with NamedTemporaryFile() as f:
+            self.assertIsNone(maps.acquire(f, f.name))
+
+        maps.close()
+
+    def test_idle_sweep(self):
+        maps = MappedFiles(idle=0.05)
+
+        with NamedTemporaryFile() as f, open(f.name, "rb") as a:
+            f.write(b"0123456789")
+            f.flush()
+
+            # Unmapped without another acquire or release coming by
+            maps.release(*maps.acquire(a, f.name))
+            self.assertEqual(maps.stats()["mapped"], 1)
+
+            deadline = monotonic() + 5
+            while maps.stats()["mapped"] and monotonic() < deadline:
+                sleep(0.05)
+            self.assertEqual(maps.stats()["mapped"], 0)
+
+        maps.close()
+
+    def test_truncated_while_mapped(self):
+        maps = MappedFiles(idle=60)
+
+        with NamedTemporaryFile() as f:
+            f.write(b"x" * 8192)
+            f.flush()
+
+            file = ServerFileDownloader(
+                filename="x", chunk_sz=4096, tot=8192, path=f.name, maps=maps
+            )
+            self.assertEqual(bytes(file.read_view(4096)), b"x" * 4096)
+
+            # Read from the file instead of the pages past its new end
+            f.truncate(1000)
+            self.assertEqual(file.read_view(4096), b"x" * 1000)
+            self.assertRaises(ProtocolError, file.check_sent, 1000, 4096)
+
+        maps.close()
+
+
+class FileHandlesTest(TestCase):
+    def test_shared_handles(self):
+        with TemporaryDirectory() as folder:
+            paths = [f"{folder}/{name}" for name in "abc"]
+            for path in paths:
+                with open(path, "wb") as f:
+                    f.write(path.encode())
+
+            handles = FileHandles(budget=2)
+
+            files = [handles.acquire(paths[0]) for _ in range(100)]
+            self.assertEqual(len({id(f) for f in files}), 1)
+            self.assertEqual(os.pread(files[0].fileno(), 3, 0), paths[0][:3].encode())
+
+            for f in files:
+                handles.release(f)
+            self.assertEqual(handles.stats()["open"], 1)
+
+            # Past the budget the least recently used idle handle is closed
+            for path in paths[1:]:
+                handles.release(handles.acquire(path))
+            self.assertTrue(files[0].closed)
+            self.assertEqual(handles.stats()["open"], 2)
+
+            # A replaced file gets a new handle, the old one closes once released
+            old = handles.acquire(paths[1])
+            os.replace(paths[2], paths[1])
+            new = handles.acquire(paths[1])
+
+            self.assertIsNot(old, new)
+            handles.release(old)
+            self.assertTrue(old.closed)
+            self.assertFalse(new.closed)
+
+            handles.release(new)
+            handles.close()
+            self.assertEqual(handles.stats()["open"], 0)
+
+
+class AdmissionTest(TestCase):
+    def test_queue_and_reject(self):
+        admission = AdmissionController(workers=2, queue_size=2)
+
+        self.assertEqual([admission.offer(key) for key in "abcde"], [0, 0, 1, 2, None])
+        self.assertEqual(admission.positions(), [("c", 1), ("d", 2)])
+
+        # A waiting client that leaves frees its place, not a worker
+        self.assertEqual(admission.release("c"), [])
+        self.assertEqual(admission.positions(), [("d", 1)])
+
+        self.assertEqual(admission.release("a"), ["d"])
+        self.assertEqual(admission.offer("f"), 1)
+        self.assertEqual(admission.release("b"), ["f"])
+        self.assertEqual(admission.offer("g"), 1)
+        self.assertTrue("g" in admission and "f" in admission)
+        self.assertFalse("a" in admission)
+
+        self.assertEqual(
+            admission.stats(),
+            {"admitted": 4, "queued": 4, "rejected": 1, "active": 2, "waiting": 1},
+        )
+
 
 def suite():
     suite = TestSuite()
 
-    for test_case in [UtilsTest, SharedTest]:
+    for test_case in [
+        UtilsTest,
+        SharedTest,
+        ProtocolTest,
+        SchedulerTest,
+        TransmitSchedulerTest,
+        SegmentTest,
+        DigestTest,
+        DeltaTest,
+        CompressionTest,
+        CatalogTest,
+        ListingTest,
+        TransferTest,
+        AsyncTransferTest,
+        StallTest,
+        AsyncStallTest,
+        SubscribeTest,
+        AsyncSubscribeTest,
+        PreforkTest,
+        SQLiteCatalogTest,
+        DebounceTest,
+        BlockCacheTest,
+        MappedFilesTest,
+        FileHandlesTest,
+        AdmissionTest,
+    ]:
         suite.addTests(TestLoader().loadTestsFromTestCase(test_case))
 
     return suite
@@ -13,6 +13,43 @@ def with_part1_arg(parser: ArgumentParser):
     parser.add_argument("-p1", "--part1", help="Run part 1", action="store_true")
 
 
+def with_resume_arg(parser: ArgumentParser):
+    parser.add_argument(
+        "-c", "--resume", help="Resume partial downloads", action="store_true"
+    )
+
+
+def with_delta_arg(parser: ArgumentParser):
+    parser.add_argument(
+        "-d", "--delta", help="Fetch only the changed blocks", action="store_true"
+    )
+
+
+def with_subscribe_arg(parser: ArgumentParser):
+    parser.add_argument(
+        "-s",
+        "--subscribe",
+        help="Keep the resource list updated by the server",
+        action="store_true",
+    )
+
+
+def with_async_arg(parser: ArgumentParser):
+    parser.add_argument(
+        "-a", "--async", help="Run with asyncio", dest="use_async", action="store_true"
+    )
+
+
+def with_processes_arg(parser: ArgumentParser):
+    parser.add_argument(
+        "-w",
+        "--processes",
+        help="Serve from N worker processes sharing the port",
+        type=int,
+        default=1,
+    )
+
+
 def with_version_arg(parser: ArgumentParser):
     parser.add_argument("-v", "--version", help="Version", action="store_true")
 
@@ -0,0 +1,46 @@
+import os, bz2, lzma, zlib
+
+from shared.constants import PRECOMPRESSED_EXTENSIONS
+
+CODECS = {
+    "zlib": (zlib.compressobj, zlib.decompressobj),
+    "bz2": (bz2.BZ2Compressor, bz2.BZ2Decompressor),
+    "lzma": (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+
+
+def new_compressor(codec: str):
+    return CODECS[codec][0]()
+
+
+def new_decompressor(codec: str):
+    return CODECS[codec][1]()
+
+
+def is_precompressed(filename: str):
+    return os.path.splitext(filename)[1].lower() in PRECOMPRESSED_EXTENSIONS
+
+
+def get_sample_ratio(path: str, sample_size: int = 64 * 1024, samples: int = 3):
+    size = os.path.getsize(path)
+    raw = compressed = 0
+
+    # A quick zlib pass over a few spread out samples
+    with open(path, "rb") as f:
+        for i in range(samples):
+            f.seek(max(0, size - sample_size) * i // max(1, samples - 1))
+            sample = f.read(sample_size)
+
+            raw += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+
+    return compressed / raw if raw else 1.0
+
+
+def compress_file(path: str, target: str, codec: str, block_size: int = 1024**2):
+    compressor = new_compressor(codec)
+
+    with open(path, "rb") as src, open(target, "wb") as dst:
+        while block := src.read(block_size):
+            dst.write(compressor.compress(block))
+        dst.write(compressor.flush())
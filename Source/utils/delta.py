@@ -0,0 +1,129 @@
+import os
+from mmap import mmap, ACCESS_READ
+from hashlib import blake2b
+from itertools import accumulate
+
+from shared.envs import DELTA_BLOCK_SIZE, DELTA_MAX_BLOCKS
+
+# rsync-style signatures: a rolling weak checksum finds candidate blocks at any
+# offset, a strong digest confirms them
+MOD = 1 << 16
+
+
+def prepare_basis(path: str) -> str | None:
+    basis = f"{path}.basis"
+
+    # A delta run that was cut short leaves its basis behind, keep using it
+    if not os.path.isfile(basis):
+        if not os.path.isfile(path) or not os.path.getsize(path):
+            return None
+        os.replace(path, basis)
+
+    return basis
+
+
+def get_block_size(size: int):
+    return max(DELTA_BLOCK_SIZE, -(-size // DELTA_MAX_BLOCKS))
+
+
+def get_weak_parts(block: bytes):
+    return sum(block) % MOD, sum(accumulate(block)) % MOD
+
+
+def get_weak_checksum(block: bytes):
+    a, b = get_weak_parts(block)
+    return a | b << 16
+
+
+def get_strong_checksum(block: bytes):
+    return blake2b(block, digest_size=16).hexdigest()
+
+
+def get_block_signatures(path: str, block_size: int):
+    blocks: list[tuple[int, str]] = []
+
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            blocks.append((get_weak_checksum(block), get_strong_checksum(block)))
+
+    return blocks
+
+
+# Signatures come from the client: a block smaller than the server would pick
+# makes the scan quadratic, and an empty one never moves it forward
+def check_delta_request(block_size, blocks, size: int):
+    if not isinstance(block_size, int) or not (
+        DELTA_BLOCK_SIZE <= block_size <= max(DELTA_BLOCK_SIZE, size)
+    ):
+        raise ValueError(f"Invalid delta block size {block_size}")
+
+    if not isinstance(blocks, list) or len(blocks) > DELTA_MAX_BLOCKS:
+        raise ValueError("Invalid delta block list")
+
+    for block in blocks:
+        if not (
+            isinstance(block, list)
+            and len(block) == 2
+            and isinstance(block[0], int)
+            and 0 <= block[0] < 1 << 32
+            and isinstance(block[1], str)
+            and len(block[1]) == 32
+        ):
+            raise ValueError(f"Invalid delta block {block}")
+
+
+def compute_delta(path: str, block_size: int, blocks: list[tuple[int, str]]):
+    # Offsets in the new file that the client copies from its own blocks,
+    # everything in between is sent as literal data
+    copies: dict[int, dict[str, int]] = {}
+
+    table: dict[int, dict[str, int]] = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(int(weak), {}).setdefault(strong, index)
+
+    size = os.path.getsize(path)
+    if not table or size < block_size:
+        return copies
+
+    with open(path, "rb") as f, mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+        pos, last = 0, None
+        a, b = get_weak_parts(data[:block_size])
+
+        while pos + block_size <= size:
+            candidates = table.get(a | b << 16)
+            index = (
+                candidates.get(get_strong_checksum(data[pos : pos + block_size]))
+                if candidates
+                else None
+            )
+
+            if index is not None:
+                # Runs of consecutive blocks collapse into a single copy
+                if (
+                    last
+                    and last["block"] + last["count"] == index
+                    and (last["offset"] + last["size"] == pos)
+                ):
+                    last["count"] += 1
+                    last["size"] += block_size
+                else:
+                    last = {"offset": pos, "block": index, "count": 1}
+                    last["size"] = block_size
+                    copies[pos] = last
+
+                pos += block_size
+                a, b = get_weak_parts(data[pos : pos + block_size])
+                continue
+
+            if pos + block_size >= size:
+                break
+
+            out, new = data[pos], data[pos + block_size]
+            a = (a - out + new) % MOD
+            b = (b - block_size * out + a) % MOD
+            pos += 1
+
+    for copy in copies.values():
+        del copy["offset"]
+
+    return copies
@@ -1,7 +1,10 @@
 import os, re, json
+from hashlib import blake2b, sha256
 
 from shared.envs import (
     MAX_BUF_SIZE,
+    RESUME_CHECK_SIZE,
+    DIGEST_CHUNK_SIZE,
     SERVER_DIR_PATH,
     SERVER_RESOURCES_PATH,
     CLIENT_DOWNLOADS_PATH,
@@ -41,18 +44,96 @@ def get_downloaded_list():
 
 
 def get_download_path(filename: str):
-    os.makedirs(CLIENT_DOWNLOADS_PATH, exist_ok=True)
-    return os.path.join(CLIENT_DOWNLOADS_PATH, filename)
+    path = os.path.join(CLIENT_DOWNLOADS_PATH, filename)
+
+    # Names from a recursive index carry folders
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def is_safe_filename(filename: str):
+    parts = filename.replace("\\", "/").split("/")
+    return not os.path.isabs(filename) and ".." not in parts and "" not in parts
+
+
+# Changes when the file is replaced or rewritten
+def get_stat_identity(stat: os.stat_result) -> tuple[int, int, int, int]:
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def get_file_identity(file) -> tuple[int, int, int, int]:
+    return get_stat_identity(os.fstat(file.fileno()))
+
+
+def get_partial_size(filename: str):
+    path = get_download_path(filename)
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def get_tail_digest(path: str, offset: int, size: int = RESUME_CHECK_SIZE):
+    start = max(0, offset - size)
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        return blake2b(f.read(offset - start), digest_size=16).hexdigest()
+
+
+def new_chunk_hasher():
+    return blake2b(digest_size=16)
+
+
+def get_file_digest(path: str, block_size: int = 1024**2):
+    digest = blake2b(digest_size=32)
+
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# Not downloaded yet, even an empty resource, is never the same file
+def is_same_file(path: str, size: int, digest: str):
+    return (
+        os.path.isfile(path)
+        and os.path.getsize(path) == size
+        and get_file_digest(path) == digest
+    )
+
+
+def get_file_digests(path: str, chunk_size: int = DIGEST_CHUNK_SIZE):
+    whole, strong, chunks = blake2b(digest_size=32), sha256(), []
+
+    # One pass over the file feeds the whole-file and the chunk digests
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            whole.update(chunk)
+            strong.update(chunk)
+
+            digest = new_chunk_hasher()
+            digest.update(chunk)
+            chunks.append(digest.hexdigest())
+
+    return {
+        "blake2b": whole.hexdigest(),
+        "sha256": strong.hexdigest(),
+        "chunk_size": chunk_size,
+        "chunks": chunks,
+    }
 
 
 def update_resources_data():
     path = os.path.join(SERVER_DIR_PATH, "resources.json")
 
-    data: dict[str, tuple[int, str]] = {}
-    filenames = get_resource_list()
-    for filename in filenames:
-        size = get_asset_size(filename)
-        data[filename] = size, get_resource_path(filename)
+    os.makedirs(SERVER_RESOURCES_PATH, exist_ok=True)
+
+    # scandir hands out the entries with their type, no extra call per file
+    with os.scandir(SERVER_RESOURCES_PATH) as it:
+        data: dict[str, tuple[int, str]] = {
+            entry.name: (entry.stat().st_size, entry.path)
+            for entry in it
+            if entry.is_file()
+        }
 
     with open(path, "w") as f:
         f.write(json.dumps(data).replace(" ", ""))
@@ -1,14 +1,26 @@
 import time, os, threading
+from functools import partial
 from watchdog.observers import Observer
 
-from classes import MonitorFileSystemHandler
+from classes import MonitorFileSystemHandler, ResourceCatalog
 from shared.envs import SERVER_RESOURCES_PATH
 from .files import update_resources_data
 from .logger import console_log, LogType
 
 
-def update_resource_list(path: str, event_type: str):
-    console_log(LogType.INFO, f"[{event_type}]: {path}")
+def update_resource_list(
+    changes: list[tuple[str, str]],
+    catalog: ResourceCatalog = None,
+):
+    for event_type, path in changes[:5]:
+        console_log(LogType.INFO, f"[{event_type}]: {path}")
+    if len(changes) > 5:
+        console_log(LogType.INFO, f"... and {len(changes) - 5} more changes")
+
+    if catalog is not None:
+        catalog.apply_changes(changes)
+        return
+
     console_log(LogType.INFO, "Updating resources data")
     update_resources_data()
     console_log(LogType.OK, "Resources data updated successfully!")
@@ -18,6 +30,7 @@ def start_watching(
     path=SERVER_RESOURCES_PATH,
     exit_signal: threading.Event = None,
     updater=update_resource_list,
+    catalog: ResourceCatalog = None,
 ):
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
@@ -25,10 +38,12 @@ def start_watching(
         console_log(LogType.ERR, f"Path {path} does not exist")
         console_log(LogType.INFO, f"Created {path}!")
 
-    update_resources_data()
+    update_resources_data() if catalog is None else None
     console_log(LogType.INFO, f'Watching changes from "{path}"\n')
 
-    event_handler = MonitorFileSystemHandler(updater=updater)
+    event_handler = MonitorFileSystemHandler(
+        updater=updater if catalog is None else partial(updater, catalog=catalog)
+    )
 
     observer = Observer()
     observer.schedule(event_handler, path, recursive=True)
@@ -45,3 +60,4 @@ def start_watching(
         console_log(LogType.INFO, "Observer stopped!")
         observer.stop()
         observer.join()
+        event_handler.stop()